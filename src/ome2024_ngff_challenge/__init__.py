@@ -7,15 +7,49 @@ ome2024-ngff-challenge: Tools for converting OME-Zarr data within the ome2024-ng
 from __future__ import annotations
 
 import argparse
+import importlib
 import sys
 
-from .lookup import cli as lookup_cli
-from .resave import cli as resave_cli
-
 __version__ = "0.0.0"
 
 __all__ = ["__version__"]
 
+# Subcommand -> (module, help). A module is only imported when its command is
+# selected so that e.g. `--help` or `lookup` do not load tensorstore, zarr, etc.
+COMMANDS = {
+    "resave": ("resave", "convert Zarr v2 dataset to Zarr v3"),
+    "lookup": ("lookup", "lookup metadata from EBI OLS"),
+    "reencode": ("reencode", "convert a single Zarr v2 array to Zarr v3"),
+    "finalize": (
+        "finalize",
+        "store the statistics of a fileset converted by `resave --output-script` jobs",
+    ),
+    "run-scripts": (
+        "run_scripts",
+        "run the scripts generated by `resave --output-script`",
+    ),
+    "update": (
+        "update",
+        "update the RO-Crate and OME metadata of a converted fileset",
+    ),
+    "validate": (
+        "validate",
+        "check the metadata and shard indexes of a converted fileset",
+    ),
+    "inspect": (
+        "occupancy",
+        "report chunk occupancy and storage use from the shard indexes",
+    ),
+    "stats": (
+        "stats",
+        "collect size and metadata statistics for a CSV of dataset URLs",
+    ),
+    "publish": (
+        "publish",
+        "build a JSON index and thumbnails of a catalogue for the dashboard",
+    ),
+}
+
 
 def dispatch(args=sys.argv[1:]):
     """
@@ -25,12 +59,11 @@ def dispatch(args=sys.argv[1:]):
     """
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
     subparsers = parser.add_subparsers(help="subparser help")
-    resave_cli(subparsers)
-    lookup_cli(subparsers)
-    # Upcoming parsers to be moved to submodules
-    subparsers.add_parser("validate", help="TBD: evaluate a converted fileset locally")
-    subparsers.add_parser(
-        "update", help="TBD: updated the RO-Crate metadata in a fileset"
-    )
+    selected = args[0] if args else None
+    for name, (module, text) in COMMANDS.items():
+        if name == selected:
+            importlib.import_module(f".{module}", __name__).cli(subparsers)
+        else:
+            subparsers.add_parser(name, help=text)
     ns = parser.parse_args(args)
     return ns.func(ns)
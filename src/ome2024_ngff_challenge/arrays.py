@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import tensorstore as ts
+
+from .resave import (
+    NGFF_VERSION,
+    ROCrateWriter,
+    array_totals,
+    convert_array,
+    sum_totals,
+    write_totals,
+)
+from .utils import Config, RetryBudget, StoreSettings, add_creator
+
+LOGGER = logging.getLogger(__file__)
+
+AXIS_TYPES = {"t": "time", "c": "channel"}
+
+
+class ArraySource:
+    """
+    Presents an in-memory, memory-mapped or lazy array as the input of
+    `convert_array` in place of a `Config`.
+
+    Any object with `shape`, `dtype` and NumPy-style slicing can be used,
+    e.g. `numpy.ndarray`, `numpy.memmap` or `dask.array.Array`. The data is
+    exposed to tensorstore as a virtual array which reads one block at a
+    time, so nothing is copied up front: memory-mapped files are only paged
+    in and dask graphs only computed for the block being written.
+    """
+
+    def __init__(self, data, name: str | None = None):
+        self.data = data
+        self.name = name or type(data).__name__
+        self.shape = tuple(int(x) for x in data.shape)
+        self.dtype = np.dtype(data.dtype)
+        self.block: list[int] | None = None
+        # Only used by TSMetrics; virtual arrays have no kvstore metrics
+        self.ts_config = {"driver": "virtual_chunked", "kvstore": {"driver": "memory"}}
+
+    def read_block(self, domain: ts.IndexDomain, array: np.ndarray, _) -> None:
+        array[...] = np.asarray(self.data[domain.index_exp])
+
+    def ts_read(self):
+        layout = None
+        if self.block is not None:
+            layout = ts.ChunkLayout(read_chunk_shape=self.block)
+        return ts.virtual_chunked(
+            self.read_block,
+            dtype=ts.dtype(self.dtype.name),
+            shape=self.shape,
+            chunk_layout=layout,
+        )
+
+    def s3_endpoint(self):
+        return ""
+
+    def __str__(self):
+        return f"<{self.name} {list(self.shape)} {self.dtype}>"
+
+
+def normalize_axes(axes: list) -> list[dict]:
+    """
+    Accepts axis names ("t", "c", "z", "y", "x") or full NGFF axis
+    dictionaries and returns the latter.
+    """
+    return [
+        {"name": axis, "type": AXIS_TYPES.get(axis, "space")}
+        if isinstance(axis, str)
+        else dict(axis)
+        for axis in axes
+    ]
+
+
+def default_chunks(shape: tuple, axes: list[dict]) -> list[int]:
+    """
+    One plane per chunk along non-spatial axes, up to 128 pixels along the
+    last two axes and up to 16 along any other spatial axis (e.g. "z").
+    """
+    chunks = []
+    for i, (size, axis) in enumerate(zip(shape, axes)):
+        if axis.get("type") != "space":
+            chunks.append(1)
+        else:
+            chunks.append(min(size, 128 if i >= len(shape) - 2 else 16))
+    return chunks
+
+
+def default_shards(shape: tuple, chunks: list[int]) -> list[int]:
+    """
+    Up to 16x16 chunks in the last two dimensions (e.g. 2048x2048 pixels for
+    the default chunks) and a single chunk along all others, which keeps the
+    memory needed per shard bounded for large stacks.
+    """
+    shards = list(chunks)
+    for i in range(max(0, len(shape) - 2), len(shape)):
+        shards[i] = min(-(-shape[i] // chunks[i]), 16) * chunks[i]
+    return shards
+
+
+def write_image(
+    data,
+    output_path: str | Path,
+    axes: list,
+    scale: list[float] | None = None,
+    translation: list[float] | None = None,
+    name: str | None = None,
+    chunks: list[int] | None = None,
+    shards: list[int] | None = None,
+    rocrate: ROCrateWriter | None = None,
+    notes: str | None = None,
+    threads: int = 16,
+    retries: int = 10,
+    overwrite: bool = False,
+    bucket: str | None = None,
+    endpoint: str | None = None,
+    anon: bool = False,
+    region: str = "us-east-1",
+) -> None:
+    """
+    Write `data` as an OME-Zarr 0.5 (Zarr v3) image without first writing a
+    v2 copy to disk.
+
+    `data` is either a single array or a list of arrays, one per resolution
+    level with the highest resolution first (see `ArraySource` for the
+    supported types). `axes` are the names or NGFF axis dictionaries of the
+    dimensions, and `scale` and `translation` the coordinate transformations
+    of the first level. The scale of the other levels is derived from the
+    ratio of their shapes.
+
+    `chunks` and `shards` apply to all levels; the chunks default to
+    `default_chunks` and the shards to `default_shards`. Each level is written
+    with `convert_array` and so uses the same codecs, batching and retries
+    as `resave`. If `rocrate` is given, its `ro-crate-metadata.json` is
+    written next to the image, otherwise no RO-Crate is created.
+    """
+    levels = list(data) if isinstance(data, (list, tuple)) else [data]
+    sources = [ArraySource(level, f"level {i}") for i, level in enumerate(levels)]
+    axes = normalize_axes(axes)
+    base = sources[0].shape
+    for source in sources:
+        if len(source.shape) != len(axes):
+            msg = f"{source} does not match the {len(axes)} axes"
+            raise ValueError(msg)
+    if scale is None:
+        scale = [1.0] * len(axes)
+    if len(scale) != len(axes):
+        msg = f"scale {scale} does not match the {len(axes)} axes"
+        raise ValueError(msg)
+
+    settings = StoreSettings(
+        path=Path(output_path),
+        bucket=bucket,
+        endpoint=endpoint,
+        anon=anon,
+        region=region,
+        overwrite=overwrite,
+    )
+    output_config = Config(settings, "output", "w")
+    background_delete = output_config.check_or_delete_path()
+    start = time.time()
+    try:
+        output_config.create_group()
+
+        datasets = []
+        for i, source in enumerate(sources):
+            factors = [b / s for b, s in zip(base, source.shape)]
+            transformations = [
+                {"type": "scale", "scale": [x * f for x, f in zip(scale, factors)]}
+            ]
+            if translation is not None:
+                transformations.append(
+                    {"type": "translation", "translation": list(translation)}
+                )
+            datasets.append(
+                {"path": str(i), "coordinateTransformations": transformations}
+            )
+        multiscale = {"axes": axes, "datasets": datasets}
+        if name:
+            multiscale["name"] = name
+        ome_attrs = {"version": NGFF_VERSION, "multiscales": [multiscale]}
+        add_creator(ome_attrs, notes)
+        output_config.zr_attrs["ome"] = ome_attrs
+
+        retry = RetryBudget(retries)
+        dimension_names = [axis["name"] for axis in axes]
+        totals = []
+        for i, source in enumerate(sources):
+            ds_chunks = chunks or default_chunks(source.shape, axes)
+            ds_shards = shards or default_shards(source.shape, ds_chunks)
+            source.block = list(ds_shards)
+            stats = convert_array(
+                source,
+                output_config.sub_config(str(i), False),
+                dimension_names,
+                ds_chunks,
+                ds_shards,
+                threads,
+                retry=retry,
+            )
+            totals.append(array_totals(stats))
+        write_totals(output_config, sum_totals(totals, images=1), start)
+
+        if rocrate is not None:
+            rocrate.write(output_config)
+    finally:
+        if background_delete is not None:
+            background_delete.wait()
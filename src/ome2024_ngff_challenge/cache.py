@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+LOGGER = logging.getLogger(__file__)
+
+
+class MetadataCache:
+    """
+    On-disk cache of the small metadata files (.zgroup, .zattrs, .zarray,
+    METADATA.ome.xml, ...) read from an input hierarchy.
+
+    Entries are keyed by the full URL of the file and store a validator
+    (mtime and size for local files, the ETag for S3 objects) which is
+    compared against the source before a cached value older than `max_age`
+    seconds is reused. Younger entries are reused without a request, since
+    checking every file (one HEAD request each on S3) costs as much as
+    reading it again. Missing files are cached as well so that probing for
+    optional groups like "labels" does not need to be repeated.
+
+    One JSON file is written per input root under the cache directory so
+    that a `--output-write-details` run can be followed by
+    `--output-read-details` or `--output-script` runs without re-crawling.
+    """
+
+    VERSION = 1
+
+    def __init__(
+        self,
+        directory: Path,
+        root: str,
+        validate: bool = True,
+        max_age: float = 3600,
+    ):
+        self.directory = Path(directory)
+        self.root = root
+        self.validate = validate
+        self.max_age = max_age
+        digest = hashlib.sha256(root.encode()).hexdigest()[:16]
+        self.filename = self.directory / f"{digest}.json"
+        self.entries: dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.load()
+
+    def load(self) -> None:
+        if not self.filename.is_file():
+            return
+        try:
+            with self.filename.open() as o:
+                data = json.load(o)
+        except (OSError, json.JSONDecodeError) as e:
+            LOGGER.warning(f"ignoring unreadable metadata cache {self.filename}: {e}")
+            return
+        if data.get("version") != self.VERSION or data.get("root") != self.root:
+            LOGGER.warning(f"ignoring stale metadata cache {self.filename}")
+            return
+        self.entries = data.get("entries", {})
+        LOGGER.debug(f"loaded {len(self.entries)} entries from {self.filename}")
+
+    def save(self) -> None:
+        """
+        Atomically write the cache file if any entries were added or changed.
+        """
+        LOGGER.info(
+            f"metadata cache {self.filename}: {self.hits} hits, {self.misses} misses"
+        )
+        if not self.dirty:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.filename.with_suffix(f".{os.getpid()}.tmp")
+        with tmp.open("w") as o:
+            json.dump(
+                {"version": self.VERSION, "root": self.root, "entries": self.entries},
+                o,
+            )
+        tmp.replace(self.filename)
+        self.dirty = False
+
+    def read_text(self, config, path: str) -> str | None:
+        """
+        Return the text of the file at `path` below `config`, either from
+        the cache or by reading (and caching) it from the source. Returns
+        None if the file does not exist.
+        """
+        url = f"{config}/{path}"
+        entry = self.entries.get(url)
+        if entry is not None:
+            now = time.time()
+            if not self.validate or now - entry.get("checked", 0) < self.max_age:
+                self.hits += 1
+                return entry["value"]
+            if entry["validator"] == validator(config, path):
+                entry["checked"] = now
+                self.dirty = True
+                self.hits += 1
+                return entry["value"]
+            LOGGER.debug(f"metadata cache: {url} changed")
+
+        self.misses += 1
+        # Take the validator before reading so that a concurrent change is
+        # detected on the next run rather than masked.
+        checked = time.time()
+        token = validator(config, path)
+        buf = config.zr_get(path)
+        value = None if buf is None else buf.to_bytes().decode()
+        self.entries[url] = {"validator": token, "value": value, "checked": checked}
+        self.dirty = True
+        return value
+
+
+def validator(config, path: str) -> str | None:
+    """
+    Return a token which changes whenever the file at `path` below `config`
+    changes, or None if the file does not exist.
+    """
+    if config.is_s3():
+        info = config.zr_info(path)
+        if info is None:
+            return None
+        etag = info.get("ETag") or info.get("etag")
+        if etag:
+            return str(etag)
+        return f"{info.get('LastModified')}-{info.get('size')}"
+
+    try:
+        st = (Path(config.fs_string()) / path).stat()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return f"{st.st_mtime_ns}-{st.st_size}"
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import time
+from collections.abc import Iterator
+from pathlib import Path
+
+LOGGER = logging.getLogger(__file__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    url TEXT PRIMARY KEY,
+    checked REAL NOT NULL,
+    changed REAL NOT NULL,
+    stats TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    url TEXT PRIMARY KEY,
+    status INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT
+);
+"""
+
+
+class Catalogue:
+    """
+    Local SQLite catalogue of the datasets crawled by `stats`.
+
+    Besides the statistics of each dataset, the status and the ETag and
+    Last-Modified validators of the documents they were derived from are
+    kept so that a refresh can send conditional requests and only parse a
+    dataset again if one of those documents changed.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM datasets").fetchone()[0]
+
+    def stats(self, url: str) -> dict | None:
+        row = self.db.execute(
+            "SELECT stats FROM datasets WHERE url = ?", (url,)
+        ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def document(self, url: str) -> tuple[int, str | None, str | None] | None:
+        """
+        Returns the status, ETag and Last-Modified of the last response for
+        the document at `url`, or None if it was never fetched.
+        """
+        return self.db.execute(
+            "SELECT status, etag, last_modified FROM documents WHERE url = ?", (url,)
+        ).fetchone()
+
+    def conditions(self, url: str) -> dict[str, str]:
+        """
+        The headers of a conditional request for the document at `url`
+        """
+        headers = {}
+        document = self.document(url)
+        if document is not None:
+            _, etag, last_modified = document
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def unchanged(self, url: str, status: int) -> bool:
+        """
+        Whether a response with `status` to the request with the `conditions`
+        for `url` means that the document did not change, i.e. "304 Not
+        Modified" or the same error as before (e.g. a missing RO-Crate).
+        """
+        if status == 304:
+            return True
+        document = self.document(url)
+        return document is not None and status // 100 != 2 and document[0] == status
+
+    def store(
+        self,
+        url: str,
+        stats: dict | None,
+        documents: dict[str, tuple[int, str | None, str | None]],
+    ) -> None:
+        """
+        Record that the dataset at `url` was checked, along with its new
+        `stats` (if it changed) and the (status, ETag, Last-Modified) of the
+        documents fetched.
+        """
+        now = time.time()
+        with self.db:
+            if stats is None:
+                self.db.execute(
+                    "UPDATE datasets SET checked = ? WHERE url = ?", (now, url)
+                )
+            else:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO datasets (url, checked, changed, stats) VALUES (?, ?, ?, ?)",
+                    (url, now, now, json.dumps(stats)),
+                )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO documents (url, status, etag, last_modified) VALUES (?, ?, ?, ?)",
+                [(key, *value) for key, value in documents.items() if value[0] != 304],
+            )
+
+    def items(self) -> Iterator[tuple[str, float, float, dict]]:
+        """
+        Yields the url, check time, change time and stats of every dataset
+        ordered by url.
+        """
+        rows = self.db.execute(
+            "SELECT url, checked, changed, stats FROM datasets ORDER BY url"
+        )
+        for url, checked, changed, stats in rows:
+            yield url, checked, changed, json.loads(stats)
@@ -0,0 +1,170 @@
+"""
+Per-channel intensity statistics collected from the blocks of an array as
+they are converted, used to fill in the "omero" rendering settings.
+"""
+
+from __future__ import annotations
+
+import copy
+
+import numpy as np
+
+from .thumbnails import DEFAULT_COLORS
+
+# Number of histogram bins per channel and block
+BINS = 1024
+
+# Percentiles used as the default rendering window
+PERCENTILES = (0.1, 99.9)
+
+
+class ChannelStatistics:
+    """
+    Streaming minimum, maximum and histogram of each channel of an array.
+
+    Every block passed to `add` is reduced to the range and a histogram
+    over that range of each of its channels in a few vectorized passes.
+    The histograms are merged by `summary`, so percentiles are exact to
+    within a bin of the block and of the merged histogram.
+
+    Blocks may arrive in any order and more than once (e.g. when retried).
+    Non-finite values and blocks which are never added (e.g. those skipped
+    as empty) are not counted.
+    """
+
+    def __init__(self, shape: list[int], axes: list[str], bins: int = BINS):
+        self.axis = axes.index("c") if "c" in axes else None
+        self.count = 1 if self.axis is None else shape[self.axis]
+        self.bins = bins
+        self.integer = False
+        self.blocks: dict[tuple, tuple[range, np.ndarray, np.ndarray, np.ndarray]] = {}
+
+    def add(self, selection: tuple[slice, ...], data: np.ndarray) -> None:
+        """
+        Record the `data` of the block at `selection`
+        """
+        if self.axis is None:
+            channels = range(1)
+            values = data.reshape(1, -1)
+        else:
+            channels = range(selection[self.axis].start, selection[self.axis].stop)
+            values = np.moveaxis(data, self.axis, 0).reshape(len(channels), -1)
+        if values.size == 0:
+            return
+
+        self.integer = values.dtype.kind in "iub"
+        finite = np.isfinite(values) if values.dtype.kind == "f" else None
+        if finite is None:
+            lo = values.min(axis=1).astype(np.float64)
+            hi = values.max(axis=1).astype(np.float64)
+        else:
+            lo = np.where(finite, values, np.inf).min(axis=1).astype(np.float64)
+            hi = np.where(finite, values, -np.inf).max(axis=1).astype(np.float64)
+        scale = self.bins / np.where(hi > lo, hi - lo, 1)
+
+        # One bincount for all channels, offset by channel
+        with np.errstate(invalid="ignore", over="ignore"):
+            index = ((values - lo[:, np.newaxis]) * scale[:, np.newaxis]).astype(
+                np.int64
+            )
+        np.clip(index, 0, self.bins - 1, out=index)
+        index += np.arange(len(channels))[:, np.newaxis] * self.bins
+        if finite is not None:
+            index = index[finite]
+        counts = np.bincount(index.ravel(), minlength=len(channels) * self.bins)
+        key = tuple((s.start, s.stop) for s in selection)
+        self.blocks[key] = (channels, lo, hi, counts.reshape(len(channels), -1))
+
+    def summary(self, percentiles: tuple[float, float] = PERCENTILES) -> list[dict]:
+        """
+        Returns the "min", "max" and the values at `percentiles` as "start"
+        and "end" of each channel, or an empty dict for channels without
+        any values.
+        """
+        ranges: list[list[tuple]] = [[] for _ in range(self.count)]
+        for channels, lo, hi, counts in self.blocks.values():
+            for i, channel in enumerate(channels):
+                if lo[i] <= hi[i]:
+                    ranges[channel].append((lo[i], hi[i], counts[i]))
+
+        results = []
+        for blocks in ranges:
+            if not blocks:
+                results.append({})
+                continue
+            low = min(b[0] for b in blocks)
+            high = max(b[1] for b in blocks)
+            merged = np.zeros(self.bins, dtype=np.int64)
+            for lo, hi, counts in blocks:
+                centers = lo + (np.arange(self.bins) + 0.5) * (hi - lo) / self.bins
+                merged += np.histogram(
+                    centers, bins=self.bins, range=(low, high), weights=counts
+                )[0].astype(np.int64)
+            cumulative = np.cumsum(merged)
+            width = (high - low) / self.bins
+            if self.integer:
+                result = {"min": int(low), "max": int(high)}
+            else:
+                result = {"min": float(low), "max": float(high)}
+            for key, percentile in zip(("start", "end"), percentiles):
+                position = np.searchsorted(
+                    cumulative, percentile / 100 * cumulative[-1], side="left"
+                )
+                value = low + (min(position, self.bins - 1) + 0.5) * width
+                value = float(np.clip(value, low, high))
+                result[key] = round(value) if self.integer else value
+            results.append(result)
+        return results
+
+
+def update_omero(omero: dict | None, summary: list[dict]) -> dict:
+    """
+    Returns a copy of the `omero` metadata with the window of each channel
+    completed from the `summary` of `ChannelStatistics`. Since the summary
+    may come from a downsampled level which lacks the extremes of the full
+    resolution, existing values are only replaced if they are wrong:
+
+      * "min" and "max" if they are missing, empty or exclude values of
+        the summary (which then widen them)
+      * "start" and "end" if they are missing or select none of the values
+
+    Channels are created if `omero` does not list one per channel.
+    """
+    omero = copy.deepcopy(omero) if omero else {}
+    channels = omero.get("channels")
+    if not isinstance(channels, list) or len(channels) != len(summary):
+        channels = [
+            {
+                "active": True,
+                "color": "FFFFFF" if len(summary) == 1 else DEFAULT_COLORS[i % 3],
+                "label": f"Channel {i}",
+            }
+            for i in range(len(summary))
+        ]
+        omero["channels"] = channels
+    for channel, values in zip(channels, summary):
+        if not values:
+            continue
+        window = channel.setdefault("window", {})
+        low, high = window.get("min"), window.get("max")
+        if (
+            not isinstance(low, (int, float))
+            or not isinstance(high, (int, float))
+            or high <= low
+        ):
+            window["min"] = values["min"]
+            window["max"] = values["max"]
+        else:
+            window["min"] = min(low, values["min"])
+            window["max"] = max(high, values["max"])
+        start, end = window.get("start"), window.get("end")
+        if (
+            not isinstance(start, (int, float))
+            or not isinstance(end, (int, float))
+            or end <= start
+            or start >= values["max"]
+            or end <= values["min"]
+        ):
+            window["start"] = values["start"]
+            window["end"] = values["end"]
+    return omero
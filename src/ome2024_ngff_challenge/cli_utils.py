@@ -0,0 +1,51 @@
+"""
+Helpers shared by the subcommand parsers. This module must stay free of
+heavy imports (tensorstore, zarr, ...) so that it can be used before a
+command has been selected; see `dispatch`.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+
+
+def configure_logging(ns: argparse.Namespace, logger: logging.Logger):
+    if ns.log.upper() == "TRACE":
+        numeric_level = 5
+    else:
+        numeric_level = getattr(logging, ns.log.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError(f"Invalid log level: {ns.log}. Use 'info' or 'debug'")
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    logger.setLevel(numeric_level)
+
+
+def csv_int(vstr, sep=",") -> list:
+    """Convert a string of comma separated values to integers
+    @returns iterable of floats
+    """
+    values = []
+    for v0 in vstr.split(sep):
+        try:
+            v = int(v0)
+            values.append(v)
+        except ValueError as ve:
+            raise argparse.ArgumentError(
+                message=f"Invalid value {v0}, values must be a number"
+            ) from ve
+    return values
+
+
+def add_store_arguments(parser: argparse.ArgumentParser, selection: str) -> None:
+    """
+    Add the S3 arguments read by `Config` for the given selection ("input" or "output")
+    """
+    parser.add_argument(f"--{selection}-bucket")
+    parser.add_argument(f"--{selection}-endpoint")
+    parser.add_argument(f"--{selection}-anon", action="store_true")
+    parser.add_argument(f"--{selection}-region", default="us-east-1")
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+
+LOGGER = logging.getLogger(__file__)
+
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+
+
+def is_jsonl(path: Path) -> bool:
+    return Path(path).suffix.lower() in JSONL_SUFFIXES
+
+
+class DetailsWriter:
+    """
+    Records the shape, chunks and proposed shards of every array for
+    `--output-write-details`.
+
+    If the filename ends in ".jsonl", one record of the form
+
+        {"key": "in.zarr/0", "shape": [...], "chunks": [...], "shards": [...]}
+
+    is appended per array as it is visited. Otherwise, the original JSON
+    format (a single dictionary keyed by input path) is written once on
+    `close()`.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.jsonl = is_jsonl(self.path)
+        self.details: dict = {}
+        self.stream = self.path.open(mode="a") if self.jsonl else None
+
+    def add(self, key: str, shape: list, chunks: list, shards: list) -> None:
+        record = {"shape": list(shape), "chunks": list(chunks), "shards": list(shards)}
+        if self.stream is not None:
+            self.stream.write(json.dumps({"key": key, **record}) + "\n")
+            self.stream.flush()
+        else:
+            self.details[key] = record
+
+    def close(self) -> None:
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        else:
+            with self.path.open(mode="w") as o:
+                json.dump(self.details, o)
+
+
+class DetailsReader:
+    """
+    Looks up the chunks and shards for an array by its input path
+    (`Config.fs_string()`) from a file written by `DetailsWriter`.
+
+    JSON files are loaded completely. JSONL files are scanned once to build
+    an index of byte offsets; each record is only parsed when it is looked
+    up. If a key occurs more than once, the last record wins so that
+    corrections can simply be appended.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.details: dict | None = None
+        self.offsets: dict[str, int] = {}
+        if is_jsonl(self.path):
+            self.index()
+        else:
+            with self.path.open() as o:
+                self.details = json.load(o)
+
+    def index(self) -> None:
+        with self.path.open("rb") as o:
+            offset = 0
+            for line in o:
+                if line.strip():
+                    # Only the key is kept in memory
+                    key = json.loads(line)["key"]
+                    self.offsets[key] = offset
+                offset += len(line)
+        LOGGER.debug(f"indexed {len(self.offsets)} records from {self.path}")
+
+    def __contains__(self, key: str) -> bool:
+        if self.details is not None:
+            return key in self.details
+        return key in self.offsets
+
+    def __getitem__(self, key: str) -> dict:
+        if self.details is not None:
+            return self.details[key]
+        offset = self.offsets[key]
+        with self.path.open("rb") as o:
+            o.seek(offset)
+            return json.loads(o.readline())
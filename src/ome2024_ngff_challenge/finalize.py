@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .manifest import MANIFEST
+from .resave import BLOCK_STATS, STATS_KEY, array_totals, sum_totals
+from .shards import list_objects
+from .utils import Config, add_store_arguments, configure_logging
+
+LOGGER = logging.getLogger(__file__)
+
+# Counters of `convert_array` which are added up over the jobs of an array
+SUMMED = ("read", "written", "elapsed", "retries", "failed_batches", "skipped_blocks")
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge finalize"
+    desc = f"""
+
+
+The `finalize` subcommand completes a fileset whose arrays were converted by
+the jobs in the `{MANIFEST}` written by `resave --output-script`. It is the
+command of the last job, which depends on all others:
+
+    - the statistics which the jobs converting a range of blocks of an array
+      stored next to its chunks are merged into the `zarr.json` of the array
+    - the roll-up totals (images, arrays, objects, bytes) are stored on
+      every group above the arrays, as `resave` does when converting directly
+
+Every array listed in the manifest must have been converted completely.
+
+
+BASIC
+
+    Finalize a local fileset:                {cmd} out.zarr
+    Finalize a fileset on S3:                {cmd} --output-bucket=bucket --output-endpoint=https://s3.example.com path/out.zarr
+
+    """
+    parser = subparsers.add_parser(
+        "finalize",
+        help="store the statistics of a fileset converted by `resave --output-script` jobs",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main, output_overwrite=False)
+    add_store_arguments(parser, "output")
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=16,
+        help="number of arrays finalized simultaneously",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument("output_path", type=Path)
+
+
+def join(*parts: str | Path) -> str:
+    return "/".join(str(p) for p in parts if str(p))
+
+
+def merge_block_stats(stats: list[dict]) -> dict:
+    """
+    Combine the `convert_array` statistics of the jobs which converted the
+    blocks of one array. Counters (and the elapsed time) are added up.
+    """
+    merged = {key: value for key, value in stats[0].items() if key != "blocks"}
+    for key in SUMMED:
+        merged[key] = sum(s.get(key, 0) for s in stats)
+    merged["start"] = min(s["start"] for s in stats)
+    merged["stop"] = max(s["stop"] for s in stats)
+    merged["passthrough"] = any(s.get("passthrough") for s in stats)
+    merged["streamed"] = any(s.get("streamed") for s in stats)
+    return merged
+
+
+class Finalizer:
+    """
+    Stores the statistics of the arrays listed in the tasks of a job
+    manifest and the roll-up totals of the groups above them. Since the
+    jobs may have run anywhere, the elapsed time of a group is the sum of
+    that of its arrays rather than a wall-clock time.
+    """
+
+    def __init__(self, config: Config, jobs: list[dict]):
+        self.config = config
+        # block ranges of every array path (none if converted whole)
+        self.arrays: dict[str, list] = {}
+        for job in jobs:
+            for task in job["tasks"]:
+                ranges = self.arrays.setdefault(task["path"], [])
+                if "blocks" in task:
+                    ranges.append(tuple(task["blocks"]))
+
+    def read(self, path: str) -> dict | None:
+        return self.config.zr_read_json(join(path, "zarr.json"))
+
+    def write_stats(self, path: str, metadata: dict, stats: dict) -> None:
+        metadata.setdefault("attributes", {})[STATS_KEY] = stats
+        self.config.zr_write_text(join(path, "zarr.json"), json.dumps(metadata))
+
+    def finalize_array(self, path: str) -> dict:
+        """
+        Returns the statistics of the array at `path`, merging and removing
+        those stored by the jobs which converted ranges of its blocks.
+        """
+        metadata = self.read(path)
+        if metadata is None:
+            msg = f"{self.config}/{path} has not been converted"
+            raise ValueError(msg)
+        array_config = self.config.sub_config(path, False)
+        found = list_objects(array_config, BLOCK_STATS)
+        if not found:
+            stats = metadata.get("attributes", {}).get(STATS_KEY)
+            if stats is None:
+                msg = f"{self.config}/{path} has not been converted"
+                raise ValueError(msg)
+            return stats
+
+        ranges = {tuple(int(x) for x in Path(key).stem.split("-")) for key in found}
+        missing = sorted(set(self.arrays[path]) - ranges)
+        if missing:
+            msg = f"blocks {missing} of {self.config}/{path} have not been converted"
+            raise ValueError(msg)
+        stats = merge_block_stats(
+            [array_config.zr_read_json(f"{BLOCK_STATS}/{key}") for key in sorted(found)]
+        )
+        for key in found:
+            array_config.zr_delete(f"{BLOCK_STATS}/{key}")
+        if not array_config.is_s3():
+            # the now empty directory
+            array_config.zr_delete(BLOCK_STATS)
+
+        objects = list_objects(array_config)
+        objects.pop("zarr.json", None)
+        stats["objects"] = len(objects)
+        stats["stored"] = sum(objects.values())
+        self.write_stats(path, metadata, stats)
+        return stats
+
+    def run(self, threads: int) -> dict:
+        """
+        Finalize all arrays and groups and return the totals of the fileset.
+        """
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            stats = dict(zip(self.arrays, pool.map(self.finalize_array, self.arrays)))
+
+        # Every group above an array, deepest first
+        children: dict[str, list[dict]] = {}
+        for path, array_stats in stats.items():
+            parts = path.split("/")
+            children.setdefault("/".join(parts[:-1]), []).append(
+                array_totals(array_stats)
+            )
+            for depth in range(len(parts) - 1):
+                children.setdefault("/".join(parts[:depth]), [])
+        totals: dict = {}
+        for path in sorted(children, key=lambda p: -len(p.split("/")) if p else 0):
+            # Note: the rows of a plate are implicit groups without zarr.json
+            metadata = self.read(path) or {}
+            ome = metadata.get("attributes", {}).get("ome", {})
+            below = children[path]
+            if path.split("/")[-1] == "labels" and "labels" in ome:
+                # Labels are part of the image rather than images of their own
+                below = [{**t, "images": 0} for t in below]
+            totals = sum_totals(below, images=int("multiscales" in ome))
+            if metadata:
+                self.write_stats(path, metadata, totals)
+            if path:
+                children["/".join(path.split("/")[:-1])].append(totals)
+        return totals
+
+
+def main(ns: argparse.Namespace) -> None:
+    configure_logging(ns, LOGGER)
+    config = Config(ns, "output", "w")
+    manifest = config.zr_read_text(MANIFEST)
+    if manifest is None:
+        message = f"no {MANIFEST} found at {config}"
+        raise SystemExit(message)
+    jobs = [json.loads(line) for line in manifest.to_bytes().decode().splitlines()]
+    totals = Finalizer(config, jobs).run(ns.threads)
+    LOGGER.info(f"finalized {totals['arrays']} arrays in {config}: {totals}")
@@ -1,11 +1,22 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import contextlib
+import json
 import logging
+import sys
+import urllib.parse
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
 
-import requests
+from .cli_utils import configure_logging
+from .ontology import DEFAULT_INDEX, DEFAULT_SOURCES, OntologyIndex, parse_obo
 
-from .utils import configure_logging
+if TYPE_CHECKING:
+    import requests
 
 LOGGER = logging.getLogger(__file__)
 
@@ -15,13 +26,27 @@ def cli(subparsers: argparse._SubParsersAction):
     desc = f"""
 
 
-The `lookup` subcommand will take search the EBI OLS service
-for metadata identifiers matching the given input.
+The `lookup` subcommand will search a local index of ontology terms
+(FBbi imaging modalities and the NCBI taxonomy "taxslim" subset by default)
+for metadata identifiers matching the given input. The index is built once
+with `--build-index`, after which no network access is needed.
+
+With `--remote`, the EBI OLS service is queried when the local index has no
+match. OLS responses are cached in the index for `--ttl` seconds.
 
 
 BASIC
 
+    Build the index (needs network):         {cmd} --build-index
+    Build the index from local OBO files:    {cmd} --build-index fbbi.obo taxslim.obo
     Simplest example:                        {cmd} "light-sheet"
+    Fall back to the EBI OLS service:        {cmd} --remote "light-sheet"
+
+BATCH
+
+    Several terms:                           {cmd} "light-sheet" "confocal" "homo sapiens"
+    Terms from a file as TSV:                {cmd} --input=terms.txt --format=tsv
+    Terms from stdin as JSON lines:          cut -f3 sheet.tsv | {cmd} --input=- --format=json --remote
 
 
     """
@@ -35,7 +60,50 @@ BASIC
     parser.add_argument(
         "--log", default="info", help="'error', 'warn', 'info', 'debug' or 'trace'"
     )
-    parser.add_argument("text")
+    parser.add_argument(
+        "--index",
+        type=Path,
+        default=DEFAULT_INDEX,
+        help=f"location of the local ontology index (default: {DEFAULT_INDEX})",
+    )
+    parser.add_argument(
+        "--build-index",
+        nargs="*",
+        metavar="OBO",
+        help="(re)build the index from OBO files or URLs (default: FBbi and NCBI taxslim)",
+    )
+    parser.add_argument(
+        "--remote",
+        action="store_true",
+        help="query the EBI OLS service if the local index has no match",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=7 * 24 * 3600,
+        help="seconds for which cached OLS responses are reused (default: 1 week)",
+    )
+    parser.add_argument(
+        "--rows", type=int, default=10, help="number of results per term"
+    )
+    parser.add_argument(
+        "--input",
+        metavar="FILE",
+        help="file with one term per line to look up ('-' for stdin)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=("table", "tsv", "json"),
+        default="table",
+        help="'table' for reading, 'tsv' with a QUERY column, or one JSON object per term",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="maximum number of simultaneous OLS requests",
+    )
+    parser.add_argument("text", nargs="*", help="terms to look up")
 
 
 def parse(ns: argparse.Namespace):
@@ -44,24 +112,175 @@ def parse(ns: argparse.Namespace):
     """
 
     configure_logging(ns, LOGGER)
+    if not ns.text and not ns.input and ns.build_index is None:
+        message = "Provide the text to look up, --input or --build-index"
+        raise SystemExit(message)
+
+
+def read_source(source: str) -> list[str]:
+    if source.startswith(("http://", "https://")):
+        # Note: only imported when needed since lookups are usually local
+        import requests
+
+        response = requests.get(source, timeout=(5, 300))
+        response.raise_for_status()
+        return response.text.splitlines()
+    with Path(source).open(encoding="utf-8") as o:
+        return o.read().splitlines()
 
 
-def main(ns: argparse.Namespace):
-    text = ns.text
-    url = f"https://www.ebi.ac.uk/ols4/api/search?q={text}&obsoletes=false&local=false&rows=10&start=0&format=json&lang=en"
-    response = requests.get(url, timeout=(5, 30))
-    if response.status_code == 200:
-        result = response.json()
-        docs = result["response"]["docs"]
+def build_index(index: OntologyIndex, sources: list[str]) -> None:
+    for source in sources:
+        count = index.add(parse_obo(read_source(source)))
+        LOGGER.info(f"indexed {count} terms from {source}")
+
+
+def remote_url(text: str, rows: int) -> str:
+    query = urllib.parse.quote(text)
+    return f"https://www.ebi.ac.uk/ols4/api/search?q={query}&obsoletes=false&local=false&rows={rows}&start=0&format=json&lang=en"
+
+
+def remote_session(workers: int) -> requests.Session:
+    """
+    A session for OLS with a connection pool for `workers` threads
+    """
+    import requests
+    import requests.adapters
+
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    return session
+
+
+def fetch(session: requests.Session, url: str) -> dict:
+    response = session.get(url, timeout=(5, 30))
+    if response.status_code != 200:
+        raise Exception(response)
+    return response.json()
+
+
+def read_terms(ns: argparse.Namespace) -> Iterator[str]:
+    """
+    Yields the terms given as arguments followed by those in `--input`
+    (one per line, "-" for stdin), skipping blank lines.
+    """
+    yield from ns.text
+    if ns.input == "-":
+        yield from (line.strip() for line in sys.stdin if line.strip())
+    elif ns.input:
+        with Path(ns.input).open(encoding="utf-8") as o:
+            yield from (line.strip() for line in o if line.strip())
+
+
+def resolve(
+    index: OntologyIndex, terms: Iterable[str], ns: argparse.Namespace
+) -> Iterator[tuple[str, list, str | None]]:
+    """
+    Yields `(term, docs, error)` in the order of `terms`. Terms are first
+    searched in the local index; with `--remote`, misses are fetched from
+    OLS over a single pooled session with at most `--workers` requests in
+    flight, opened on the first miss. Results are yielded as soon as they
+    (and all previous terms) are available. The index is only used from the
+    calling thread.
+    """
+    # The pool is shut down before the session (if any) is closed
+    with contextlib.ExitStack() as stack, ThreadPoolExecutor(ns.workers) as pool:
+        session = None
+
+        # (term, docs, None) for resolved terms or (term, url, future)
+        pending: collections.deque = collections.deque()
+
+        def ready():
+            return pending and (pending[0][2] is None or pending[0][2].done())
+
+        for term in terms:
+            docs = index.search(term, ns.rows)
+            if docs or not ns.remote:
+                pending.append((term, docs, None))
+            else:
+                url = remote_url(term, ns.rows)
+                cached = index.cached_response(url, ns.ttl)
+                if cached is not None:
+                    LOGGER.debug(f"using cached response for {url}")
+                    pending.append((term, cached["response"]["docs"], None))
+                else:
+                    if session is None:
+                        session = stack.enter_context(remote_session(ns.workers))
+                    pending.append((term, url, pool.submit(fetch, session, url)))
+            while ready():
+                yield complete(index, *pending.popleft())
+
+        while pending:
+            yield complete(index, *pending.popleft())
+
+
+def complete(index: OntologyIndex, term: str, value, future: Future | None):
+    if future is None:
+        return term, value, None
+    try:
+        result = future.result()
+    except Exception as e:
+        LOGGER.error(f"lookup of {term!r} failed: {e}")
+        return term, [], str(e)
+    index.store_response(value, result)
+    return term, result["response"]["docs"], None
+
+
+def description(doc: dict) -> str:
+    desc = "" if not doc["description"] else doc["description"][0]
+    return desc.split("\n")[0][:70]  # At most first 70 chars of first line
+
+
+def print_results(results: Iterable[tuple[str, list, str | None]], fmt: str) -> int:
+    """
+    Print the results as they arrive and return the number of failed terms.
+    """
+    failed = 0
+    if fmt == "table":
         header = "ONTOLOGY  \tTERM                \tLABEL                         \tDESCRIPTION"
         print(header)  # noqa: T201
+    elif fmt == "tsv":
+        print("QUERY\tONTOLOGY\tTERM\tLABEL\tDESCRIPTION")  # noqa: T201
+    for term, docs, error in results:
+        failed += error is not None
+        if fmt == "json":
+            record = {"query": term, "results": docs}
+            if error is not None:
+                record["error"] = error
+            print(json.dumps(record), flush=True)  # noqa: T201
+            continue
         for doc in docs:
             onto = doc["ontology_name"]
-            term = doc["short_form"]
+            short = doc["short_form"]
             name = doc["label"]
-            desc = "" if not doc["description"] else doc["description"][0]
-            desc = desc.split("\n")[0][:70]  # At most first 70 chars of first line
-            print(f"""{onto:10s}\t{term:20s}\t{name:30s}\t{desc}""")  # noqa: T201
+            desc = description(doc)
+            if fmt == "tsv":
+                print(f"{term}\t{onto}\t{short}\t{name}\t{desc}")  # noqa: T201
+            else:
+                print(f"""{onto:10s}\t{short:20s}\t{name:30s}\t{desc}""")  # noqa: T201
+        sys.stdout.flush()
+    return failed
 
-    else:
-        raise Exception(response)
+
+def main(ns: argparse.Namespace) -> None:
+    """
+    Raises SystemExit if any remote lookup failed.
+    """
+    parse(ns)
+    index = OntologyIndex(ns.index)
+    try:
+        if ns.build_index is not None:
+            build_index(index, ns.build_index or list(DEFAULT_SOURCES))
+        if not ns.text and not ns.input:
+            return
+
+        if not len(index) and not ns.remote:
+            message = (
+                f"The local index {ns.index} is empty. Use --build-index or --remote"
+            )
+            raise SystemExit(message)
+        failed = print_results(resolve(index, read_terms(ns), ns), ns.format)
+    finally:
+        index.close()
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import heapq
+import json
+import logging
+import math
+import shlex
+
+import numpy as np
+
+from .utils import Config
+
+LOGGER = logging.getLogger(__file__)
+
+MANIFEST = "jobs.jsonl"
+MAKEFILE = "Makefile"
+
+
+class JobManifest:
+    """
+    Collects the arrays visited during an `--output-script` run and groups
+    them into jobs of roughly `job_bytes` uncompressed bytes each:
+
+      * arrays smaller than `job_bytes` are packed together, assigning the
+        largest remaining array to the currently smallest job
+      * larger arrays are split into ranges of whole shards which are
+        converted with `ome2024-ngff-challenge reencode --blocks=START:STOP`
+
+    Every array is converted with `ome2024-ngff-challenge reencode`. A final
+    "finalize" job depends on all others and stores the statistics of the
+    arrays and the roll-up totals of the groups with
+    `ome2024-ngff-challenge finalize`. `write` stores the jobs as JSON lines
+    (one job per line) along with a Makefile rendering.
+    """
+
+    def __init__(self, job_bytes: int):
+        if job_bytes < 1:
+            msg = f"job size must be positive ({job_bytes})"
+            raise ValueError(msg)
+        self.job_bytes = job_bytes
+        self.tasks: list[dict] = []
+
+    def add(
+        self,
+        input_config: Config,
+        output_config: Config,
+        metadata: dict,
+        dimension_names: list,
+        chunks: list,
+        shards: list,
+    ) -> None:
+        """
+        Add the array described by the v2 `metadata` to the manifest.
+        """
+        shape = metadata["shape"]
+        itemsize = np.dtype(metadata["dtype"]).itemsize
+        block = shards if shards else chunks
+        block_bytes = math.prod(min(b, s) for b, s in zip(block, shape)) * itemsize
+        block_count = math.prod(-(-s // b) for s, b in zip(shape, block))
+        task = {
+            "path": output_config.subpath.as_posix() if output_config.subpath else "",
+            "input": str(input_config),
+            "output": str(output_config),
+            "shape": list(shape),
+            "dtype": metadata["dtype"],
+            "chunks": list(chunks),
+            "shards": list(shards) if shards else None,
+            "dimension_names": list(dimension_names),
+        }
+
+        total = math.prod(shape) * itemsize
+        if total <= self.job_bytes or block_count == 1:
+            command = reencode_command(
+                input_config, output_config, dimension_names, chunks, shards
+            )
+            self.tasks.append({**task, "bytes": total, "command": command})
+            return
+
+        per_job = max(1, self.job_bytes // block_bytes)
+        for start in range(0, block_count, per_job):
+            stop = min(block_count, start + per_job)
+            self.tasks.append(
+                {
+                    **task,
+                    "bytes": (stop - start) * block_bytes,
+                    "blocks": [start, stop],
+                    "command": reencode_command(
+                        input_config,
+                        output_config,
+                        dimension_names,
+                        chunks,
+                        shards,
+                        (start, stop),
+                    ),
+                }
+            )
+
+    def jobs(self, config: Config) -> list[dict]:
+        """
+        Returns the list of jobs for the fileset at `config`, the last of
+        which is the "finalize" job.
+        """
+        total = sum(task["bytes"] for task in self.tasks)
+        count = min(len(self.tasks), max(1, math.ceil(total / self.job_bytes)))
+        bins: list[tuple[int, int, list]] = [(0, i, []) for i in range(count)]
+        for task in sorted(self.tasks, key=lambda t: t["bytes"], reverse=True):
+            nbytes, idx, tasks = heapq.heappop(bins)
+            tasks.append(task)
+            heapq.heappush(bins, (nbytes + task["bytes"], idx, tasks))
+
+        jobs = []
+        for nbytes, idx, tasks in sorted(bins, key=lambda b: b[1]):
+            jobs.append(
+                {
+                    "id": f"job-{idx:05d}",
+                    "bytes": nbytes,
+                    "depends_on": [],
+                    "commands": [task["command"] for task in tasks],
+                    "tasks": tasks,
+                }
+            )
+        jobs.append(
+            {
+                "id": "finalize",
+                "bytes": 0,
+                "depends_on": [job["id"] for job in jobs],
+                "commands": [finalize_command(config)],
+                "tasks": [],
+            }
+        )
+        return jobs
+
+    def write(self, config: Config) -> None:
+        jobs = self.jobs(config)
+        lines = [json.dumps(job) for job in jobs]
+        config.zr_write_text(MANIFEST, "\n".join(lines) + "\n")
+        config.zr_write_text(MAKEFILE, render_makefile(jobs))
+        LOGGER.info(
+            f"wrote {len(jobs) - 1} jobs for {len(self.tasks)} tasks to {config}/{MANIFEST}"
+        )
+
+
+def render_makefile(jobs: list[dict]) -> str:
+    """
+    Render the jobs as Makefile targets so that `make -j N` (or a scheduler
+    which understands Makefiles) can run them respecting the dependencies.
+    """
+    final = jobs[-1]["id"]
+    lines = [".PHONY: all " + " ".join(job["id"] for job in jobs), f"all: {final}", ""]
+    for job in jobs:
+        lines.append(f"{job['id']}: {' '.join(job['depends_on'])}".rstrip())
+        lines.extend(f"\t{command.replace('$', '$$')}" for command in job["commands"])
+        lines.append("")
+    return "\n".join(lines)
+
+
+def reencode_command(
+    input_config: Config,
+    output_config: Config,
+    dimension_names: list,
+    chunks: list,
+    shards: list | None,
+    blocks: tuple[int, int] | None = None,
+) -> str:
+    args = [
+        "ome2024-ngff-challenge",
+        "reencode",
+        *input_config.cli_args(),
+        *output_config.cli_args(),
+        f"--output-chunks={','.join(map(str, chunks))}",
+    ]
+    if shards:
+        args.append(f"--output-shards={','.join(map(str, shards))}")
+    args.append(f"--dimension-names={','.join(map(str, dimension_names))}")
+    if blocks is not None:
+        args.append(f"--blocks={blocks[0]}:{blocks[1]}")
+    args.extend([input_config.fs_string(), output_config.fs_string()])
+    return shlex.join(args)
+
+
+def finalize_command(config: Config) -> str:
+    args = [
+        "ome2024-ngff-challenge",
+        "finalize",
+        *config.cli_args(),
+        config.fs_string(),
+    ]
+    return shlex.join(args)
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+from pathlib import Path
+
+import numpy as np
+
+from .shards import EMPTY, ShardLayout
+from .utils import Config, add_store_arguments, configure_logging
+from .validate import Validator
+
+LOGGER = logging.getLogger(__file__)
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge inspect"
+    desc = f"""
+
+
+The `inspect` subcommand reports how the chunks of a converted fileset (or a
+single v3 array) are stored. Like `validate`, only the shard indexes are read,
+from which the following is derived for every array and resolution level:
+
+    - occupancy: how many of the chunks within the array bounds are stored.
+      Chunks containing only the fill value are not written
+    - the distribution of compressed chunk sizes
+    - the compression ratio of the stored chunks, the bytes spent on shard
+      indexes and the fraction of stored pixels which are padding beyond
+      the edge of the array
+    - a map of the stored ("#"), partially stored ("+") and empty (".")
+      regions in the last two dimensions
+
+
+BASIC
+
+    Inspect a fileset:                       {cmd} out.zarr
+    Inspect a single array:                  {cmd} out.zarr/0
+    Machine-readable output:                 {cmd} --format=json out.zarr > report.json
+    Inspect a fileset on S3:                 {cmd} --input-bucket=bucket --input-endpoint=https://s3.example.com path/out.zarr
+
+    """
+    parser = subparsers.add_parser(
+        "inspect",
+        help="report chunk occupancy and storage use from the shard indexes",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main, output_overwrite=False)
+    add_store_arguments(parser, "input")
+    parser.add_argument(
+        "--format",
+        choices=("text", "json"),
+        default="text",
+        help="print a text report or one JSON document",
+    )
+    parser.add_argument(
+        "--map-width",
+        type=int,
+        default=64,
+        help="maximum width of the occupancy maps (0 to disable)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=16,
+        help="number of groups or arrays listed simultaneously",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=64,
+        help="number of shard index reads in flight",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument("input_path", type=Path)
+
+
+class ArrayUsage:
+    """
+    Stored chunks of one sharded array, accumulated from its shard indexes
+    """
+
+    def __init__(self, path: str, metadata: dict, level: int, layout: ShardLayout):
+        self.path = path
+        self.level = level
+        self.layout = layout
+        self.dtype = np.dtype(metadata["data_type"])
+        self.shards = 0
+        self.shard_bytes = 0
+        self.coords: list[np.ndarray] = []
+        self.nbytes: list[np.ndarray] = []
+
+    @property
+    def chunk_grid(self) -> list[int]:
+        """Number of chunks within the array bounds along each dimension"""
+        return [-(-s // c) for s, c in zip(self.layout.shape, self.layout.chunk_shape)]
+
+    def add(self, key: str, size: int, index: np.ndarray) -> None:
+        position = np.array(self.layout.position(key))
+        per_shard = np.array(self.layout.chunks_per_shard)
+        stored = index[:, 0] != EMPTY
+        local = np.array(np.unravel_index(np.flatnonzero(stored), per_shard)).T
+        self.coords.append(local + position * per_shard)
+        self.nbytes.append(index[stored, 1])
+        self.shards += 1
+        self.shard_bytes += size
+
+    def occupancy(self) -> np.ndarray:
+        """Boolean grid of the stored chunks within the array bounds"""
+        grid = np.zeros(self.chunk_grid, dtype=bool)
+        if self.coords:
+            coords = np.concatenate(self.coords)
+            inside = np.all(coords < np.array(self.chunk_grid), axis=1)
+            grid[tuple(coords[inside].T)] = True
+        return grid
+
+    def summary(self) -> dict:
+        nbytes = np.concatenate(self.nbytes) if self.nbytes else np.zeros(0, "u8")
+        chunk_pixels = math.prod(self.layout.chunk_shape)
+        stored = len(nbytes)
+        compressed = int(nbytes.sum())
+        pixels = 0
+        if stored:
+            coords = np.concatenate(self.coords)
+            starts = coords * np.array(self.layout.chunk_shape)
+            extent = np.minimum(
+                np.array(self.layout.chunk_shape), np.array(self.layout.shape) - starts
+            ).clip(min=0)
+            pixels = int(extent.prod(axis=1).sum())
+        total = math.prod(self.chunk_grid)
+        return {
+            "path": self.path,
+            "level": self.level,
+            "shape": self.layout.shape,
+            "dtype": self.dtype.name,
+            "chunks": self.layout.chunk_shape,
+            "shards": self.layout.shard_shape,
+            "shards_stored": self.shards,
+            "shards_total": math.prod(self.layout.grid),
+            "chunks_stored": stored,
+            "chunks_total": total,
+            "occupancy": stored / total if total else 0.0,
+            "stored_bytes": self.shard_bytes,
+            "index_bytes": self.shards * self.layout.index_size,
+            "compressed_bytes": compressed,
+            "uncompressed_bytes": stored * chunk_pixels * self.dtype.itemsize,
+            "compression_ratio": (
+                stored * chunk_pixels * self.dtype.itemsize / compressed
+                if compressed
+                else None
+            ),
+            "padding": 1 - pixels / (stored * chunk_pixels) if stored else 0.0,
+            "chunk_bytes": percentiles(nbytes),
+        }
+
+
+def percentiles(values: np.ndarray) -> dict:
+    if not len(values):
+        return {}
+    points = np.percentile(values, [0, 50, 90, 100])
+    return dict(zip(["min", "median", "p90", "max"], (int(p) for p in points)))
+
+
+def occupancy_map(grid: np.ndarray, width: int) -> list[str]:
+    """
+    Render the last two dimensions of a boolean chunk grid (any chunk stored
+    along the others) in at most `width` columns.
+    """
+    if grid.ndim == 0 or not grid.size:
+        return []
+    plane = grid.reshape(-1, *grid.shape[-2:]) if grid.ndim > 1 else grid[None, None]
+    fraction = plane.mean(axis=0)
+    rows, cols = fraction.shape
+    step = max(1, -(-cols // width))
+    padded = np.full((-(-rows // step) * step, -(-cols // step) * step), np.nan)
+    padded[:rows, :cols] = fraction
+    blocks = padded.reshape(padded.shape[0] // step, step, -1, step)
+    values = np.nanmean(blocks, axis=(1, 3))
+    return [
+        "".join("." if v == 0 else "#" if v == 1 else "+" for v in row)
+        for row in values
+    ]
+
+
+def human_bytes(nbytes: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(nbytes) < 1024 or unit == "TiB":
+            return f"{nbytes:.0f} {unit}" if unit == "B" else f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return ""
+
+
+def ratio(value: float | None) -> str:
+    return "-" if value is None else f"{value:.2f}x"
+
+
+class Inspector(Validator):
+    """
+    Collects the shard indexes read while validating into an `ArrayUsage`
+    per array. A single array can be inspected in place of a fileset.
+    """
+
+    def __init__(self, config: Config, threads: int, requests: int):
+        super().__init__(config, threads, requests, strict=False)
+        self.usage: dict[str, ArrayUsage] = {}
+
+    def check_metadata(self) -> None:
+        metadata = self.config.zr_read_json("zarr.json")
+        if metadata is not None and metadata.get("node_type") == "array":
+            self.arrays.append(("", metadata, 0))
+        else:
+            super().check_metadata()
+        for path, metadata, level in self.arrays:
+            layout = ShardLayout.from_metadata(metadata)
+            if layout is None:
+                LOGGER.warning(f"{path or self.config}: not sharded, skipping")
+                continue
+            self.usage[path] = ArrayUsage(path, metadata, level, layout)
+
+    def check_shard(
+        self,
+        path: str,
+        key: str,
+        layout: ShardLayout,
+        size: int,
+        data: bytes | Exception,
+    ) -> np.ndarray | None:
+        index = super().check_shard(path, key, layout, size, data)
+        if index is not None and path in self.usage:
+            self.usage[path].add(key, size, index)
+        return index
+
+    def levels(self, arrays: list[dict]) -> list[dict]:
+        levels: dict[int, dict] = {}
+        keys = (
+            "shards_stored",
+            "chunks_stored",
+            "chunks_total",
+            "stored_bytes",
+            "index_bytes",
+            "compressed_bytes",
+            "uncompressed_bytes",
+        )
+        for array in arrays:
+            level = levels.setdefault(
+                array["level"], {"level": array["level"], "arrays": 0}
+            )
+            level["arrays"] += 1
+            for key in keys:
+                level[key] = level.get(key, 0) + array[key]
+        for level in levels.values():
+            total = level["chunks_total"]
+            level["occupancy"] = level["chunks_stored"] / total if total else 0.0
+            compressed = level["compressed_bytes"]
+            level["compression_ratio"] = (
+                level["uncompressed_bytes"] / compressed if compressed else None
+            )
+        return [levels[key] for key in sorted(levels)]
+
+
+def print_text(config: Config, inspector: Inspector, arrays: list, levels: list):
+    lines = []
+    for array in arrays:
+        lines.append(
+            f"{array['path'] or config}  level={array['level']}  "
+            f"shape={array['shape']}  {array['dtype']}  "
+            f"chunks={array['chunks']}  shards={array['shards']}"
+        )
+        lines.append(
+            f"    shards {array['shards_stored']}/{array['shards_total']}  "
+            f"chunks {array['chunks_stored']}/{array['chunks_total']} "
+            f"({array['occupancy']:.1%})  stored {human_bytes(array['stored_bytes'])}  "
+            f"index {human_bytes(array['index_bytes'])}  "
+            f"ratio {ratio(array['compression_ratio'])}  "
+            f"padding {array['padding']:.1%}"
+        )
+        sizes = array["chunk_bytes"]
+        if sizes:
+            lines.append(
+                "    chunk bytes  "
+                + "  ".join(
+                    f"{key} {human_bytes(value)}" for key, value in sizes.items()
+                )
+            )
+        for row in array.get("map", []):
+            lines.append(f"    {row}")
+    lines.append("")
+    lines.append("LEVEL  ARRAYS  CHUNKS              OCCUPANCY  STORED      RATIO")
+    for level in levels:
+        chunks = f"{level['chunks_stored']}/{level['chunks_total']}"
+        lines.append(
+            f"{level['level']:<5d}  {level['arrays']:<6d}  {chunks:<18s}  "
+            f"{level['occupancy']:>9.1%}  {human_bytes(level['stored_bytes']):<10s}  "
+            f"{ratio(level['compression_ratio'])}"
+        )
+    if inspector.report.problems:
+        lines.append("")
+        lines.append(f"{len(inspector.report.problems)} problems found; see `validate`")
+    print("\n".join(lines))  # noqa: T201
+
+
+def main(ns: argparse.Namespace) -> None:
+    configure_logging(ns, LOGGER)
+    config = Config(ns, "input", "r")
+    if not config.zr_exists("zarr.json"):
+        message = f"no Zarr v3 group or array found at {config}"
+        raise SystemExit(message)
+    inspector = Inspector(config, ns.threads, ns.requests)
+    inspector.run()
+
+    arrays = []
+    for _, usage in sorted(inspector.usage.items()):
+        array = usage.summary()
+        if ns.map_width > 0:
+            array["map"] = occupancy_map(usage.occupancy(), ns.map_width)
+        arrays.append(array)
+    levels = inspector.levels(arrays)
+
+    if ns.format == "json":
+        print(json.dumps({"arrays": arrays, "levels": levels}, indent=2))  # noqa: T201
+    else:
+        print_text(config, inspector, arrays, levels)
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import json
+import logging
+import re
+import sqlite3
+import time
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+LOGGER = logging.getLogger(__file__)
+
+DEFAULT_INDEX = Path("~/.cache/ome2024-ngff-challenge/ontologies.sqlite")
+
+# Vocabularies used by `resave --rocrate-modality` and `--rocrate-organism`
+DEFAULT_SOURCES = (
+    "http://purl.obolibrary.org/obo/fbbi.obo",
+    "http://purl.obolibrary.org/obo/ncbitaxon/subsets/taxslim.obo",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    ontology TEXT NOT NULL,
+    term TEXT NOT NULL UNIQUE,
+    label TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    synonyms TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT NOT NULL COLLATE NOCASE,
+    term_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS names_name ON names (name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS trigrams (
+    gram TEXT NOT NULL,
+    term_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trigrams_gram ON trigrams (gram);
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    fetched REAL NOT NULL,
+    body TEXT NOT NULL
+);
+"""
+
+
+def trigrams(text: str) -> set[str]:
+    """
+    Returns the trigrams of the lower-cased words in `text`, padded so that
+    the beginning and end of each word are weighted more strongly.
+    """
+    grams = set()
+    for word in re.findall(r"\w+", text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def parse_obo(lines: Iterable[str]) -> Iterator[dict]:
+    """
+    Yields a record per non-obsolete [Term] stanza of an OBO file with the
+    identifiers converted to the OLS "short form" (e.g. "FBbi_00000243").
+    """
+    term: dict | None = None
+
+    def finish(term):
+        if term and term.get("label") and not term.get("obsolete"):
+            yield term
+
+    for raw in lines:
+        line = raw.strip()
+        if line.startswith("["):
+            yield from finish(term)
+            term = {"synonyms": []} if line == "[Term]" else None
+            continue
+        if term is None or ": " not in line:
+            continue
+        key, value = line.split(": ", 1)
+        if key == "id":
+            prefix = value.split(":", 1)[0]
+            term["ontology"] = prefix.lower()
+            term["term"] = value.replace(":", "_", 1)
+        elif key == "name":
+            term["label"] = value
+        elif key == "def":
+            term["description"] = value.split('"')[1] if '"' in value else value
+        elif key == "synonym" and '"' in value:
+            term["synonyms"].append(value.split('"')[1])
+        elif key == "is_obsolete":
+            term["obsolete"] = value == "true"
+    yield from finish(term)
+
+
+class OntologyIndex:
+    """
+    Local SQLite index of ontology terms for `lookup`, usable without network
+    access once built.
+
+    Each term can be found by a prefix of its label or of any synonym, and
+    by trigram similarity for misspelled or partial words. The same database
+    holds a cache of raw OLS responses, each of which is reused until it is
+    older than the TTL given to `cached_response`.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM terms").fetchone()[0]
+
+    def add(self, records: Iterable[dict]) -> int:
+        """
+        Add or replace the given terms and return how many were added.
+        """
+        count = 0
+        with self.db:
+            for record in records:
+                self.db.execute(
+                    "DELETE FROM names WHERE term_id IN (SELECT id FROM terms WHERE term = ?)",
+                    (record["term"],),
+                )
+                self.db.execute(
+                    "DELETE FROM trigrams WHERE term_id IN (SELECT id FROM terms WHERE term = ?)",
+                    (record["term"],),
+                )
+                self.db.execute("DELETE FROM terms WHERE term = ?", (record["term"],))
+                synonyms = list(record.get("synonyms", []))
+                term_id = self.db.execute(
+                    "INSERT INTO terms (ontology, term, label, description, synonyms) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        record["ontology"],
+                        record["term"],
+                        record["label"],
+                        record.get("description", ""),
+                        json.dumps(synonyms),
+                    ),
+                ).lastrowid
+                names = [record["label"], *synonyms]
+                self.db.executemany(
+                    "INSERT INTO names (name, term_id) VALUES (?, ?)",
+                    [(name, term_id) for name in names],
+                )
+                grams = set().union(*(trigrams(name) for name in names))
+                self.db.executemany(
+                    "INSERT INTO trigrams (gram, term_id) VALUES (?, ?)",
+                    [(gram, term_id) for gram in grams],
+                )
+                count += 1
+        return count
+
+    def search(self, text: str, limit: int = 10) -> list[dict]:
+        """
+        Returns up to `limit` terms matching `text` in the format of the
+        OLS search API documents: exact and prefix matches on labels and
+        synonyms first, followed by the closest trigram matches.
+        """
+        found: dict[int, float] = {}
+        # Prefix match as a range scan on the (case-insensitive) name index
+        rows = self.db.execute(
+            "SELECT term_id, name FROM names WHERE name >= ? AND name < ? LIMIT ?",
+            (text, text + "\U0010ffff", limit * 10),
+        )
+        for term_id, name in rows:
+            score = 3.0 if name.lower() == text.lower() else 2.0
+            found[term_id] = max(found.get(term_id, 0), score)
+
+        grams = trigrams(text)
+        if grams and len(found) < limit:
+            marks = ",".join("?" * len(grams))
+            rows = self.db.execute(
+                f"SELECT term_id, COUNT(*) FROM trigrams WHERE gram IN ({marks}) "
+                "GROUP BY term_id ORDER BY COUNT(*) DESC LIMIT ?",
+                (*grams, limit * 10),
+            )
+            for term_id, count in rows:
+                # Require at least half of the query's trigrams to match
+                similarity = count / len(grams)
+                if similarity >= 0.5:
+                    found.setdefault(term_id, similarity)
+
+        best = sorted(found.items(), key=lambda x: -x[1])[:limit]
+        docs = []
+        for term_id, _ in best:
+            onto, term, label, desc = self.db.execute(
+                "SELECT ontology, term, label, description FROM terms WHERE id = ?",
+                (term_id,),
+            ).fetchone()
+            docs.append(
+                {
+                    "ontology_name": onto,
+                    "short_form": term,
+                    "label": label,
+                    "description": [desc] if desc else [],
+                }
+            )
+        return docs
+
+    def cached_response(self, url: str, ttl: float) -> dict | None:
+        row = self.db.execute(
+            "SELECT fetched, body FROM responses WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None or time.time() - row[0] > ttl:
+            return None
+        return json.loads(row[1])
+
+    def store_response(self, url: str, body: dict) -> None:
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (url, fetched, body) VALUES (?, ?, ?)",
+                (url, time.time(), json.dumps(body)),
+            )
@@ -0,0 +1,324 @@
+from __future__ import annotations
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import requests
+import tensorstore as ts
+import tqdm
+
+from .catalogue import Catalogue
+from .cli_utils import configure_logging
+from .thumbnails import encode_png, plane_selection, render
+
+LOGGER = logging.getLogger(__file__)
+
+# Columns of the index, including the values derived by the dashboard
+COLUMNS = (
+    "url",
+    "type",
+    "image",
+    "name",
+    "description",
+    "license",
+    "organismId",
+    "fbbiId",
+    "written",
+    "images",
+    "arrays",
+    "objects",
+    "bytes",
+    "shape",
+    "chunks",
+    "shards",
+    "dimension_names",
+    "size_t",
+    "size_c",
+    "size_z",
+    "size_y",
+    "size_x",
+    "dim_count",
+    "chunk_pixels",
+    "shard_pixels",
+    "checked",
+    "changed",
+    "thumbnail",
+)
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge publish"
+    desc = f"""
+
+
+The `publish` subcommand prepares the datasets of a `stats --catalogue` for
+a static web dashboard. It writes to the output directory:
+
+    - `index.json`: one compact JSON document with a row per dataset,
+      sorted by `--sort` and including the values which the dashboard would
+      otherwise derive itself (e.g. `size_x`, `chunk_pixels`)
+    - `thumbnails/*.png`: a preview of the first image of each dataset,
+      rendered from its lowest resolution level in a pool of processes
+      unless one was written by `resave --output-thumbnails`
+
+Thumbnails which are newer than the last change of their dataset are kept.
+
+
+BASIC
+
+    Simplest example:                        {cmd} --catalogue=catalogue.sqlite site/
+    Smallest datasets first:                 {cmd} --catalogue=catalogue.sqlite --sort=written site/
+    Only the index:                          {cmd} --catalogue=catalogue.sqlite --thumbnails-skip site/
+
+    """
+    parser = subparsers.add_parser(
+        "publish",
+        help="build a JSON index and thumbnails of a catalogue for the dashboard",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main)
+    parser.add_argument(
+        "--catalogue",
+        type=Path,
+        required=True,
+        help="SQLite database written by `stats --catalogue`",
+    )
+    parser.add_argument(
+        "--sort",
+        default="-written",
+        help="column by which the index is sorted, descending with a '-' prefix",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=256,
+        help="approximate length in pixels of the longer side of thumbnails",
+    )
+    parser.add_argument(
+        "--max-pixels",
+        type=int,
+        default=4096 * 4096,
+        help="skip thumbnails whose lowest resolution level has more pixels per plane",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=min(8, os.cpu_count() or 1),
+        help="number of thumbnails rendered simultaneously",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="seconds to wait for the metadata of an image",
+    )
+    parser.add_argument(
+        "--thumbnails-skip",
+        action="store_true",
+        help="only write the index",
+    )
+    parser.add_argument(
+        "--thumbnails-overwrite",
+        action="store_true",
+        help="render all thumbnails again",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument(
+        "output", type=Path, help="directory for the index and thumbnails"
+    )
+
+
+def isoformat(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat(
+        timespec="seconds"
+    )
+
+
+def thumbnail_name(url: str) -> str:
+    digest = hashlib.sha1(url.encode(), usedforsecurity=False).hexdigest()
+    return f"thumbnails/{digest[:16]}.png"
+
+
+def record(url: str, checked: float, changed: float, stats: dict) -> dict:
+    """
+    The row of the index for a dataset of the catalogue
+    """
+    row = {key: stats.get(key) for key in COLUMNS}
+    row["url"] = url
+    if row["written"] is not None:
+        row["written"] = round(row["written"])
+    shape = stats.get("shape") or []
+    names = stats.get("dimension_names") or []
+    if not names and len(shape) == 5:
+        names = ["t", "c", "z", "y", "x"]
+    if len(names) == len(shape):
+        for name, size in zip(names, shape):
+            if f"size_{name}" in row:
+                row[f"size_{name}"] = size
+    if shape:
+        row["dim_count"] = sum(size > 1 for size in shape)
+    if stats.get("chunks"):
+        row["chunk_pixels"] = math.prod(stats["chunks"])
+    if stats.get("shards"):
+        row["shard_pixels"] = math.prod(stats["shards"])
+    row["checked"] = isoformat(checked)
+    row["changed"] = isoformat(changed)
+    return row
+
+
+def sort_records(records: list[dict], sort: str) -> list[dict]:
+    """
+    Sort by the column `sort` (descending with a "-" prefix), with the
+    rows lacking a value last.
+    """
+    column = sort.lstrip("-")
+    present = [r for r in records if r.get(column) is not None]
+    missing = [r for r in records if r.get(column) is None]
+    present.sort(key=lambda r: r[column], reverse=sort.startswith("-"))
+    return present + missing
+
+
+def converted_thumbnail(image_url: str, size: int, timeout: float) -> bytes | None:
+    """
+    Returns the thumbnail written by `resave --output-thumbnails` next to the
+    image at `image_url` if its longer side is about `size` pixels.
+    """
+    response = requests.get(f"{image_url}/thumbnails/thumbnail.png", timeout=timeout)
+    data = response.content
+    if not response.ok or data[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    width, height = struct.unpack(">II", data[16:24])
+    return data if size // 2 < max(width, height) <= size else None
+
+
+def make_thumbnail(
+    image_url: str, output: str, size: int, max_pixels: int, timeout: float
+) -> str | None:
+    """
+    Render the lowest resolution level of the image at `image_url` to the
+    PNG file `output`, unless a thumbnail was written during the conversion.
+    Runs in a worker process and returns an error message rather than raising.
+    """
+    try:
+        partial = Path(f"{output}.partial")
+        data = converted_thumbnail(image_url, size, timeout)
+        if data is not None:
+            partial.write_bytes(data)
+            partial.replace(output)
+            return None
+        response = requests.get(f"{image_url}/zarr.json", timeout=timeout)
+        response.raise_for_status()
+        ome = response.json()["attributes"]["ome"]
+        multiscale = ome["multiscales"][0]
+        axes = [axis["name"] for axis in multiscale["axes"]]
+        lowest = multiscale["datasets"][-1]["path"]
+        array = ts.open(
+            {
+                "driver": "zarr3",
+                "kvstore": {"driver": "http", "base_url": f"{image_url}/{lowest}/"},
+            }
+        ).result()
+        if math.prod(array.shape[-2:]) > max_pixels:
+            return f"{image_url}: lowest resolution level {array.shape} is too large"
+        selection, kept = plane_selection(list(array.shape), axes, size)
+        data = array[selection].read().result()
+        partial.write_bytes(encode_png(render(data, kept, ome.get("omero"))))
+        partial.replace(output)
+    except Exception as e:
+        return f"{image_url}: {e}"
+    return None
+
+
+def make_thumbnails(records: list[dict], ns: argparse.Namespace) -> int:
+    """
+    Render the missing or outdated thumbnails of `records` and set their
+    "thumbnail" path if one exists. Returns the number of failures.
+    """
+    (ns.output / "thumbnails").mkdir(parents=True, exist_ok=True)
+    jobs = {}
+    for row in records:
+        if row["image"] is None:
+            continue
+        name = thumbnail_name(row["url"])
+        path = ns.output / name
+        changed = datetime.datetime.fromisoformat(row["changed"]).timestamp()
+        if (
+            not path.exists()
+            or ns.thumbnails_overwrite
+            or path.stat().st_mtime < changed
+        ):
+            image_url = "/".join(x for x in (row["url"], row["image"]) if x)
+            jobs[name] = (image_url, str(path))
+        row["thumbnail"] = name
+
+    failed = set()
+    if jobs:
+        # tensorstore's threads do not survive a fork
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max(1, ns.processes), mp_context=context) as pool:
+            futures = {
+                pool.submit(
+                    make_thumbnail, url, path, ns.size, ns.max_pixels, ns.timeout
+                ): name
+                for name, (url, path) in jobs.items()
+            }
+            for future in tqdm.tqdm(
+                as_completed(futures), total=len(futures), unit="image", ncols=80
+            ):
+                error = future.result()
+                if error is not None:
+                    LOGGER.warning(error)
+                    failed.add(futures[future])
+
+    for row in records:
+        if (
+            row["thumbnail"] in failed
+            or not (ns.output / str(row["thumbnail"])).exists()
+        ):
+            row["thumbnail"] = None
+    return len(failed)
+
+
+def main(ns: argparse.Namespace) -> None:
+    configure_logging(ns, LOGGER)
+    if ns.sort.lstrip("-") not in COLUMNS:
+        message = f"--sort must be one of {', '.join(COLUMNS)}"
+        raise SystemExit(message)
+    if not ns.catalogue.exists():
+        message = f"no catalogue found at {ns.catalogue}"
+        raise SystemExit(message)
+    catalogue = Catalogue(ns.catalogue)
+    try:
+        records = [record(*item) for item in catalogue.items()]
+    finally:
+        catalogue.close()
+
+    ns.output.mkdir(parents=True, exist_ok=True)
+    failed = 0
+    if not ns.thumbnails_skip:
+        failed = make_thumbnails(records, ns)
+
+    index = {
+        "generated": isoformat(datetime.datetime.now().timestamp()),
+        "sort": ns.sort,
+        "columns": list(COLUMNS),
+        "rows": [[row[c] for c in COLUMNS] for row in sort_records(records, ns.sort)],
+    }
+    partial = ns.output / "index.json.partial"
+    partial.write_text(json.dumps(index, separators=(",", ":")))
+    partial.replace(ns.output / "index.json")
+    LOGGER.info(
+        f"published {len(records)} datasets to {ns.output} ({failed} thumbnails failed)"
+    )
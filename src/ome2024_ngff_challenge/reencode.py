@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import argparse
+import logging
+from pathlib import Path
+
+from .resave import convert_array
+from .utils import (
+    Config,
+    RetryBudget,
+    add_store_arguments,
+    configure_logging,
+    csv_int,
+)
+
+LOGGER = logging.getLogger(__file__)
+
+
+def block_range(vstr: str) -> tuple[int, int]:
+    """Convert a string of the form START:STOP to a tuple of integers"""
+    try:
+        start, stop = (int(x) for x in vstr.split(":"))
+    except ValueError as ve:
+        raise argparse.ArgumentTypeError(
+            f"Invalid block range {vstr}, must be START:STOP"
+        ) from ve
+    if not 0 <= start < stop:
+        raise argparse.ArgumentTypeError(f"Invalid block range {vstr}")
+    return start, stop
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge reencode"
+    desc = f"""
+
+
+The `reencode` subcommand converts a single Zarr v2 array into a Zarr v3 array
+with the same codecs as `resave`. It is primarily used by the jobs written to
+`jobs.jsonl` by `resave --output-script` in order to split very large arrays
+into several jobs of whole shards.
+
+
+BASIC
+
+    Convert a whole array:                   {cmd} --output-chunks=1,256,256 --output-shards=1,2048,2048 --dimension-names=z,y,x in.zarr/0 out.zarr/0
+    Convert the first 10 shards:             {cmd} --output-chunks=1,256,256 --output-shards=1,2048,2048 --dimension-names=z,y,x --blocks=0:10 in.zarr/0 out.zarr/0
+
+    """
+    parser = subparsers.add_parser(
+        "reencode",
+        help="convert a single Zarr v2 array to Zarr v3",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main, output_overwrite=False)
+    add_store_arguments(parser, "input")
+    add_store_arguments(parser, "output")
+    parser.add_argument(
+        "--output-chunks",
+        required=True,
+        type=csv_int,
+        help="comma separated list of chunk sizes",
+    )
+    parser.add_argument(
+        "--output-shards",
+        type=csv_int,
+        help="comma separated list of shard sizes",
+    )
+    parser.add_argument(
+        "--dimension-names",
+        required=True,
+        type=lambda x: x.split(","),
+        help="comma separated list of dimension names",
+    )
+    parser.add_argument(
+        "--blocks",
+        type=block_range,
+        help="only convert the shards (or chunks) with linear index in START:STOP",
+    )
+    parser.add_argument(
+        "--output-threads",
+        type=int,
+        default=16,
+        help="number of simultaneous write threads",
+    )
+    parser.add_argument(
+        "--output-retries",
+        type=int,
+        default=10,
+        help="total number of times failed shards may be retried",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument("input_path", type=Path)
+    parser.add_argument("output_path", type=Path)
+
+
+def parse(ns: argparse.Namespace):
+    """
+    Parse the namespace arguments provided by the dispatcher
+    """
+    configure_logging(ns, LOGGER)
+
+
+def main(ns: argparse.Namespace) -> None:
+    parse(ns)
+    convert_array(
+        Config(ns, "input", "r"),
+        Config(ns, "output", "w"),
+        ns.dimension_names,
+        ns.output_chunks,
+        ns.output_shards,
+        ns.output_threads,
+        ns.blocks,
+        RetryBudget(ns.output_retries),
+    )
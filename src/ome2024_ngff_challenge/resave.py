@@ -2,6 +2,8 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import itertools
 import json
 import logging
 import math
@@ -10,21 +12,35 @@ import os
 import random
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numcodecs
+import numpy as np
 import tensorstore as ts
 import tqdm
 
+from .cache import MetadataCache
+from .channels import ChannelStatistics, update_omero
+from .details import DetailsReader, DetailsWriter
+from .manifest import JobManifest
+from .shards import ShardLayout, ShardStream, list_objects
+from .thumbnails import PreviewAccumulator, encode_png
 from .utils import (
+    BackgroundDelete,
     Batched,
     Config,
+    RetryBudget,
     SafeEncoder,
+    StoreSettings,
     TSMetrics,
     add_creator,
+    add_store_arguments,
     chunk_iter,
     configure_logging,
     csv_int,
     guess_shards,
+    is_transient,
     strip_version,
 )
 from .zarr_crate.rembi_extension import Biosample, ImageAcquistion, Specimen
@@ -33,6 +49,286 @@ from .zarr_crate.zarr_extension import ZarrCrate
 NGFF_VERSION = "0.5"
 LOGGER = logging.getLogger(__file__)
 
+# Attribute holding the statistics of `convert_array` on each array and the
+# roll-up totals (see `sum_totals`) on every group above it
+STATS_KEY = "_ome2024_ngff_challenge_stats"
+# Directory next to the chunks of an array where jobs converting a range of
+# its blocks store their statistics until `finalize` merges them
+BLOCK_STATS = "_block_stats"
+TOTALS = ("images", "arrays", "objects", "bytes", "written", "elapsed")
+
+
+def array_totals(stats: dict) -> dict:
+    """
+    The roll-up totals of a single array from its `convert_array` stats
+    """
+    return {
+        "images": 0,
+        "arrays": 1,
+        "objects": stats.get("objects", 0),
+        "bytes": stats.get("stored", 0),
+        "written": stats.get("written", 0),
+        "elapsed": stats["elapsed"],
+    }
+
+
+def sum_totals(totals: list[dict], images: int = 0) -> dict:
+    """
+    Add up the totals of the arrays and groups below a group: the number of
+    images, of arrays, of chunk or shard objects and of their bytes, and the
+    bytes written as counted by tensorstore.
+    """
+    summed = {key: sum(t[key] for t in totals) for key in TOTALS}
+    summed["images"] += images
+    return summed
+
+
+def write_totals(config: Config, totals: dict, start: float) -> dict:
+    """
+    Store `totals` in the attributes of the group at `config`, with the
+    time since `start` as elapsed time, unless no array was converted
+    (e.g. a dry-run or `--output-script`).
+    """
+    totals = {**totals, "elapsed": time.time() - start}
+    if config.zr_group is not None and totals["arrays"]:
+        config.zr_attrs[STATS_KEY] = totals
+    return totals
+
+
+def occupied_blocks(
+    input_config: Config, shape: list, block: list
+) -> set[tuple[int, ...]] | None:
+    """
+    Returns the grid indices of the output blocks (shards, or chunks if no
+    shards are used) which overlap at least one chunk stored in the v2 input
+    array, or None if the input cannot be listed (e.g. it is not a Zarr
+    array). All other blocks only contain the fill value.
+    """
+    if not isinstance(input_config, Config):
+        return None
+    metadata = input_config.zr_read_json(".zarray")
+    if metadata is None:
+        return None
+    chunks = metadata["chunks"]
+    separator = metadata.get("dimension_separator", ".")
+
+    occupied: set[tuple[int, ...]] = set()
+    for key in list_objects(input_config):
+        if key.startswith(".") or "/." in key:
+            continue  # .zarray, .zattrs, ...
+        try:
+            index = [int(x) for x in key.split(separator)]
+        except ValueError:
+            continue
+        if len(index) != len(shape):
+            continue
+        starts = [i * c for i, c in zip(index, chunks)]
+        if any(start >= size for start, size in zip(starts, shape)):
+            continue
+        ranges = [
+            range(start // b, (min(size, start + c) - 1) // b + 1)
+            for start, c, b, size in zip(starts, chunks, block, shape)
+        ]
+        occupied.update(itertools.product(*ranges))
+    return occupied
+
+
+def fill_value(read) -> bool | int | float | str:
+    """
+    The v3 "fill_value" matching the fill value of the input `read`: 0 (or
+    false) if it has none, e.g. null in v2, and "NaN", "Infinity" or
+    "-Infinity" for floats which JSON cannot represent.
+    """
+    if read.fill_value is None:
+        return False if read.dtype.numpy_dtype.kind == "b" else 0
+    value = read.fill_value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        if math.isnan(value):
+            return "NaN"
+        return "Infinity" if value > 0 else "-Infinity"
+    return value
+
+
+# Shards larger than this (uncompressed) are streamed rather than assembled
+# in memory by tensorstore
+STREAM_BYTES = 256 * 1024**2
+
+# numcodecs Blosc shuffle constants to v3 blosc codec names
+BLOSC_SHUFFLE = {0: "noshuffle", 1: "shuffle", 2: "bitshuffle"}
+
+
+def passthrough_codecs(input_config: Config, chunks: list) -> list[dict] | None:
+    """
+    Returns v3 chunk codecs under which the compressed chunks of the v2
+    input array can be stored as they are, or None if they must be
+    re-encoded. This requires the output chunks to equal the input chunks
+    and the input to be C-ordered, blosc-compressed and without filters.
+    """
+    if not isinstance(input_config, Config):
+        return None
+    metadata = input_config.zr_read_json(".zarray")
+    if metadata is None or list(metadata["chunks"]) != list(chunks):
+        return None
+    compressor = metadata.get("compressor") or {}
+    if compressor.get("id") != "blosc" or metadata.get("filters"):
+        return None
+    if metadata.get("order", "C") != "C":
+        return None
+    dtype = np.dtype(metadata["dtype"])
+    if dtype.kind not in "biuf":
+        return None
+    shuffle = compressor.get("shuffle", 1)
+    if shuffle == -1:  # AUTOSHUFFLE
+        shuffle = 2 if dtype.itemsize == 1 else 1
+    return [
+        {
+            "name": "bytes",
+            "configuration": {"endian": "big" if dtype.byteorder == ">" else "little"},
+        },
+        {
+            "name": "blosc",
+            "configuration": {
+                "cname": compressor.get("cname", "lz4"),
+                "clevel": compressor.get("clevel", 5),
+                "shuffle": BLOSC_SHUFFLE[shuffle],
+                "typesize": dtype.itemsize,
+                "blocksize": compressor.get("blocksize", 0),
+            },
+        },
+    ]
+
+
+class ShardCopier:
+    """
+    Writes whole shards from the compressed chunks of a v2 array without
+    decoding them (see `passthrough_codecs`): the inner chunks of each shard
+    are read concurrently through tensorstore's kvstore, concatenated and
+    followed by the shard index.
+    """
+
+    def __init__(self, input_config: Config, write, layout: ShardLayout):
+        metadata = input_config.zr_read_json(".zarray")
+        self.separator = metadata.get("dimension_separator", ".")
+        store = dict(input_config.ts_store)
+        store["path"] = store["path"].rstrip("/") + "/"
+        self.input = ts.KvStore.open(store, context=input_config.context).result()
+        self.output = write.kvstore
+        self.layout = layout
+
+    def chunk_key(self, index: tuple[int, ...]) -> str:
+        return self.separator.join(map(str, index)) or "0"
+
+    def read_chunk(self, index: tuple[int, ...]) -> bytes | None:
+        """The compressed input chunk at `index`, or None if not stored"""
+        result = self.input.read(self.chunk_key(index)).result()
+        return bytes(result.value) if result.state == "value" else None
+
+    def copy(self, blocks: list[tuple[slice, ...]]) -> None:
+        shard_shape = self.layout.shard_shape
+        reads = []
+        for block in blocks:
+            position = tuple(s.start // n for s, n in zip(block, shard_shape))
+            futures = [
+                None if index is None else self.input.read(self.chunk_key(index))
+                for index in self.layout.chunk_indices(position)
+            ]
+            reads.append((position, futures))
+
+        writes = []
+        for position, futures in reads:
+            chunks = []
+            for future in futures:
+                result = None if future is None else future.result()
+                stored = result is not None and result.state == "value"
+                chunks.append(bytes(result.value) if stored else None)
+            if any(chunk is not None for chunk in chunks):
+                shard = self.layout.encode(chunks)
+                writes.append(self.output.write(self.layout.key(position), shard))
+        for future in writes:
+            future.result()
+
+
+class ChunkEncoder:
+    """
+    Reads single inner chunks of `read` and encodes them with the codecs
+    which tensorstore resolved for the sharded array `write`, i.e. as they
+    would be stored by tensorstore itself. Chunks equal to the fill value
+    are not stored.
+    """
+
+    def __init__(self, read, write, chunks: list):
+        metadata = json.loads(write.kvstore["zarr.json"])
+        codecs = metadata["codecs"][0]["configuration"]["codecs"]
+        blosc = next(c["configuration"] for c in codecs if c["name"] == "blosc")
+        shuffle = {name: value for value, name in BLOSC_SHUFFLE.items()}
+        self.compressor = numcodecs.Blosc(
+            cname=blosc["cname"],
+            clevel=blosc["clevel"],
+            shuffle=shuffle[blosc["shuffle"]],
+            blocksize=blosc.get("blocksize", 0),
+        )
+        self.read = read
+        self.chunks = list(chunks)
+        self.dtype = np.dtype(read.dtype.numpy_dtype).newbyteorder("<")
+        fill_value = metadata.get("fill_value", 0)
+        if isinstance(fill_value, str):
+            fill_value = float(fill_value)  # "NaN", "Infinity", ...
+        self.fill = np.array(fill_value).astype(self.dtype)
+
+    def read_chunk(self, index: tuple[int, ...]) -> bytes | None:
+        region = tuple(
+            slice(i * c, min(s, (i + 1) * c))
+            for i, c, s in zip(index, self.chunks, self.read.shape)
+        )
+        data = self.read[region].read().result()
+        if np.array_equal(
+            data,
+            np.broadcast_to(self.fill, data.shape),
+            equal_nan=self.fill.dtype.kind == "f",
+        ):
+            return None
+        chunk = np.full(self.chunks, self.fill, dtype=self.dtype)
+        chunk[tuple(slice(0, n) for n in data.shape)] = data
+        return self.compressor.encode(chunk)
+
+
+def stream_shard(
+    output_config: Config,
+    layout: ShardLayout,
+    position: tuple[int, ...],
+    read_chunk,
+    window: int,
+) -> None:
+    """
+    Write the shard at `position` with a `ShardStream`, obtaining each
+    encoded inner chunk from `read_chunk(index)`. At most `window` chunks
+    are read or held at once.
+    """
+    stream = ShardStream(output_config, layout.key(position), layout)
+    try:
+        with ThreadPoolExecutor(max_workers=window) as pool:
+            pending: collections.deque = collections.deque()
+            for i, index in enumerate(layout.chunk_indices(position)):
+                if index is not None:
+                    pending.append((i, pool.submit(read_chunk, index)))
+                while len(pending) > window or (pending and pending[0][1].done()):
+                    j, future = pending.popleft()
+                    data = future.result()
+                    if data is not None:
+                        stream.add(j, data)
+            while pending:
+                j, future = pending.popleft()
+                data = future.result()
+                if data is not None:
+                    stream.add(j, data)
+    except BaseException:
+        stream.abort()
+        raise
+    if stream.chunks:
+        stream.close()
+    else:
+        stream.abort()
+
 
 def convert_array(
     input_config: Config,
@@ -41,9 +337,60 @@ def convert_array(
     chunks: list,
     shards: list,
     threads: int,
-):
+    block_range: tuple[int, int] | None = None,
+    retry: RetryBudget | None = None,
+    stream_bytes: int = STREAM_BYTES,
+    observers: list | None = None,
+) -> dict:
+    """
+    Re-encode the v2 array at `input_config` as a v3 array at `output_config`
+    and return the statistics stored in its `zarr.json`.
+
+    If `block_range` is given, only the blocks (shards, or chunks if no shards
+    are used) with linear indices in [start, stop) are written so that large
+    arrays can be converted by several independent jobs. The array is then
+    opened rather than created if it already exists, and the statistics are
+    stored as `BLOCK_STATS/START-STOP.json` next to its chunks for
+    `finalize` to merge.
+
+    Blocks which do not overlap any chunk stored in the input are neither
+    read nor written (see `occupied_blocks`), and chunks equal to the fill
+    value are omitted from the shards written, so sparse inputs such as
+    labels or mosaics with empty regions stay sparse.
+
+    If the output chunks equal the input chunks and the input is compressed
+    with blosc, the compressed chunks are copied into the shards as they are
+    (see `ShardCopier`) and the output uses the input's blosc settings.
+
+    Shards of more than `stream_bytes` uncompressed bytes (e.g. the default
+    full-array shards of large images) are not assembled in memory but
+    streamed one inner chunk at a time (see `stream_shard`), to multipart
+    uploads on S3.
+
+    If a batch of blocks fails, each of its blocks is rewritten on its own,
+    using `retry` to back off between failures. Since every block is written
+    completely, rewriting a block which already succeeded is harmless.
+
+    If `observers` are given, each block is read into memory and passed to
+    `observer.add(selection, data)` before being written (e.g. to collect
+    previews, see `PreviewAccumulator`). Compressed chunks are then not
+    copied and shards are not streamed. Retried blocks are passed again.
+    """
+    if retry is None:
+        retry = RetryBudget(0)
+    retries_before = retry.retries
+    failed_batches = 0
+
     read = input_config.ts_read()
 
+    passthrough = None
+    if shards and not observers:
+        passthrough = passthrough_codecs(input_config, chunks)
+    inner_codecs = passthrough or [
+        {"name": "bytes", "configuration": {"endian": "little"}},
+        {"name": "blosc", "configuration": {"cname": "zstd", "clevel": 5}},
+    ]
+
     if shards:
         chunk_grid = {
             "name": "regular",
@@ -54,10 +401,7 @@ def convert_array(
             "name": "sharding_indexed",
             "configuration": {
                 "chunk_shape": chunks,  # read size
-                "codecs": [
-                    {"name": "bytes", "configuration": {"endian": "little"}},
-                    {"name": "blosc", "configuration": {"cname": "zstd", "clevel": 5}},
-                ],
+                "codecs": inner_codecs,
                 "index_codecs": [
                     {"name": "bytes", "configuration": {"endian": "little"}},
                     {"name": "crc32c"},
@@ -83,12 +427,19 @@ def convert_array(
         },  # "configuration": {"separator": "/"}},
         "codecs": codecs,
         "data_type": read.dtype,
+        # Unstored input chunks are skipped or left out of the shards
+        "fill_value": fill_value(read),
         "dimension_names": dimension_names,
     }
 
     write_config = base_config.copy()
     write_config["create"] = True
-    write_config["delete_existing"] = output_config.overwrite
+    write_config["store_data_equal_to_fill_value"] = False
+    if block_range is None:
+        write_config["delete_existing"] = output_config.overwrite
+    else:
+        # Other jobs may be writing the same array concurrently
+        write_config["open"] = True
 
     LOGGER.log(
         5,
@@ -105,22 +456,98 @@ def convert_array(
 
     verify_config = base_config.copy()
 
-    write = ts.open(write_config).result()
+    write = ts.open(write_config, context=output_config.context).result()
 
     before = TSMetrics(input_config.ts_config, write_config)
 
     # read & write a chunk (or shard) at a time:
-    blocks = shards if shards is not None else chunks
-    for idx, batch in enumerate(Batched(chunk_iter(read.shape, blocks), threads)):
+    block = shards if shards else chunks
+    blocks = chunk_iter(read.shape, block)
+    if block_range is not None:
+        blocks = blocks[slice(*block_range)]
+    skipped_blocks = 0
+    occupied = occupied_blocks(input_config, read.shape, block)
+    if occupied is not None:
+        scheduled = [
+            b
+            for b in blocks
+            if tuple(s.start // n for s, n in zip(b, block)) in occupied
+        ]
+        skipped_blocks = len(blocks) - len(scheduled)
+        blocks = scheduled
+        LOGGER.debug(f"{input_config}: skipping {skipped_blocks} empty blocks")
+
+    copier = None
+    layout = None
+    if shards:
+        layout = ShardLayout(list(read.shape), list(shards), list(chunks))
+    if passthrough:
+        copier = ShardCopier(input_config, write, layout)
+        LOGGER.info(f"{input_config}: copying compressed chunks without re-encoding")
+
+    read_chunk = None
+    shard_bytes = math.prod(shards or []) * read.dtype.numpy_dtype.itemsize
+    if shards and not observers and shard_bytes > stream_bytes:
+        if copier is not None:
+            read_chunk = copier.read_chunk
+        else:
+            read_chunk = ChunkEncoder(read, write, chunks).read_chunk
+        LOGGER.info(f"{output_config}: streaming shards of {shards}")
+
+    def write_block(s):
+        if read_chunk is not None:
+            position = tuple(x.start // n for x, n in zip(s, shards))
+            stream_shard(output_config, layout, position, read_chunk, threads)
+        elif copier is not None:
+            copier.copy([s])
+        elif observers:
+            data = read[s].read().result()
+            for observer in observers:
+                observer.add(s, data)
+            write[s].write(data).result()
+        else:
+            write[s].write(read[s]).result()
+
+    for idx, batch in enumerate(Batched(blocks, threads)):
         start = time.time()
-        with ts.Transaction() as txn:
-            LOGGER.log(5, f"batch {idx:03d}: scheduling transaction size={len(batch)}")
+        try:
+            if read_chunk is not None:
+                for slice_tuple in batch:
+                    write_block(slice_tuple)
+            elif copier is not None:
+                copier.copy(batch)
+            else:
+                with ts.Transaction() as txn:
+                    LOGGER.log(
+                        5, f"batch {idx:03d}: scheduling transaction size={len(batch)}"
+                    )
+                    reads = [read[s].read() for s in batch] if observers else None
+                    for i, slice_tuple in enumerate(batch):
+                        if reads is None:
+                            data = read[slice_tuple]
+                        else:
+                            data = reads[i].result()
+                            for observer in observers:
+                                observer.add(slice_tuple, data)
+                        write.with_transaction(txn)[slice_tuple] = data
+                        LOGGER.log(
+                            5,
+                            f"batch {idx:03d}: {slice_tuple} scheduled in transaction",
+                        )
+                    LOGGER.log(
+                        5, f"batch {idx:03d}: waiting on transaction size={len(batch)}"
+                    )
+        except Exception as e:
+            if retry.remaining() <= 0 or not is_transient(e):
+                raise
+            failed_batches += 1
+            LOGGER.warning(f"batch {idx:03d}: failed ({e}); rewriting blocks singly")
             for slice_tuple in batch:
-                write.with_transaction(txn)[slice_tuple] = read[slice_tuple]
-                LOGGER.log(
-                    5, f"batch {idx:03d}: {slice_tuple} scheduled in transaction"
+                retry.call(
+                    lambda s=slice_tuple: write_block(s),
+                    f"{output_config} {slice_tuple}",
+                    error=e,
                 )
-            LOGGER.log(5, f"batch {idx:03d}: waiting on transaction size={len(batch)}")
         stop = time.time()
         elapsed = stop - start
         avg = float(elapsed) / len(batch)
@@ -140,9 +567,22 @@ def convert_array(
         "elapsed": after.elapsed(),
         "threads": threads,
         "cpu_count": multiprocessing.cpu_count(),
+        "retries": retry.retries - retries_before,
+        "failed_batches": failed_batches,
+        "skipped_blocks": skipped_blocks,
+        "passthrough": copier is not None,
+        "streamed": read_chunk is not None,
     }
     if hasattr(os, "sched_getaffinity"):
         stats["sched_affinity"] = len(os.sched_getaffinity(0))
+    if block_range is not None:
+        stats["blocks"] = list(block_range)
+    else:
+        # Exact storage use, including shards streamed outside of tensorstore
+        objects = list_objects(output_config)
+        objects.pop("zarr.json", None)
+        stats["objects"] = len(objects)
+        stats["stored"] = sum(objects.values())
 
     LOGGER.info(f"""Re-encode (tensorstore) {input_config} to {output_config}
         read: {stats["read"]}
@@ -150,17 +590,23 @@ def convert_array(
         time: {stats["elapsed"]}
     """)
 
-    ## TODO: there is likely an easier way of doing this
-    metadata = write.kvstore["zarr.json"]
-    metadata = json.loads(metadata)
-    if "attributes" in metadata:
-        attributes = metadata["attributes"]
+    if block_range is None:
+        ## TODO: there is likely an easier way of doing this
+        metadata = write.kvstore["zarr.json"]
+        metadata = json.loads(metadata)
+        if "attributes" in metadata:
+            attributes = metadata["attributes"]
+        else:
+            attributes = {}
+            metadata["attributes"] = attributes
+        attributes[STATS_KEY] = stats
+        metadata = json.dumps(metadata)
+        write.kvstore["zarr.json"] = metadata
     else:
-        attributes = {}
-        metadata["attributes"] = attributes
-    attributes["_ome2024_ngff_challenge_stats"] = stats
-    metadata = json.dumps(metadata)
-    write.kvstore["zarr.json"] = metadata
+        # Concurrent jobs would overwrite each other's stats
+        LOGGER.info(f"stats for blocks {block_range}: {json.dumps(stats)}")
+        key = f"{BLOCK_STATS}/{block_range[0]}-{block_range[1]}.json"
+        write.kvstore[key] = json.dumps(stats)
 
     ## TODO: This is not working with v3 branch nor with released version
     ## zr_array = zarr.open_array(store=output_config.zr_store, mode="a", zarr_format=3)
@@ -168,15 +614,53 @@ def convert_array(
     ##     "_ome2024_ngff_challenge_stats": stats,
     ## })
 
-    verify = ts.open(verify_config).result()
+    verify = ts.open(verify_config, context=output_config.context).result()
     LOGGER.info(f"Verifying <{output_config}>\t{read.shape}\t")
-    for x in range(10):
-        r = tuple([random.randint(0, y - 1) for y in read.shape])
+    for x in range(10 if blocks else 0):
+        # Only check points within the blocks written by this call
+        block = random.choice(blocks)
+        r = tuple([random.randint(b.start, b.stop - 1) for b in block])
         before = read[r].read().result()
         after = verify[r].read().result()
-        assert before == after
+        assert np.array_equal(before, after, equal_nan=before.dtype.kind == "f")
         LOGGER.debug(f"{x}")
     LOGGER.info("ok")
+    return stats
+
+
+class Previews:
+    """
+    Settings of the thumbnail (and optional maximum intensity projections)
+    which `convert_image` renders from the lowest resolution level of each
+    image while converting it, and the paths of the PNG files written,
+    relative to the root of the output.
+    """
+
+    DIRECTORY = "thumbnails"
+
+    def __init__(
+        self, size: int = 256, projections: bool = False, max_pixels: int = 4096**2
+    ):
+        self.size = size
+        self.projections = projections
+        self.max_pixels = max_pixels
+        self.paths: list[str] = []
+
+    def accumulator(
+        self, shape: list[int], axes: list[str]
+    ) -> PreviewAccumulator | None:
+        if math.prod(shape[-2:]) > self.max_pixels:
+            LOGGER.info(f"no thumbnail: lowest resolution level {shape} is too large")
+            return None
+        return PreviewAccumulator(shape, axes, self.size, self.projections)
+
+    def write(
+        self, config: Config, accumulator: PreviewAccumulator, omero: dict | None
+    ) -> None:
+        for name, rgb in accumulator.images(omero).items():
+            path = Path(self.DIRECTORY) / f"{name}.png"
+            config.zr_write_bytes(path, encode_png(rgb))
+            self.paths.append(str(config.subpath / path if config.subpath else path))
 
 
 def convert_image(
@@ -184,12 +668,31 @@ def convert_image(
     output_config: Config,
     output_chunks: list[int] | None,
     output_shards: list[int] | None,
-    output_read_details: str | None,
-    output_write_details: bool,
-    output_script: bool,
+    output_read_details: DetailsReader | None,
+    output_write_details: DetailsWriter | None,
+    output_script: JobManifest | None,
     threads: int,
     notes: str | None,
-):
+    retry: RetryBudget | None = None,
+    previews: Previews | None = None,
+    channel_stats: bool = False,
+) -> dict:
+    """
+    Convert the image at `input_config` and its labels, returning their
+    roll-up totals, which are also stored on the image and labels groups.
+
+    If `previews` is given, the thumbnails of the image (but not of its
+    labels) are collected from the blocks of its lowest resolution level as
+    they are converted and written next to it.
+
+    If `channel_stats` is set, the range and percentiles of each channel are
+    collected from the same blocks (see `ChannelStatistics`) and written to
+    the "omero" windows of the image (see `update_omero`).
+    """
+    start = time.time()
+    totals = []
+    accumulator = None
+    statistics = None
     dimension_names = None
     # top-level version...
     ome_attrs = {"version": NGFF_VERSION}
@@ -208,46 +711,29 @@ def convert_image(
         # dev2: everything is under 'ome' key
         output_config.zr_attrs["ome"] = ome_attrs
 
-    if output_read_details:
-        with output_read_details.open() as o:
-            details = json.load(o)
-    else:
-        details = {}
-        if output_config.path.exists() and output_config.path.is_file():
-            # Someone has already written details. Reload them
-            with output_config.path.open() as o:
-                details = json.load(o)
-
     # convert arrays
     multiscales = input_config.zr_attrs.get("multiscales")
+    lowest = multiscales[0]["datasets"][-1]["path"]
     for ds in multiscales[0]["datasets"]:
         ds_path = ds["path"]
-        ds_array = input_config.zr_group[ds_path]
-        ds_shape = ds_array.shape
-        ds_chunks = ds_array.chunks
+        ds_array = input_config.array_metadata(ds_path)
+        ds_shape = ds_array["shape"]
+        ds_chunks = ds_array["chunks"]
         ds_shards = guess_shards(ds_shape, ds_chunks)
         ds_input_config = input_config.sub_config(ds_path, False)
         ds_output_config = output_config.sub_config(ds_path, False)
 
         if output_write_details:
-            details.update(
-                {
-                    ds_input_config.fs_string(): {
-                        "shape": ds_shape,
-                        "chunks": ds_chunks,
-                        "shards": ds_shards,
-                    }
-                }
+            # Note: not S3 compatible
+            output_write_details.add(
+                ds_input_config.fs_string(), ds_shape, ds_chunks, ds_shards
             )
-            # Note: not S3 compatible and doesn't use subpath!
-            with output_config.path.open(mode="w") as o:
-                json.dump(details, o)
         else:
             if output_read_details:
                 # read row by row and overwrite
-                key = ds_input_config.fs_string()
-                ds_chunks = details[key]["chunks"]
-                ds_shards = details[key]["shards"]
+                details = output_read_details[ds_input_config.fs_string()]
+                ds_chunks = details["chunks"]
+                ds_shards = details["shards"]
             else:
                 if output_chunks:
                     ds_chunks = output_chunks
@@ -264,19 +750,46 @@ def convert_image(
                 chunk_txt = ",".join(map(str, ds_chunks))
                 shard_txt = ",".join(map(str, ds_shards))
                 dimsn_txt = ",".join(map(str, dimension_names))
+                command = f"zarrs_reencode --chunk-shape {chunk_txt} --shard-shape {shard_txt} --dimension-names {dimsn_txt} --validate {ds_input_config} {ds_output_config}"
                 output_config.zr_write_text(
-                    Path(ds_path) / "convert.sh",
-                    f"zarrs_reencode --chunk-shape {chunk_txt} --shard-shape {shard_txt} --dimension-names {dimsn_txt} --validate {ds_input_config} {ds_output_config}\n",
+                    Path(ds_path) / "convert.sh", f"{command}\n"
+                )
+                output_script.add(
+                    ds_input_config,
+                    ds_output_config,
+                    ds_array,
+                    dimension_names,
+                    ds_chunks,
+                    ds_shards,
                 )
             else:
-                convert_array(
+                observers = []
+                if previews is not None and ds_path == lowest:
+                    accumulator = previews.accumulator(ds_shape, dimension_names)
+                    if accumulator is not None:
+                        observers.append(accumulator)
+                if channel_stats and ds_path == lowest:
+                    statistics = ChannelStatistics(ds_shape, dimension_names)
+                    observers.append(statistics)
+                stats = convert_array(
                     ds_input_config,
                     ds_output_config,
                     dimension_names,
                     ds_chunks,
                     ds_shards,
                     threads,
+                    retry=retry,
+                    observers=observers or None,
                 )
+                totals.append(array_totals(stats))
+
+    if statistics is not None:
+        ome_attrs["omero"] = update_omero(ome_attrs.get("omero"), statistics.summary())
+        if output_config.zr_group is not None:
+            output_config.zr_attrs["ome"] = ome_attrs
+
+    if accumulator is not None and output_config.zr_group is not None:
+        previews.write(output_config, accumulator, ome_attrs.get("omero"))
 
     # check for labels...
     try:
@@ -297,6 +810,8 @@ def convert_image(
         if not dry_run:
             labels_output_config.zr_attrs["ome"] = dict(labels_config.zr_attrs)
 
+        labels_start = time.time()
+        labels_totals = []
         for label_path in labels_attrs:
             label_config = labels_config.sub_config(label_path)
             label_path_obj = Path("labels") / label_path
@@ -306,7 +821,7 @@ def convert_image(
                 create_or_open_group=(not dry_run),
             )
 
-            convert_image(
+            label_totals = convert_image(
                 label_config,
                 label_output_config,
                 output_chunks,
@@ -316,7 +831,15 @@ def convert_image(
                 output_script,
                 threads,
                 notes,
+                retry,
             )
+            # Labels are part of the image rather than images of their own
+            labels_totals.append({**label_totals, "images": 0})
+        totals.append(
+            write_totals(labels_output_config, sum_totals(labels_totals), labels_start)
+        )
+
+    return write_totals(output_config, sum_totals(totals, images=1), start)
 
 
 class ROCrateWriter:
@@ -395,124 +918,315 @@ class ROCrateWriter:
         config: Config,
         filename: str | Path = "ro-crate-metadata.json",
         indent: int = 2,
+        previews: list[str] | None = None,
     ) -> None:
         """
         Use the config location to write a string representation of the metadata to a file.
+        The PNG files at the relative `previews` paths are added as images, the first one
+        as the thumbnail of the dataset.
         """
         self.generate()
         self.process()
+        for i, path in enumerate(previews or []):
+            preview = self.crate.add_file(
+                dest_path=path,
+                properties={
+                    "@type": ["File", "ImageObject"],
+                    "encodingFormat": "image/png",
+                },
+            )
+            if i == 0:
+                self.zarr_root["thumbnail"] = preview
         metadata_dict = self.crate.metadata.generate()
         text = json.dumps(metadata_dict, indent=indent)
         config.zr_write_text(filename, text)
 
 
-def main(ns: argparse.Namespace) -> int | None:
+class Session:
     """
-    If no images are converted, raises SystemExit.
-    Otherwise, return the number of images, unless --silent.
+    Conversion state which outlives a single conversion so that resave can
+    be embedded in a long-running process:
+
+      * all arrays are opened with one tensorstore context, sharing its
+        cache pool and S3/file I/O concurrency limits
+      * one MetadataCache per input hierarchy is kept in memory and saved
+        by `close()`
+      * overwritten local outputs are deleted in the background until
+        `close()`
+
+    The CLI creates one from its arguments (`Session.from_namespace`).
+    Programmatic users construct one directly and call `convert` (or the
+    more specific `convert_image`, `convert_plate` and `convert_series`)
+    as often as needed, passing `StoreSettings` or local paths:
+
+        with Session(rocrate=ROCrateWriter(data_license=...)) as session:
+            for name in names:
+                session.convert(f"in/{name}.zarr", f"out/{name}.zarr")
     """
 
-    converted: int = 0
+    def __init__(
+        self,
+        chunks: list[int] | None = None,
+        shards: list[int] | None = None,
+        threads: int = 16,
+        retries: int = 10,
+        notes: str | None = None,
+        rocrate: ROCrateWriter | None = None,
+        cache_directory: Path | None = None,
+        cache_trust: bool = False,
+        cache_max_age: float = 3600,
+        context: dict | None = None,
+        read_details: Path | None = None,
+        write_details: bool = False,
+        script: bool = False,
+        job_bytes: int = 4 * 1024**3,
+        thumbnails: bool = False,
+        projections: bool = False,
+        channel_stats: bool = False,
+    ):
+        self.chunks = chunks
+        self.shards = shards
+        self.threads = threads
+        self.retries = retries
+        self.notes = notes
+        self.rocrate = rocrate
+        self.cache_directory = cache_directory
+        self.cache_trust = cache_trust
+        self.cache_max_age = cache_max_age
+        self.context = ts.Context(context or {})
+        self.details_reader = DetailsReader(read_details) if read_details else None
+        self.write_details = write_details
+        self.script = script
+        self.job_bytes = job_bytes
+        self.thumbnails = thumbnails or projections
+        self.projections = projections
+        self.channel_stats = channel_stats
+
+        self.caches: dict[str, MetadataCache] = {}
+        self.background_deletes: list[BackgroundDelete] = []
+
+    @classmethod
+    def from_namespace(cls, ns: argparse.Namespace) -> Session:
+        return cls(
+            chunks=ns.output_chunks,
+            shards=ns.output_shards,
+            threads=ns.output_threads,
+            retries=ns.output_retries,
+            notes=ns.conversion_notes,
+            rocrate=ns.rocrate,
+            cache_directory=ns.input_cache,
+            cache_trust=ns.input_cache_trust,
+            cache_max_age=ns.input_cache_max_age,
+            read_details=ns.output_read_details,
+            write_details=ns.output_write_details,
+            script=ns.output_script,
+            job_bytes=ns.output_job_bytes,
+            thumbnails=ns.output_thumbnails,
+            projections=ns.output_projections,
+            channel_stats=ns.output_channel_stats,
+        )
 
-    parse(ns)
-    rocrate: ROCrateWriter = ns.rocrate
+    def __enter__(self) -> Session:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for cache in self.caches.values():
+            cache.save()
+        while self.background_deletes:
+            self.background_deletes.pop().wait()
+
+    def cache(self, settings: StoreSettings) -> MetadataCache | None:
+        if self.cache_directory is None:
+            return None
+        key = settings.cache_key()
+        if key not in self.caches:
+            self.caches[key] = MetadataCache(
+                Path(self.cache_directory).expanduser(),
+                key,
+                validate=not self.cache_trust,
+                max_age=self.cache_max_age,
+            )
+        return self.caches[key]
 
-    input_config = Config(ns, "input", "r")
-    output_config = Config(ns, "output", "w")
-    output_config.check_or_delete_path()
+    def open(
+        self,
+        input: StoreSettings | str | Path,
+        output: StoreSettings | str | Path,
+    ) -> tuple[Config, Config]:
+        """
+        Returns the input and output configurations after clearing (or
+        refusing to overwrite) the output and creating its root group.
+        """
+        input_settings = StoreSettings.of(input)
+        input_config = Config(
+            input_settings,
+            "input",
+            "r",
+            cache=self.cache(input_settings),
+            context=self.context,
+        )
+        output_config = Config(
+            StoreSettings.of(output), "output", "w", context=self.context
+        )
+        background_delete = output_config.check_or_delete_path()
+        if background_delete is not None:
+            self.background_deletes.append(background_delete)
 
-    input_config.open_group()
+        input_config.open_group()
 
-    if not ns.output_write_details:
-        output_config.create_group()
-        if rocrate:
-            rocrate.write(output_config)
+        if not self.write_details:
+            output_config.create_group()
+            if self.rocrate:
+                self.rocrate.write(output_config)
+        return input_config, output_config
 
-    # image...
-    if input_config.zr_attrs.get("multiscales"):
-        convert_image(
+    def convert(
+        self,
+        input: StoreSettings | str | Path,
+        output: StoreSettings | str | Path,
+    ) -> int:
+        """
+        Convert an image, plate or bioformats2raw series depending on the
+        input metadata and return the number of images converted.
+        """
+        return self._convert(input, output, None)
+
+    def convert_image(self, input, output) -> int:
+        return self._convert(input, output, "multiscales")
+
+    def convert_plate(self, input, output) -> int:
+        return self._convert(input, output, "plate")
+
+    def convert_series(self, input, output) -> int:
+        return self._convert(input, output, "bioformats2raw.layout")
+
+    def _convert(self, input, output, kind: str | None) -> int:
+        input_config, output_config = self.open(input, output)
+        attrs = input_config.zr_attrs
+        if kind is None:
+            # Note: plates can *also* contain bioformats2raw metadata
+            for key in ("multiscales", "plate", "bioformats2raw.layout"):
+                if attrs.get(key):
+                    kind = key
+                    break
+            else:
+                LOGGER.warning(f"no convertible metadata: {attrs.keys()}")
+                return 0
+        elif not attrs.get(kind):
+            msg = f"no {kind} metadata found at {input_config}"
+            raise ValueError(msg)
+
+        details_writer = None
+        if self.write_details:
+            details_writer = DetailsWriter(output_config.path)
+        manifest = JobManifest(self.job_bytes) if self.script else None
+        previews = Previews(projections=self.projections) if self.thumbnails else None
+        run = (details_writer, manifest, RetryBudget(self.retries), previews)
+        try:
+            if kind == "multiscales":
+                totals = self._image(input_config, output_config, run)
+            elif kind == "plate":
+                totals = self._plate(input_config, output_config, run)
+            else:
+                totals = self._series(input_config, output_config, run)
+        finally:
+            if details_writer is not None:
+                details_writer.close()
+
+        converted = totals["images"]
+        if manifest is not None and converted:
+            manifest.write(output_config)
+        if self.rocrate and previews is not None and previews.paths:
+            # Rewritten now that the previews exist
+            self.rocrate.write(output_config, previews=previews.paths)
+        return converted
+
+    def _image(self, input_config: Config, output_config: Config, run) -> dict:
+        details_writer, manifest, retry, previews = run
+        return convert_image(
             input_config,
             output_config,
-            ns.output_chunks,
-            ns.output_shards,
-            ns.output_read_details,
-            ns.output_write_details,
-            ns.output_script,
-            ns.output_threads,
-            ns.conversion_notes,
+            self.chunks,
+            self.shards,
+            self.details_reader,
+            details_writer,
+            manifest,
+            self.threads,
+            self.notes,
+            retry,
+            previews,
+            self.channel_stats,
         )
-        converted += 1
 
-    # plate...
-    elif plate_attrs := input_config.zr_attrs.get("plate"):
+    def _root_attrs(self, input_config: Config, output_config: Config) -> None:
         ome_attrs = {"version": NGFF_VERSION}
         for key, value in input_config.zr_attrs.items():
             # ...replaces all other versions - remove
             strip_version(value)
             ome_attrs[key] = value
 
-        add_creator(ome_attrs, ns.conversion_notes)
+        add_creator(ome_attrs, self.notes)
 
         if output_config.zr_group is not None:  # otherwise dry run
             # dev2: everything is under 'ome' key
             output_config.zr_attrs["ome"] = ome_attrs
 
-        wells = plate_attrs.get("wells")
+    def _plate(self, input_config: Config, output_config: Config, run) -> dict:
+        start = time.time()
+        wells_totals = []
+        self._root_attrs(input_config, output_config)
+
+        wells = input_config.zr_attrs["plate"].get("wells")
 
         for well in tqdm.tqdm(
             wells, position=0, desc="i", leave=False, colour="green", ncols=80
         ):
             well_path = well["path"]
+            well_start = time.time()
+            well_output_config = None
 
             well_input_config = input_config.sub_config(well_path)
 
+            well_attrs = {}
+            for key, value in well_input_config.zr_attrs.items():
+                strip_version(value)
+                well_attrs[key] = value
+                well_attrs["version"] = "0.5"
+
             if output_config.zr_group is not None:  # otherwise dry-run
                 well_output_config = output_config.sub_config(well_path)
-                well_attrs = {}
-                for key, value in well_input_config.zr_attrs.items():
-                    strip_version(value)
-                    well_attrs[key] = value
-                    well_attrs["version"] = "0.5"
                 well_output_config.zr_attrs["ome"] = well_attrs
 
             images = well_attrs["well"]["images"]
+            well_totals = []
             for img in tqdm.tqdm(
                 images, position=1, desc="j", leave=False, colour="red", ncols=80
             ):
                 img_path = Path(well_path) / img["path"]
                 img_input_config = input_config.sub_config(img_path)
 
-                if output_config.zr_group is not None:  # otherwise dry-run
-                    img_output_config = output_config.sub_config(str(img_path))
-                else:
-                    img_output_config = None
-
-                convert_image(
-                    img_input_config,
-                    img_output_config,
-                    ns.output_chunks,
-                    ns.output_shards,
-                    ns.output_read_details,
-                    ns.output_write_details,
-                    ns.output_script,
-                    ns.output_threads,
-                    ns.conversion_notes,
+                img_output_config = output_config.sub_config(
+                    str(img_path),
+                    create_or_open_group=output_config.zr_group is not None,
                 )
-                converted += 1
-    # Note: plates can *also* contain this metadata
-    elif layout := input_config.zr_attrs.get("bioformats2raw.layout"):
-        assert layout == 3
-        ome_attrs = {"version": NGFF_VERSION}
-        for key, value in input_config.zr_attrs.items():
-            # ...replaces all other versions - remove
-            strip_version(value)
-            ome_attrs[key] = value
 
-        add_creator(ome_attrs, ns.conversion_notes)
+                well_totals.append(
+                    self._image(img_input_config, img_output_config, run)
+                )
+            totals = sum_totals(well_totals)
+            if well_output_config is not None:
+                totals = write_totals(well_output_config, totals, well_start)
+            wells_totals.append(totals)
+        return write_totals(output_config, sum_totals(wells_totals), start)
 
-        if output_config.zr_group is not None:  # otherwise dry run
-            # dev2: everything is under 'ome' key
-            output_config.zr_attrs["ome"] = ome_attrs
+    def _series(self, input_config: Config, output_config: Config, run) -> dict:
+        start = time.time()
+        series_totals = []
+        assert input_config.zr_attrs["bioformats2raw.layout"] == 3
+        self._root_attrs(input_config, output_config)
 
         ome_config = input_config.sub_config("OME")
         series = ome_config.zr_attrs.get("series", [])
@@ -520,7 +1234,7 @@ def main(ns: argparse.Namespace) -> int | None:
 
         filename = "OME/METADATA.ome.xml"
         ome_xml = input_config.zr_read_text(filename)
-        if ome_xml is not None:
+        if ome_xml is not None and output_config.zr_group is not None:
             output_config.zr_write_text(filename, ome_xml.text)
 
         for img_path in tqdm.tqdm(
@@ -528,25 +1242,27 @@ def main(ns: argparse.Namespace) -> int | None:
         ):
             img_input_config = input_config.sub_config(str(img_path))
 
-            if output_config.zr_group is not None:  # otherwise dry-run
-                img_output_config = output_config.sub_config(str(img_path))
-            else:
-                img_output_config = None
-
-            convert_image(
-                img_input_config,
-                img_output_config,
-                ns.output_chunks,
-                ns.output_shards,
-                ns.output_read_details,
-                ns.output_write_details,
-                ns.output_script,
-                ns.output_threads,
-                ns.conversion_notes,
+            img_output_config = output_config.sub_config(
+                str(img_path),
+                create_or_open_group=output_config.zr_group is not None,
             )
-            converted += 1
-    else:
-        LOGGER.warning(f"no convertible metadata: {input_config.zr_attrs.keys()}")
+
+            series_totals.append(self._image(img_input_config, img_output_config, run))
+        return write_totals(output_config, sum_totals(series_totals), start)
+
+
+def main(ns: argparse.Namespace) -> int | None:
+    """
+    If no images are converted, raises SystemExit.
+    Otherwise, return the number of images, unless --silent.
+    """
+
+    parse(ns)
+    with Session.from_namespace(ns) as session:
+        converted = session.convert(
+            StoreSettings.from_namespace(ns, "input"),
+            StoreSettings.from_namespace(ns, "output"),
+        )
 
     if converted == 0:
         raise SystemExit(1)
@@ -558,6 +1274,65 @@ def main(ns: argparse.Namespace) -> int | None:
     return converted
 
 
+def add_rocrate_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Add the license and other RO-Crate arguments read by `rocrate_writer`
+    """
+
+    # Very recommended metadata (SHOULD!)
+    def license_action(group, arg: str, url: str, recommended: bool = True):
+        class LicenseAction(argparse.Action):
+            def __call__(self, parser, args, *unused, **ignore):  # noqa: ARG002
+                args.rocrate_license = url
+                if not recommended:
+                    warnings.warn(
+                        f"This license is not recommended: {url}", stacklevel=1
+                    )
+
+        desc = url
+        if not recommended:
+            desc = "(not recommended) " + url
+        group.add_argument(arg, action=LicenseAction, nargs=0, help=desc)
+
+    group_lic = parser.add_mutually_exclusive_group()
+    license_action(
+        group_lic, "--cc0", "https://creativecommons.org/publicdomain/zero/1.0/"
+    )
+    license_action(group_lic, "--cc-by", "https://creativecommons.org/licenses/by/4.0/")
+    group_lic.add_argument(
+        "--rocrate-license",
+        type=str,
+        help="URL to another license, e.g., 'https://creativecommons.org/licenses/by/4.0/'",
+    )
+
+    # Recommended metadata (SHOULD)
+    parser.add_argument(
+        "--rocrate-organism",
+        type=str,
+        help="NCBI identifier of the form 'NCBI:txid7227'",
+    )
+    parser.add_argument(
+        "--rocrate-modality",
+        type=str,
+        help="FBbi identifier of the form 'obo:FBbi_00000243'",
+    )
+
+    # Optional metadata (MAY)
+    parser.add_argument(
+        "--rocrate-name",
+        type=str,
+        help="optional name of the dataset; taken from the NGFF metadata if available",
+    )
+    parser.add_argument(
+        "--rocrate-description", type=str, help="optional description of the dataset"
+    )
+    parser.add_argument(
+        "--rocrate-skip",
+        action="store_true",
+        help="skips the creation of the RO-Crate file",
+    )
+
+
 def cli(subparsers: argparse._SubParsersAction):
     """
     Parses the arguments contained in `args` and passes
@@ -621,6 +1396,7 @@ CHUNKS/SHARDS
 
     Set the same value for all resolutions   {cmd} --cc-by in.zarr out.zarr --output-chunks=1,1,1,256,256 --output-shards=1,1,1,2048,2048
     Log the current values for all images    {cmd} --cc-by in.zarr cfg.json --output-write-details
+    ...one line per array for large plates   {cmd} --cc-by in.zarr cfg.jsonl --output-write-details
     Read values from an edited config file   {cmd} --cc-by in.zarr out.zarr --output-read-details=cfg.json
 
 
@@ -644,10 +1420,15 @@ REMOTE (S3)
 ADVANCED
 
     Prepare scripts for conversion.          {cmd} --cc-by in.zarr out.zarr --output-script
+    ...with jobs of ~1GB each                {cmd} --cc-by in.zarr out.zarr --output-script --output-job-bytes=1000000000
+    Cache input metadata between runs        {cmd} --cc-by in.zarr cfg.json --output-write-details --input-cache=~/.cache/ngff
     Set number of parallel threads           {cmd} --cc-by in.zarr out.zarr --output-threads=128
     Increase logging                         {cmd} --cc-by in.zarr out.zarr --log=debug
     Increase logging even more               {cmd} --cc-by in.zarr out.zarr --log=trace
     Record details about the conversion      {cmd} --cc-by in.zarr out.zarr --conversion-notes="run on a virtual machine"
+    Write thumbnails while converting        {cmd} --cc-by in.zarr out.zarr --output-thumbnails
+    ...and Z/T max. intensity projections    {cmd} --cc-by in.zarr out.zarr --output-projections
+    Compute omero windows while converting   {cmd} --cc-by in.zarr out.zarr --output-channel-stats
     """
     parser = subparsers.add_parser(
         "resave",
@@ -656,14 +1437,24 @@ ADVANCED
         formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.set_defaults(func=main)
-    parser.add_argument("--input-bucket")
-    parser.add_argument("--input-endpoint")
-    parser.add_argument("--input-anon", action="store_true")
-    parser.add_argument("--input-region", default="us-east-1")
-    parser.add_argument("--output-bucket")
-    parser.add_argument("--output-endpoint")
-    parser.add_argument("--output-anon", action="store_true")
-    parser.add_argument("--output-region", default="us-east-1")
+    add_store_arguments(parser, "input")
+    parser.add_argument(
+        "--input-cache",
+        type=Path,
+        help="directory for caching input metadata between runs",
+    )
+    parser.add_argument(
+        "--input-cache-trust",
+        action="store_true",
+        help="reuse cached input metadata without checking the source for changes",
+    )
+    parser.add_argument(
+        "--input-cache-max-age",
+        type=float,
+        default=3600,
+        help="seconds for which cached input metadata is reused without checking the source",
+    )
+    add_store_arguments(parser, "output")
     parser.add_argument(
         "--output-overwrite",
         action="store_true",
@@ -675,69 +1466,45 @@ ADVANCED
         help="CAUTION: Do not run conversion. Instead prepare scripts for later conversion",
     )
     parser.add_argument(
-        "--output-threads",
+        "--output-retries",
         type=int,
-        default=16,
-        help="number of simultaneous write threads",
+        default=10,
+        help="total number of times failed shards may be retried during the conversion",
     )
     parser.add_argument(
-        "--silent",
-        action="store_true",
-        help="Command returns nothing; required for nextflow",
-    )
-
-    # Very recommended metadata (SHOULD!)
-    def license_action(group, arg: str, url: str, recommended: bool = True):
-        class LicenseAction(argparse.Action):
-            def __call__(self, parser, args, *unused, **ignore):  # noqa: ARG002
-                args.rocrate_license = url
-                if not recommended:
-                    warnings.warn(
-                        f"This license is not recommended: {url}", stacklevel=1
-                    )
-
-        desc = url
-        if not recommended:
-            desc = "(not recommended) " + url
-        group.add_argument(arg, action=LicenseAction, nargs=0, help=desc)
-
-    group_lic = parser.add_mutually_exclusive_group()
-    license_action(
-        group_lic, "--cc0", "https://creativecommons.org/publicdomain/zero/1.0/"
-    )
-    license_action(group_lic, "--cc-by", "https://creativecommons.org/licenses/by/4.0/")
-    group_lic.add_argument(
-        "--rocrate-license",
-        type=str,
-        help="URL to another license, e.g., 'https://creativecommons.org/licenses/by/4.0/'",
+        "--output-job-bytes",
+        type=int,
+        default=4 * 1024**3,
+        help="target number of uncompressed bytes per job in the --output-script manifest",
     )
-
-    # Recommended metadata (SHOULD)
     parser.add_argument(
-        "--rocrate-organism",
-        type=str,
-        help="NCBI identifier of the form 'NCBI:txid7227'",
+        "--output-threads",
+        type=int,
+        default=16,
+        help="number of simultaneous write threads",
     )
     parser.add_argument(
-        "--rocrate-modality",
-        type=str,
-        help="FBbi identifier of the form 'obo:FBbi_00000243'",
+        "--output-thumbnails",
+        action="store_true",
+        help="write a thumbnail of each image, collected from its lowest resolution level during the conversion",
     )
-
-    # Optional metadata (MAY)
     parser.add_argument(
-        "--rocrate-name",
-        type=str,
-        help="optional name of the dataset; taken from the NGFF metadata if available",
+        "--output-projections",
+        action="store_true",
+        help="also write maximum intensity projections along Z and T next to the thumbnails",
     )
     parser.add_argument(
-        "--rocrate-description", type=str, help="optional description of the dataset"
+        "--output-channel-stats",
+        action="store_true",
+        help="complete the omero window of each channel from the lowest resolution level during the conversion",
     )
     parser.add_argument(
-        "--rocrate-skip",
+        "--silent",
         action="store_true",
-        help="skips the creation of the RO-Crate file",
+        help="Command returns nothing; required for nextflow",
     )
+
+    add_rocrate_arguments(parser)
     parser.add_argument(
         "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
     )
@@ -745,10 +1512,12 @@ ADVANCED
     group_ex.add_argument(
         "--output-write-details",
         action="store_true",
-        help="don't convert array, instead write chunk and proposed shard sizes",
+        help="don't convert array, instead write chunk and proposed shard sizes (.json or .jsonl)",
     )
     group_ex.add_argument(
-        "--output-read-details", type=Path, help="read chink and shard sizes from file"
+        "--output-read-details",
+        type=Path,
+        help="read chunk and shard sizes from file (.json or .jsonl)",
     )
     group_ex.add_argument(
         "--output-chunks",
@@ -774,15 +1543,23 @@ def parse(ns: argparse.Namespace):
     """
     configure_logging(ns, LOGGER)
 
-    ns.rocrate = None
-    if not ns.rocrate_skip:
-        setup = {}
-        for key in ("name", "description", "organism", "modality"):
-            value = getattr(ns, f"rocrate_{key}", None)
-            if value:
-                setup[key] = value
-        if not ns.rocrate_license:
-            message = "No license set. Choose one of the Creative Commons license (e.g., `--cc-by`) or skip RO-Crate creation (`--rocrate-skip`)"
-            raise SystemExit(message)
-        setup["data_license"] = ns.rocrate_license
-        ns.rocrate = ROCrateWriter(**setup)
+    ns.rocrate = rocrate_writer(ns)
+
+
+def rocrate_writer(ns: argparse.Namespace) -> ROCrateWriter | None:
+    """
+    Returns the ROCrateWriter configured by `add_rocrate_arguments` or None
+    if `--rocrate-skip` was set. Raises SystemExit if no license is set.
+    """
+    if ns.rocrate_skip:
+        return None
+    setup = {}
+    for key in ("name", "description", "organism", "modality"):
+        value = getattr(ns, f"rocrate_{key}", None)
+        if value:
+            setup[key] = value
+    if not ns.rocrate_license:
+        message = "No license set. Choose one of the Creative Commons license (e.g., `--cc-by`) or skip RO-Crate creation (`--rocrate-skip`)"
+        raise SystemExit(message)
+    setup["data_license"] = ns.rocrate_license
+    return ROCrateWriter(**setup)
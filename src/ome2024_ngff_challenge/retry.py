@@ -0,0 +1,124 @@
+"""
+Retrying operations which fail for transient reasons (throttling, network
+errors, ...) with backoff. Like `cli_utils`, this module must stay free of
+heavy imports so that e.g. `run-scripts` can use it without loading
+tensorstore or zarr.
+"""
+
+from __future__ import annotations
+
+import logging
+import random
+import re
+import subprocess
+import time
+
+LOGGER = logging.getLogger(__file__)
+
+
+# OSErrors which will not go away by trying again
+PERMANENT_OS_ERRORS = (
+    FileNotFoundError,
+    FileExistsError,
+    PermissionError,
+    IsADirectoryError,
+    NotADirectoryError,
+)
+
+# Status codes and HTTP responses of tensorstore errors worth retrying
+TRANSIENT_TS_ERROR = re.compile(
+    r"^(UNAVAILABLE|DEADLINE_EXCEEDED|RESOURCE_EXHAUSTED|ABORTED):"
+    r"|http_response_code='(5\d\d|429)'"
+)
+
+# Error codes of S3 (botocore) responses worth retrying
+TRANSIENT_S3_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestTimeout",
+    "RequestTimeTooSkewed",
+    "InternalError",
+    "ServiceUnavailable",
+}
+
+# Messages in the output of a failed script (see `run-scripts`) which
+# report one of the transient failures above
+TRANSIENT_OUTPUT = re.compile(
+    r"\b(UNAVAILABLE|DEADLINE_EXCEEDED|RESOURCE_EXHAUSTED|ABORTED):"
+    r"|http_response_code='(5\d\d|429)'"
+    r"|\b(" + "|".join(sorted(TRANSIENT_S3_CODES)) + r")\b"
+    r"|\b(TimeoutError|ConnectionError|ConnectionResetError)\b"
+)
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether `error` may succeed when retried: network and I/O errors,
+    tensorstore errors reporting an unavailable or throttling store or a
+    5xx response, S3 errors with a 5xx or throttling code, and scripts
+    which were killed or report one of these in their output. Everything
+    else (e.g. a dtype mismatch or a failed verification) is a bug or bad
+    input and retrying only delays reporting it.
+    """
+    response = getattr(error, "response", None)
+    if isinstance(response, dict) and "Error" in response:  # botocore
+        status = response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return status >= 500 or response["Error"].get("Code") in TRANSIENT_S3_CODES
+    if isinstance(error, OSError):
+        return not isinstance(error, PERMANENT_OS_ERRORS)
+    if isinstance(error, ValueError):  # tensorstore
+        return TRANSIENT_TS_ERROR.search(str(error)) is not None
+    if isinstance(error, subprocess.CalledProcessError):
+        # a negative exit status is a signal, e.g. from the OOM killer
+        output = error.stderr or ""
+        return error.returncode < 0 or TRANSIENT_OUTPUT.search(output) is not None
+    return False
+
+
+class RetryBudget:
+    """
+    Retries callables with jittered exponential backoff.
+
+    The number of retries is shared by all calls so that a store which keeps
+    failing aborts the run after `budget` retries rather than retrying every
+    shard. Each delay is chosen uniformly from [0, min(cap, base * 2**attempt)].
+    """
+
+    def __init__(self, budget: int, base: float = 0.5, cap: float = 30.0):
+        if budget < 0:
+            msg = f"budget must not be negative ({budget})"
+            raise ValueError(msg)
+        self.budget = budget
+        self.base = base
+        self.cap = cap
+        self.retries = 0
+
+    def remaining(self) -> int:
+        return self.budget - self.retries
+
+    def call(self, func, description: str = "", error: Exception | None = None):
+        """
+        Call `func` until it succeeds or the budget is exhausted, in which case
+        the last error is raised. Errors which are not transient (see
+        `is_transient`) are raised immediately. If `error` is given, the
+        operation already failed once elsewhere and so the first call already
+        counts as a retry.
+        """
+        attempt = 0
+        while True:
+            if error is not None:
+                if self.remaining() <= 0 or not is_transient(error):
+                    raise error
+                self.retries += 1
+                delay = random.uniform(0, min(self.cap, self.base * 2**attempt))
+                attempt += 1
+                LOGGER.warning(
+                    f"retry {attempt} of {description} in {delay:0.2f}s "
+                    f"({self.remaining()} left): {error}"
+                )
+                time.sleep(delay)
+            try:
+                return func()
+            except Exception as e:
+                error = e
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import tqdm
+
+from .cli_utils import configure_logging
+from .retry import RetryBudget
+
+LOGGER = logging.getLogger(__file__)
+
+SCRIPT = "convert.sh"
+STATUS = "run-scripts.jsonl"
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge run-scripts"
+    desc = f"""
+
+
+The `run-scripts` subcommand runs the `{SCRIPT}` scripts generated by
+`resave --output-script` in parallel on the local machine. The number of
+simultaneous scripts is bounded by the number of CPUs and by the available
+memory divided by the shard size of the largest array.
+
+The outcome of every script is appended to `{STATUS}` in the output
+directory. Scripts which succeeded in a previous run and whose array metadata
+(`zarr.json`) exists are skipped. Scripts which fail for a transient reason
+(a throttled or unavailable store, a timeout, or being killed) are retried
+with an exponentially increasing delay; other failures are not retried.
+
+
+BASIC
+
+    Run all scripts:                         {cmd} out.zarr
+    Limit the number of parallel scripts:    {cmd} out.zarr --jobs=4
+    Re-run scripts which already succeeded:  {cmd} out.zarr --force
+
+    """
+    parser = subparsers.add_parser(
+        "run-scripts",
+        help="run the scripts generated by `resave --output-script`",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        help="maximum number of simultaneous scripts (default: based on CPUs and memory)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help="number of times a script failing for a transient reason is retried",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="run all scripts even if they previously succeeded",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument("output_path", type=Path)
+
+
+def parse(ns: argparse.Namespace):
+    """
+    Parse the namespace arguments provided by the dispatcher
+    """
+    configure_logging(ns, LOGGER)
+
+
+def available_memory() -> int | None:
+    """
+    Returns the available memory in bytes or None if it cannot be determined
+    """
+    meminfo = Path("/proc/meminfo")
+    if meminfo.is_file():
+        for line in meminfo.read_text().splitlines():
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_memory(script: Path) -> int:
+    """
+    Estimate the memory needed by a `zarrs_reencode` script as the size of
+    one shard. The item size is read from the input array if it is local,
+    otherwise 8 bytes are assumed.
+    """
+    args = shlex.split(script.read_text())
+    if "--shard-shape" not in args:
+        return 0
+    shard = args[args.index("--shard-shape") + 1].split(",")
+    itemsize = 8
+    zarray = Path(args[-2]) / ".zarray"
+    if zarray.is_file():
+        dtype = json.loads(zarray.read_text())["dtype"]
+        itemsize = int("".join(c for c in dtype if c.isdigit()) or 8)
+    return math.prod(int(x) for x in shard) * itemsize
+
+
+def worker_count(scripts: list[Path], jobs: int | None) -> int:
+    if hasattr(os, "sched_getaffinity"):
+        count = len(os.sched_getaffinity(0))
+    else:
+        count = multiprocessing.cpu_count()
+    memory = available_memory()
+    needed = max((estimate_memory(s) for s in scripts), default=0)
+    if memory and needed:
+        count = min(count, max(1, memory // needed))
+    if jobs:
+        count = min(count, jobs)
+    return max(1, count)
+
+
+def load_status(status: Path) -> dict[str, dict]:
+    """
+    Returns the most recent record for each script from a previous run
+    """
+    records: dict[str, dict] = {}
+    if status.is_file():
+        with status.open() as o:
+            for line in o:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["script"]] = record
+    return records
+
+
+class Runner:
+    """
+    Runs scripts with retries (see `RetryBudget`) and appends one status
+    record per script
+    """
+
+    def __init__(self, status: Path, retries: int, base: float = 0.5):
+        self.status = status
+        self.retries = retries
+        self.base = base
+        self.lock = threading.Lock()
+
+    def record(self, record: dict) -> None:
+        with self.lock, self.status.open("a") as o:
+            o.write(json.dumps(record) + "\n")
+
+    def run(self, script: Path) -> dict:
+        start = time.time()
+        retry = RetryBudget(self.retries, base=self.base)
+
+        def attempt():
+            proc = subprocess.run(
+                ["sh", str(script)], capture_output=True, text=True, check=False
+            )
+            if proc.returncode != 0:
+                LOGGER.warning(
+                    f"{script} failed (attempt {retry.retries + 1}, exit {proc.returncode}): {proc.stderr.strip()[-500:]}"
+                )
+                raise subprocess.CalledProcessError(
+                    proc.returncode, proc.args, proc.stdout, proc.stderr
+                )
+
+        try:
+            retry.call(attempt, str(script))
+            returncode = 0
+        except subprocess.CalledProcessError as e:
+            returncode = e.returncode
+        stop = time.time()
+        record = {
+            "script": str(script),
+            "status": returncode,
+            "attempts": retry.retries + 1,
+            "start": start,
+            "stop": stop,
+            "elapsed": stop - start,
+        }
+        self.record(record)
+        return record
+
+
+def main(ns: argparse.Namespace) -> None:
+    """
+    Raises SystemExit if any script failed after all retries.
+    """
+    parse(ns)
+    status = ns.output_path / STATUS
+    previous = load_status(status)
+
+    scripts = []
+    for script in sorted(ns.output_path.rglob(SCRIPT)):
+        done = previous.get(str(script), {}).get("status") == 0
+        if not ns.force and done and (script.parent / "zarr.json").is_file():
+            LOGGER.debug(f"skipping {script}")
+            continue
+        scripts.append(script)
+
+    if not scripts:
+        LOGGER.warning(f"no scripts to run in {ns.output_path}")
+        return
+
+    workers = worker_count(scripts, ns.jobs)
+    LOGGER.info(f"running {len(scripts)} scripts with {workers} workers")
+    runner = Runner(status, ns.retries)
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(runner.run, script) for script in scripts]
+        for future in tqdm.tqdm(
+            as_completed(futures), total=len(futures), colour="green", ncols=80
+        ):
+            record = future.result()
+            if record["status"] != 0:
+                failed.append(record["script"])
+
+    if failed:
+        LOGGER.error(f"{len(failed)} scripts failed: {failed}")
+        raise SystemExit(1)
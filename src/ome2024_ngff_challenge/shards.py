@@ -0,0 +1,406 @@
+from __future__ import annotations
+
+import itertools
+import logging
+import math
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from zarr.api.synchronous import sync
+
+from .utils import Config
+
+LOGGER = logging.getLogger(__file__)
+
+# Offset and length of a chunk which is not stored in the shard
+EMPTY = 2**64 - 1
+
+# S3 requires all but the last part of a multipart upload to be >= 5 MiB
+PART_SIZE = 16 * 1024**2
+
+
+try:
+    # compiled implementation (google_crc32c or crc32c) used by the codec
+    from numcodecs.checksum32 import crc32c_checksum as _crc32c_native
+except ImportError:
+    _crc32c_native = None
+
+
+def _crc32c_table() -> list[int]:
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data: bytes) -> int:
+    """
+    CRC-32C (Castagnoli) checksum as used by the "crc32c" codec. Uses the
+    implementation numcodecs was installed with, if any, and otherwise the
+    much slower table-driven `_crc32c_python`.
+    """
+    if _crc32c_native is not None:
+        return _crc32c_native(data)
+    return _crc32c_python(data)
+
+
+def _crc32c_python(data: bytes) -> int:
+    crc = 0xFFFFFFFF
+    table = _CRC32C_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+class ShardIndexError(ValueError):
+    pass
+
+
+@dataclass
+class ShardLayout:
+    """
+    Geometry of a v3 array using the "sharding_indexed" codec as written by
+    `convert_array`: which shard keys can exist and where each shard's index
+    of (offset, nbytes) pairs for its inner chunks is located.
+    """
+
+    shape: list[int]
+    shard_shape: list[int]
+    chunk_shape: list[int]
+    index_location: str = "end"
+    checksum: bool = True
+    separator: str = "/"
+    prefix: str = "c"
+
+    @classmethod
+    def from_metadata(cls, metadata: dict) -> ShardLayout | None:
+        """
+        Returns the layout described by the v3 array `metadata` or None if
+        the array is not sharded.
+        """
+        codecs = metadata.get("codecs", [])
+        if not codecs or codecs[0].get("name") != "sharding_indexed":
+            return None
+        config = codecs[0]["configuration"]
+        index_codecs = [codec["name"] for codec in config.get("index_codecs", [])]
+        for codec in config.get("index_codecs", []):
+            endian = codec.get("configuration", {}).get("endian", "little")
+            if codec["name"] == "bytes" and endian != "little":
+                msg = "only little-endian shard indexes are supported"
+                raise ValueError(msg)
+        if not set(index_codecs) <= {"bytes", "crc32c"}:
+            msg = f"unsupported shard index codecs: {index_codecs}"
+            raise ValueError(msg)
+
+        encoding = metadata.get("chunk_key_encoding", {"name": "default"})
+        default_separator = "/" if encoding["name"] == "default" else "."
+        separator = encoding.get("configuration", {}).get(
+            "separator", default_separator
+        )
+        return cls(
+            shape=list(metadata["shape"]),
+            shard_shape=list(metadata["chunk_grid"]["configuration"]["chunk_shape"]),
+            chunk_shape=list(config["chunk_shape"]),
+            index_location=config.get("index_location", "end"),
+            checksum="crc32c" in index_codecs,
+            separator=separator,
+            prefix="c" if encoding["name"] == "default" else "",
+        )
+
+    @property
+    def chunks_per_shard(self) -> list[int]:
+        return [s // c for s, c in zip(self.shard_shape, self.chunk_shape)]
+
+    @property
+    def chunk_count(self) -> int:
+        return math.prod(self.chunks_per_shard)
+
+    @property
+    def index_size(self) -> int:
+        return self.chunk_count * 16 + (4 if self.checksum else 0)
+
+    @property
+    def grid(self) -> list[int]:
+        """Number of shards along each dimension"""
+        return [-(-s // b) for s, b in zip(self.shape, self.shard_shape)]
+
+    def key(self, position: tuple[int, ...]) -> str:
+        parts = [str(x) for x in position] or ["0"]
+        if self.prefix:
+            parts.insert(0, self.prefix)
+        return self.separator.join(parts)
+
+    def position(self, key: str) -> tuple[int, ...]:
+        """Grid position of the shard with the given key"""
+        parts = key.split(self.separator)
+        if self.prefix:
+            parts = parts[1:]
+        return tuple(int(x) for x in parts)[: len(self.shape)]
+
+    def keys(self) -> dict[str, tuple[int, ...]]:
+        """
+        Returns the grid position of every possible shard by its key
+        relative to the array.
+        """
+        return {
+            self.key(position): position
+            for position in itertools.product(*(range(g) for g in self.grid))
+        }
+
+    def chunk_indices(self, position: tuple[int, ...]) -> list[tuple[int, ...] | None]:
+        """
+        Grid indices of the inner chunks of the shard at `position` in the
+        order of its index, with None for chunks beyond the array bounds.
+        """
+        per_shard = self.chunks_per_shard
+        grid = [-(-s // c) for s, c in zip(self.shape, self.chunk_shape)]
+        indices: list[tuple[int, ...] | None] = []
+        for local in itertools.product(*(range(n) for n in per_shard)):
+            index = tuple(p * n + i for p, n, i in zip(position, per_shard, local))
+            inside = all(i < g for i, g in zip(index, grid))
+            indices.append(index if inside else None)
+        return indices
+
+    def index_range(self, size: int) -> tuple[int, int]:
+        """Byte range of the index within a shard of `size` bytes"""
+        if self.index_location == "start":
+            return 0, self.index_size
+        return size - self.index_size, size
+
+    def decode_index(self, data: bytes) -> np.ndarray:
+        """
+        Returns the (offset, nbytes) pairs of the inner chunks in C order,
+        after verifying the checksum if there is one.
+        """
+        if len(data) != self.index_size:
+            msg = f"shard index has {len(data)} bytes instead of {self.index_size}"
+            raise ShardIndexError(msg)
+        entries = data[: self.chunk_count * 16]
+        if self.checksum:
+            expected = int.from_bytes(data[-4:], "little")
+            actual = crc32c(entries)
+            if actual != expected:
+                msg = f"shard index checksum mismatch ({actual:08x} != {expected:08x})"
+                raise ShardIndexError(msg)
+        return np.frombuffer(entries, dtype="<u8").reshape(-1, 2)
+
+    def encode(self, chunks: list[bytes | None]) -> bytes:
+        """
+        Returns a shard containing the already encoded inner `chunks`, given
+        in C order with None for chunks which are not stored, and its index.
+        """
+        if len(chunks) != self.chunk_count:
+            msg = f"{len(chunks)} chunks given for a shard of {self.chunk_count}"
+            raise ValueError(msg)
+        index = np.full((self.chunk_count, 2), EMPTY, dtype="<u8")
+        offset = self.index_size if self.index_location == "start" else 0
+        for i, data in enumerate(chunks):
+            if data is not None:
+                index[i] = (offset, len(data))
+                offset += len(data)
+        entries = index.tobytes()
+        if self.checksum:
+            entries += crc32c(entries).to_bytes(4, "little")
+        data = b"".join(chunk for chunk in chunks if chunk is not None)
+        if self.index_location == "start":
+            return entries + data
+        return data + entries
+
+    def check(self, data: bytes, size: int) -> np.ndarray:
+        """
+        Decode the index of a shard of `size` bytes and verify that every
+        stored chunk lies within the shard's data region without overlapping
+        another. Returns the index; raises `ShardIndexError` otherwise.
+        """
+        if size < self.index_size:
+            msg = f"shard of {size} bytes is smaller than its index ({self.index_size})"
+            raise ShardIndexError(msg)
+        index = self.decode_index(data)
+        offsets, nbytes = index[:, 0], index[:, 1]
+        missing = (offsets == EMPTY) | (nbytes == EMPTY)
+        if np.any(missing & ((offsets != EMPTY) | (nbytes != EMPTY))):
+            msg = "shard index has chunks with only one of offset and length unset"
+            raise ShardIndexError(msg)
+
+        start, stop = (self.index_size, size)
+        if self.index_location != "start":
+            start, stop = 0, size - self.index_size
+        stored = index[~missing]
+        ends = stored[:, 0] + stored[:, 1]
+        if np.any(stored[:, 0] < start) or np.any(ends > stop):
+            msg = f"shard index points outside of the data region [{start}, {stop})"
+            raise ShardIndexError(msg)
+        order = np.argsort(stored[:, 0])
+        if np.any(stored[order[1:], 0] < ends[order[:-1]]):
+            msg = "shard index has overlapping chunks"
+            raise ShardIndexError(msg)
+        return index
+
+
+def list_objects(config: Config, prefix: str = "") -> dict[str, int]:
+    """
+    Returns the size of every object below `prefix`, keyed by their path
+    relative to it. On S3 this is a single (paginated) listing.
+    """
+    if config.is_s3():
+        root = f"{config.zr_store.path}/{prefix}".rstrip("/")
+        # Note: calls must go through the zarr event loop which owns the session
+        found = sync(config.zr_store._fs._find(root, detail=True))
+        return {
+            key[len(root) + 1 :]: info["size"]
+            for key, info in found.items()
+            if key.startswith(root + "/")
+        }
+    root = Path(config.fs_string()) / prefix
+    sizes = {}
+    for dirpath, _, files in os.walk(root):
+        for name in files:
+            path = Path(dirpath) / name
+            sizes[path.relative_to(root).as_posix()] = path.stat().st_size
+    return sizes
+
+
+def _read_range(path: Path, start: int, stop: int) -> bytes | Exception:
+    try:
+        with path.open("rb") as f:
+            f.seek(start)
+            return f.read(stop - start)
+    except OSError as e:
+        return e
+
+
+def read_ranges(
+    config: Config, ranges: list[tuple[str, int, int]], concurrency: int = 64
+) -> list[bytes | Exception]:
+    """
+    Read the byte ranges [start, stop) of the given keys with up to
+    `concurrency` requests in flight. Failures are returned in place of the
+    data rather than raised.
+    """
+    if not ranges:
+        return []
+    if config.is_s3():
+        fs = config.zr_store._fs
+        paths = [f"{config.zr_store.path}/{key}" for key, _, _ in ranges]
+        starts = [start for _, start, _ in ranges]
+        stops = [stop for _, _, stop in ranges]
+        return sync(
+            fs._cat_ranges(
+                paths, starts, stops, batch_size=concurrency, on_error="return"
+            )
+        )
+    root = Path(config.fs_string())
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(
+            pool.map(
+                lambda r: _read_range(root / r[0], r[1], r[2]),
+                ranges,
+            )
+        )
+
+
+class ShardStream:
+    """
+    Writes a shard with its index at the end one inner chunk at a time, so
+    that memory use depends on the chunk (and upload part) size rather than
+    on the shard size. Locally, chunks are appended to a temporary file which
+    replaces the shard on `close`. On S3, they are uploaded as the parts of a
+    multipart upload of `part_size` bytes each, falling back to a single PUT
+    if the whole shard fits into one part. Nothing is visible at the shard's
+    key until `close` succeeds; `abort` discards everything written.
+    """
+
+    def __init__(
+        self, config: Config, key: str, layout: ShardLayout, part_size: int = PART_SIZE
+    ):
+        if layout.index_location != "end":
+            msg = "only shards with the index at the end can be streamed"
+            raise ValueError(msg)
+        self.config = config
+        self.layout = layout
+        self.part_size = part_size
+        self.index = np.full((layout.chunk_count, 2), EMPTY, dtype="<u8")
+        self.offset = 0
+        self.chunks = 0
+        if config.is_s3():
+            self.fs = config.zr_store._fs
+            self.path = f"{config.zr_store.path}/{key}"
+            self.bucket, self.key, _ = self.fs.split_path(self.path)
+            self.buffer = bytearray()
+            self.upload_id: str | None = None
+            self.parts: list[dict] = []
+        else:
+            self.path = Path(config.fs_string()) / key
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.partial = self.path.with_name(
+                f".{self.path.name}.partial-{uuid.uuid4().hex[:8]}"
+            )
+            self.file = self.partial.open("wb")
+
+    def add(self, i: int, data: bytes) -> None:
+        """Append the encoded inner chunk with linear index `i`"""
+        self.index[i] = (self.offset, len(data))
+        self.offset += len(data)
+        self.chunks += 1
+        if not self.config.is_s3():
+            self.file.write(data)
+            return
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+
+    def _s3(self, method: str, **kwargs) -> dict:
+        # Note: calls must go through the zarr event loop which owns the session
+        return sync(
+            self.fs._call_s3(method, Bucket=self.bucket, Key=self.key, **kwargs)
+        )
+
+    def _upload_part(self, data: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = self._s3("create_multipart_upload")["UploadId"]
+        number = len(self.parts) + 1
+        response = self._s3(
+            "upload_part", UploadId=self.upload_id, PartNumber=number, Body=data
+        )
+        self.parts.append({"PartNumber": number, "ETag": response["ETag"]})
+
+    def close(self) -> None:
+        entries = self.index.tobytes()
+        if self.layout.checksum:
+            entries += crc32c(entries).to_bytes(4, "little")
+        if not self.config.is_s3():
+            self.file.write(entries)
+            self.file.close()
+            self.partial.replace(self.path)
+            return
+        self.buffer += entries
+        if self.upload_id is None:
+            sync(self.fs._pipe_file(self.path, bytes(self.buffer)))
+        else:
+            self._upload_part(bytes(self.buffer))
+            self._s3(
+                "complete_multipart_upload",
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        self.buffer = bytearray()
+        self.fs.invalidate_cache(self.path)
+
+    def abort(self) -> None:
+        if not self.config.is_s3():
+            self.file.close()
+            self.partial.unlink(missing_ok=True)
+        elif self.upload_id is not None:
+            self._s3("abort_multipart_upload", UploadId=self.upload_id)
+            self.upload_id = None
@@ -0,0 +1,626 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import csv
+import datetime
+import json
+import logging
+from pathlib import Path
+
+import aiohttp
+import tqdm
+
+from .catalogue import Catalogue
+from .cli_utils import configure_logging
+
+LOGGER = logging.getLogger(__file__)
+
+# Statistics of each array and, since the roll-up totals were added, of the
+# groups above them (see `resave.sum_totals`)
+STATS_KEY = "_ome2024_ngff_challenge_stats"
+
+# Columns appended to each row unless the input already has the first of them
+COLUMN_GROUPS = (
+    ("written", "written_human_readable"),
+    ("shape", "shards", "chunks", "dimension_names"),
+    ("license", "name", "description", "organismId", "fbbiId"),
+    ("images", "arrays", "objects", "bytes"),
+)
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge stats"
+    desc = f"""
+
+
+The `stats` subcommand reads a CSV file with a `url` column (or a single
+column of URLs) of converted filesets and appends the bytes written, the
+shape, shards and chunks of the first resolution level, and the RO-Crate
+license, name, description, organism and imaging modality of each one.
+
+The exact totals which `resave` stores on the top-level group are used when
+present. Otherwise the size of a plate is estimated from its first wells and
+that of a bioformats2raw fileset from its first series.
+
+Datasets are crawled concurrently over one pool of HTTP connections. Every
+finished row is appended to `<name>_temp.csv`, so an interrupted run can
+simply be restarted: URLs already in the temp file are not fetched again.
+The complete table is written to `<name>_output.csv` in the input order.
+
+With `--catalogue`, the statistics are kept in a local SQLite database along
+with the ETag and Last-Modified of each dataset's `zarr.json` and RO-Crate.
+Later runs send conditional requests for these two documents and only read
+the rest of a dataset again if either changed. `--export` writes everything
+in the catalogue as CSV or JSON (by its suffix).
+
+
+BASIC
+
+    Simplest example:                        {cmd} idr0004_samples.csv
+    Several files:                           {cmd} idr00*_samples.csv
+    Gentler on the server:                   {cmd} --datasets=4 --connections=8 idr0004_samples.csv
+    Start again from scratch:                {cmd} --restart idr0004_samples.csv
+
+CATALOGUE
+
+    Crawl into a catalogue:                  {cmd} --catalogue=catalogue.sqlite idr00*_samples.csv
+    Refresh it and export all datasets:      {cmd} --catalogue=catalogue.sqlite --export=datasets.json idr00*_samples.csv
+    Export without crawling:                 {cmd} --catalogue=catalogue.sqlite --export=datasets.csv
+
+    """
+    parser = subparsers.add_parser(
+        "stats",
+        help="collect size and metadata statistics for a CSV of dataset URLs",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main)
+    parser.add_argument(
+        "--datasets",
+        type=int,
+        default=16,
+        help="number of datasets crawled simultaneously",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=32,
+        help="maximum number of open HTTP connections",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="seconds to wait for a connection or for data before giving up on a request",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="ignore the rows of a previous run in the temp file (or the catalogue)",
+    )
+    parser.add_argument(
+        "--catalogue",
+        type=Path,
+        help="SQLite database in which datasets are stored and refreshed",
+    )
+    parser.add_argument(
+        "--export",
+        type=Path,
+        help="write all datasets of the catalogue to this .csv or .json file",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument("csv_files", nargs="*", type=Path)
+
+
+def format_bytes_human_readable(num_bytes):
+    unit = None
+    for u in ["B", "KB", "MB", "GB", "TB"]:
+        unit = u
+        if num_bytes < 1024.0:
+            break
+        num_bytes /= 1024.0
+    return f"{num_bytes:.2f} {unit}"
+
+
+def list_to_str(my_list):
+    if not my_list:
+        return ""
+    return ",".join(str(item) for item in my_list)
+
+
+def get_chunk_and_shard_shapes(zarray):
+    """Returns dict with 'shape', 'chunks' and 'shards' keys (if shards are present)"""
+    if "chunks" in zarray:
+        # For zarr v2 we just have chunks:
+        return {"chunks": zarray["chunks"], "shape": zarray["shape"]}
+    # For zarr v3 we check for sharding
+    # Based on https://github.com/zarr-developers/zarr-specs/blob/main/docs/v3/codecs/sharding-indexed/v1.0.rst#configuration-parameters
+    chunk_shape = (
+        zarray.get("chunk_grid", {}).get("configuration", {}).get("chunk_shape")
+    )
+    sharding_codecs = [
+        codec
+        for codec in zarray.get("codecs", [])
+        if codec.get("name") == "sharding_indexed"
+    ]
+    if sharding_codecs:
+        # if we have sharding, a 'chunk' is the sub-chunk of a shard
+        sub_chunks = sharding_codecs[0].get("configuration", {}).get("chunk_shape")
+        if sub_chunks:
+            return {
+                "chunks": sub_chunks,
+                "shards": chunk_shape,
+                "shape": zarray.get("shape"),
+            }
+    return {"chunks": chunk_shape, "shape": zarray.get("shape")}
+
+
+class Crawler:
+    """
+    Collects the statistics of datasets over a shared `aiohttp` session.
+    All documents of a dataset which do not depend on each other (e.g. the
+    `zarr.json` of every resolution level) are requested at the same time.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+
+    async def fetch(
+        self, url: str, headers: dict | None = None
+    ) -> tuple[int, dict, str | None, str | None]:
+        """
+        Returns the status, the JSON body ({} unless successful), the ETag
+        and the Last-Modified header of the response for `url`. The status
+        is 0 if no valid response was received.
+        """
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                body = {}
+                if response.status // 100 == 2:
+                    body = await response.json(content_type=None)
+                else:
+                    LOGGER.debug(f"{url}: HTTP {response.status}")
+                return (
+                    response.status,
+                    body,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            LOGGER.debug(f"{url}: {e!r}")
+            return 0, {}, None, None
+
+    async def load_json(self, url: str) -> dict:
+        return (await self.fetch(url))[1]
+
+    async def exists(self, url: str) -> bool:
+        try:
+            async with self.session.head(url) as response:
+                return response.status // 100 == 2
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def get_array_values(
+        self, zarr_url: str, multiscales: list | None, levels: int | None = None
+    ) -> dict:
+        # we want chunks, shards, shape from first resolution level...
+        # but we want total 'written' bytes for all resolutions...
+        if not multiscales:
+            return {}
+        datasets = multiscales[0].get("datasets", [])[:levels]
+        arrays = await asyncio.gather(
+            *(self.load_json(f"{zarr_url}/{ds['path']}/zarr.json") for ds in datasets)
+        )
+        dict_data: dict = {}
+        for level, array_json in enumerate(arrays):
+            if level == 0:
+                dict_data = get_chunk_and_shard_shapes(array_json)
+                dict_data["written"] = 0
+            stats = array_json.get("attributes", {}).get(STATS_KEY, {})
+            dict_data["written"] += stats.get("written", 0)
+            dict_data["dimension_names"] = array_json.get("dimension_names", "")
+        return dict_data
+
+    async def load_series(self, zarr_url: str) -> list:
+        # Load series from METADATA.ome.xml if available or /OME/zarr.json
+        if not await self.exists(zarr_url + "/OME/METADATA.ome.xml"):
+            series_json = await self.load_json(zarr_url + "/OME/zarr.json")
+            return series_json.get("attributes", {}).get("ome", {}).get("series", [])
+        # FIXME: parsing the OME-XML is not implemented yet!
+        return ["0"]
+
+    async def load_plate(
+        self, zarr_url: str, plate: dict, average_count: int, levels: int | None
+    ) -> dict:
+        # let's try to get average 'written' for the first wells...
+        async def load_field(well):
+            field_url = f"{zarr_url}/{well['path']}/0"
+            field_json = await self.load_json(field_url + "/zarr.json")
+            multiscales = field_json.get("attributes", {}).get("ome", {})
+            return await self.get_array_values(
+                field_url, multiscales.get("multiscales"), levels
+            )
+
+        fields = await asyncio.gather(
+            *(load_field(well) for well in plate["wells"][:average_count])
+        )
+        written_values = [f["written"] for f in fields if f.get("written", 0) > 0]
+        avg_written = sum(written_values) / len(written_values) if written_values else 0
+        image_count = len(plate["wells"]) * plate.get("field_count", 1)
+        stats = next((f for f in reversed(fields) if f), {})
+        # we want to return the total written bytes for all images...
+        stats["written"] = avg_written * image_count
+        return stats
+
+    async def load_zarr(self, zarr_url: str, average_count: int = 5) -> dict | None:
+        """
+        Returns the statistics of the dataset at `zarr_url` combined with
+        its RO-Crate fields, or None if its `zarr.json` cannot be loaded.
+        """
+        response, rocrate_json = await asyncio.gather(
+            self.load_json(zarr_url + "/zarr.json"),
+            self.load_json(zarr_url + "/ro-crate-metadata.json"),
+        )
+        return await self.parse(zarr_url, response, rocrate_json, average_count)
+
+    async def refresh(
+        self,
+        zarr_url: str,
+        average_count: int,
+        catalogue: Catalogue,
+        force: bool = False,
+    ) -> dict | None:
+        """
+        Like `load_zarr`, but the `zarr.json` and RO-Crate of the dataset are
+        requested conditionally and the statistics in the `catalogue` are
+        reused without further requests if neither changed.
+        """
+        urls = (zarr_url + "/zarr.json", zarr_url + "/ro-crate-metadata.json")
+        responses = await asyncio.gather(
+            *(
+                self.fetch(url, {} if force else catalogue.conditions(url))
+                for url in urls
+            )
+        )
+        documents = {
+            url: (status, etag, modified)
+            for url, (status, _, etag, modified) in zip(urls, responses)
+        }
+        (root_status, response, *_), (rocrate_status, rocrate_json, *_) = responses
+        if root_status // 100 != 2 and root_status != 304:
+            return None
+
+        cached = None if force else catalogue.stats(zarr_url)
+        if cached is not None and all(
+            catalogue.unchanged(url, status) for url, (status, *_) in documents.items()
+        ):
+            LOGGER.debug(f"{zarr_url}: not modified")
+            catalogue.store(zarr_url, None, documents)
+            return cached
+
+        # Only one of the documents changed (or the catalogue lost the stats)
+        if root_status == 304:
+            response = await self.load_json(urls[0])
+        if rocrate_status == 304:
+            rocrate_json = await self.load_json(urls[1])
+        stats = await self.parse(zarr_url, response, rocrate_json, average_count)
+        if stats is not None:
+            catalogue.store(zarr_url, stats, documents)
+        return stats
+
+    async def parse(
+        self, zarr_url: str, response: dict, rocrate_json: dict, average_count: int
+    ) -> dict | None:
+        """
+        Returns the statistics of the dataset with the root `zarr.json`
+        `response`, loading the arrays needed, or None if it is empty. The
+        "type" of the dataset and the path of its first "image" are included
+        for `publish`.
+        """
+        if not response:
+            return None
+        ome_json = response.get("attributes", {}).get("ome", {})
+        # With the totals of the whole fileset, only the first level of one
+        # image is needed for its shape, chunks and shards. Older totals do
+        # not include the bytes written, which are then added up as before.
+        totals = response.get("attributes", {}).get(STATS_KEY, {})
+        levels = None
+        if "written" in totals:
+            levels = average_count = 1
+        stats: dict = {}
+        kind, image = None, None
+        if "multiscales" in ome_json:
+            stats = await self.get_array_values(
+                zarr_url, ome_json["multiscales"], levels
+            )
+            kind, image = "image", ""
+        elif "plate" in ome_json:
+            stats = await self.load_plate(
+                zarr_url, ome_json["plate"], average_count, levels
+            )
+            kind = "plate"
+            if ome_json["plate"].get("wells"):
+                image = f"{ome_json['plate']['wells'][0]['path']}/0"
+        elif ome_json.get("bioformats2raw.layout"):
+            # let's just get the first image...
+            series = await self.load_series(zarr_url)
+            kind = "bioformats2raw"
+            if series:
+                image = str(series[0])
+                image_url = f"{zarr_url}/{image}"
+                image_json = await self.load_json(image_url + "/zarr.json")
+                multiscales = (
+                    image_json.get("attributes", {}).get("ome", {}).get("multiscales")
+                )
+                stats = await self.get_array_values(image_url, multiscales, levels)
+        stats["type"] = kind
+        stats["image"] = image
+        # "written" is always tensorstore's count, "bytes" those stored
+        if "written" in totals:
+            stats["written"] = totals["written"]
+        if "bytes" in totals:
+            stats.update({key: totals.get(key) for key in COLUMN_GROUPS[3]})
+        # combine the stats with the rocrate data...
+        stats.update(rocrate_fields(rocrate_json))
+        return stats
+
+
+def rocrate_fields(rocrate_json: dict) -> dict:
+    # Try to find various fields in the Ro-Crate metadata
+    fields = dict.fromkeys(COLUMN_GROUPS[2])
+    for item in rocrate_json.get("@graph", []):
+        if item.get("license"):
+            fields["license"] = item["license"]
+        if item.get("name"):
+            fields["name"] = item["name"]
+        if item.get("description"):
+            fields["description"] = item["description"]
+        if item.get("@type") == "biosample":
+            fields["organismId"] = item.get("organism_classification", {}).get("@id")
+        if item.get("@type") == "image_acquisition":
+            fields["fbbiId"] = item.get("fbbi_id", {}).get("@id")
+    return fields
+
+
+def missing_columns(column_names: list[str]) -> list[str]:
+    return [
+        name
+        for group in COLUMN_GROUPS
+        if group[0] not in column_names
+        for name in group
+    ]
+
+
+def stats_values(stats: dict, columns: list[str]) -> list:
+    """
+    The values of the `missing_columns` for a row
+    """
+    written = stats.get("written", 0)
+    values = {
+        "written": written,
+        "written_human_readable": format_bytes_human_readable(written),
+        "shape": list_to_str(stats.get("shape", "")),
+        "shards": list_to_str(stats.get("shards", "")),
+        "chunks": list_to_str(stats.get("chunks", "")),
+        "dimension_names": list_to_str(stats.get("dimension_names", "")),
+    }
+    return [
+        values[name] if name in values else stats.get(name) or "" for name in columns
+    ]
+
+
+def read_input(csv_name: Path) -> tuple[list[str], int, dict[str, list[str]]]:
+    """
+    Returns the column names, the index of the url column and the rows of
+    `csv_name` by URL, dropping duplicate URLs and links to other CSV files.
+    """
+    column_names: list[str] = []
+    url_col = None
+    rows: dict[str, list[str]] = {}
+    with csv_name.open(newline="") as csvfile:
+        for row in csv.reader(csvfile, delimiter=","):
+            if len(row) == 0:
+                continue
+            if url_col is None:
+                # search for url column and skip row if found
+                if "url" in row:
+                    column_names = row
+                    url_col = row.index("url")
+                    continue
+                column_names = ["url"]
+                url_col = 0
+            zarr_url = row[url_col]
+            if zarr_url.endswith(".csv") or zarr_url in rows:
+                continue
+            rows[zarr_url] = row
+    return column_names, url_col or 0, rows
+
+
+def read_previous(
+    temp_csv: Path, url_col: int, rows: dict[str, list[str]], extra: int
+) -> dict[str, list[str]]:
+    """
+    Returns the completed rows of an earlier run, ignoring any which are
+    not for an input URL or were cut short.
+    """
+    done: dict[str, list[str]] = {}
+    if not temp_csv.exists():
+        return done
+    with temp_csv.open(newline="") as csvfile:
+        for row in csv.reader(csvfile, delimiter=","):
+            if len(row) <= url_col or row[url_col] not in rows:
+                continue
+            if len(row) == len(rows[row[url_col]]) + extra:
+                done[row[url_col]] = row
+    return done
+
+
+async def crawl(
+    todo: list[tuple[str, list[str]]],
+    average_count: int,
+    columns: list[str],
+    temp_csv: Path | None,
+    catalogue: Catalogue | None,
+    ns: argparse.Namespace,
+) -> dict[str, list[str] | None]:
+    """
+    Crawl the `todo` URLs with at most `ns.datasets` in progress and
+    `ns.connections` connections open. Rows are appended to `temp_csv` (if
+    given) as they complete; the returned dict holds None for URLs which
+    failed. With a `catalogue`, datasets are refreshed (see `refresh`).
+    """
+    semaphore = asyncio.Semaphore(max(1, ns.datasets))
+    connector = aiohttp.TCPConnector(limit=max(1, ns.connections), ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(sock_connect=ns.timeout, sock_read=ns.timeout)
+    results: dict[str, list[str] | None] = {}
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        crawler = Crawler(session)
+
+        async def process(zarr_url: str, row: list[str]):
+            async with semaphore:
+                if catalogue is None:
+                    stats = await crawler.load_zarr(zarr_url, average_count)
+                else:
+                    stats = await crawler.refresh(
+                        zarr_url, average_count, catalogue, ns.restart
+                    )
+                return zarr_url, row, stats
+
+        tasks = [process(zarr_url, row) for zarr_url, row in todo]
+        with contextlib.ExitStack() as stack:
+            progress = stack.enter_context(
+                tqdm.tqdm(total=len(tasks), unit="dataset", ncols=80)
+            )
+            outfile = None
+            if temp_csv is not None:
+                outfile = stack.enter_context(temp_csv.open("a", newline=""))
+                csvwriter = csv.writer(
+                    outfile, delimiter=",", quoting=csv.QUOTE_MINIMAL
+                )
+            for task in asyncio.as_completed(tasks):
+                zarr_url, row, stats = await task
+                progress.update()
+                if stats is None:
+                    LOGGER.error(f"failed to load {zarr_url}/zarr.json")
+                    results[zarr_url] = None
+                    continue
+                results[zarr_url] = [*row, *stats_values(stats, columns)]
+                if outfile is not None:
+                    # in case of failure mid-way, we write as we go...
+                    csvwriter.writerow(results[zarr_url])
+                    outfile.flush()
+    return results
+
+
+def process_csv(
+    csv_name: Path, catalogue: Catalogue | None, ns: argparse.Namespace
+) -> int:
+    """
+    Write `<name>_output.csv` for `csv_name` and return the number of
+    datasets which could not be loaded.
+
+    Without a `catalogue`, rows of an earlier run found in the temp file
+    are reused as they are. With one, every dataset is refreshed instead.
+    """
+    column_names, url_col, rows = read_input(csv_name)
+    columns = missing_columns(column_names)
+    average_count = 5 if "written" not in column_names else 1
+
+    output_csv = csv_name.with_name(csv_name.stem + "_output.csv")
+    temp_csv = None
+    done: dict[str, list[str] | None] = {}
+    if catalogue is None:
+        temp_csv = csv_name.with_name(csv_name.stem + "_temp.csv")
+        if ns.restart:
+            temp_csv.unlink(missing_ok=True)
+        done.update(read_previous(temp_csv, url_col, rows, len(columns)))
+    todo = [(url, row) for url, row in rows.items() if url not in done]
+    LOGGER.info(f"{csv_name}: {len(done)} done, {len(todo)} to crawl")
+
+    if columns and todo:
+        done.update(
+            asyncio.run(crawl(todo, average_count, columns, temp_csv, catalogue, ns))
+        )
+    failed = [url for url, row in done.items() if row is None]
+
+    # write the final output csv file...
+    with output_csv.open("w", newline="") as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=",", quoting=csv.QUOTE_MINIMAL)
+        csvwriter.writerow([*column_names, *columns])
+        for zarr_url, row in rows.items():
+            csvwriter.writerow(done.get(zarr_url) or [*row, *stats_values({}, columns)])
+    return len(failed)
+
+
+def export(catalogue: Catalogue, path: Path) -> None:
+    """
+    Write all datasets in the `catalogue` to `path` as JSON (for a ".json"
+    suffix) or CSV, with the check and change times in UTC.
+    """
+
+    def isoformat(timestamp: float) -> str:
+        return datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc
+        ).isoformat(timespec="seconds")
+
+    items = list(catalogue.items())
+    if path.suffix == ".json":
+        records = [
+            {
+                "url": url,
+                **stats,
+                "checked": isoformat(checked),
+                "changed": isoformat(changed),
+            }
+            for url, checked, changed, stats in items
+        ]
+        path.write_text(json.dumps(records, indent=1))
+    else:
+        columns = missing_columns([])
+        with path.open("w", newline="") as csvfile:
+            csvwriter = csv.writer(csvfile, delimiter=",", quoting=csv.QUOTE_MINIMAL)
+            csvwriter.writerow(["url", *columns, "checked", "changed"])
+            for url, checked, changed, stats in items:
+                csvwriter.writerow(
+                    [
+                        url,
+                        *stats_values(stats, columns),
+                        isoformat(checked),
+                        isoformat(changed),
+                    ]
+                )
+    LOGGER.info(f"exported {len(items)} datasets to {path}")
+
+
+def main(ns: argparse.Namespace) -> None:
+    """
+    Raises SystemExit if any dataset could not be loaded. These are not
+    recorded in the temp file or catalogue and will be retried by the next
+    run.
+    """
+    configure_logging(ns, LOGGER)
+    if not ns.csv_files and not ns.export:
+        message = "Provide CSV files to process or --export"
+        raise SystemExit(message)
+    if ns.export and not ns.catalogue:
+        message = "--export needs a --catalogue"
+        raise SystemExit(message)
+
+    catalogue = Catalogue(ns.catalogue) if ns.catalogue else None
+    failed = 0
+    try:
+        for csv_name in ns.csv_files:
+            failed += process_csv(csv_name, catalogue, ns)
+        if ns.export:
+            export(catalogue, ns.export)
+    finally:
+        if catalogue is not None:
+            catalogue.close()
+    if failed:
+        message = f"{failed} datasets could not be loaded"
+        raise SystemExit(message)
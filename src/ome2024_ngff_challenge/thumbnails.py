@@ -0,0 +1,206 @@
+"""
+Rendering of small RGB previews of OME-Zarr images. Only numpy is needed:
+PNG files are encoded here rather than with an imaging library.
+"""
+
+from __future__ import annotations
+
+import math
+import struct
+import zlib
+
+import numpy as np
+
+# Channel colors used when no "omero" metadata is available
+DEFAULT_COLORS = ("FF0000", "00FF00", "0000FF")
+
+
+def plane_selection(
+    shape: list[int], axes: list[str], size: int
+) -> tuple[tuple, list[str]]:
+    """
+    Returns the index selecting the first timepoint, the middle Z plane and
+    every channel of an array with `shape` and `axes`, with Y and X strided
+    so that the longer side is at most about `size` pixels, and the names of
+    the dimensions kept.
+    """
+    step = max(1, math.ceil(max(shape[-2:]) / size))
+    selection: list = []
+    kept = []
+    for axis, n in zip(axes, shape):
+        if axis == "t":
+            selection.append(0)
+        elif axis == "z":
+            selection.append(n // 2)
+        elif axis in ("y", "x"):
+            selection.append(slice(None, None, step))
+            kept.append(axis)
+        else:
+            selection.append(slice(None))
+            kept.append(axis)
+    return tuple(selection), kept
+
+
+def channel_settings(
+    count: int, omero: dict | None, planes: np.ndarray
+) -> list[tuple[int, np.ndarray, float, float]]:
+    """
+    Returns (index, RGB color, start, end) for up to three channels: the
+    active channels of the "omero" metadata with their windows, otherwise
+    the first channels scaled to their 0.1 and 99.9 percentiles.
+    """
+    channels = (omero or {}).get("channels", [])
+    if len(channels) != count:
+        channels = [{} for _ in range(count)]
+    active = [i for i, c in enumerate(channels) if c.get("active", True)] or [0]
+    settings = []
+    for n, i in enumerate(active[:3]):
+        channel = channels[i]
+        default = "FFFFFF" if count == 1 else DEFAULT_COLORS[n]
+        color = channel.get("color", default)
+        rgb = np.array([int(color[j : j + 2], 16) / 255 for j in (0, 2, 4)])
+        window = channel.get("window", {})
+        if "start" in window and "end" in window and window["end"] > window["start"]:
+            start, end = window["start"], window["end"]
+        else:
+            start, end = np.percentile(planes[i], (0.1, 99.9))
+        settings.append((i, rgb, float(start), float(end)))
+    return settings
+
+
+def render(data: np.ndarray, kept: list[str], omero: dict | None = None) -> np.ndarray:
+    """
+    Blend the channels of `data`, selected with `plane_selection`, into an
+    8-bit RGB image of shape (y, x, 3).
+    """
+    planes = data.astype(np.float32)
+    if "c" in kept:
+        planes = np.moveaxis(planes, kept.index("c"), 0)
+    else:
+        planes = planes[np.newaxis]
+    planes = planes.reshape(planes.shape[0], *planes.shape[-2:])
+    rgb = np.zeros((*planes.shape[1:], 3), dtype=np.float32)
+    for index, color, start, end in channel_settings(len(planes), omero, planes):
+        scaled = np.clip((planes[index] - start) / max(end - start, 1e-6), 0, 1)
+        rgb += scaled[..., np.newaxis] * color
+    return (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+
+def encode_png(rgb: np.ndarray) -> bytes:
+    """
+    Encode an 8-bit (y, x, 3) array as PNG
+    """
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        crc = zlib.crc32(tag + data) & 0xFFFFFFFF
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+    height, width, _ = rgb.shape
+    # Each row starts with filter type 0 (none)
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, width * 3)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(rows.tobytes(), 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def lowest_value(dtype: np.dtype):
+    if dtype.kind == "f":
+        return np.finfo(dtype).min
+    if dtype.kind in "iu":
+        return np.iinfo(dtype).min
+    return 0
+
+
+class PreviewAccumulator:
+    """
+    Assembles the thumbnail selected by `plane_selection` and, optionally,
+    the maximum intensity projections along Z (of the first timepoint) and
+    T (of the middle Z plane) from the blocks of an array as they are
+    converted, so that no extra reads are needed.
+
+    Blocks may arrive in any order and more than once (e.g. when retried).
+    Regions which are never added are rendered as the fill value 0.
+    """
+
+    def __init__(
+        self, shape: list[int], axes: list[str], size: int, projections: bool = False
+    ):
+        self.shape = list(shape)
+        self.axes = list(axes)
+        step = max(1, math.ceil(max(self.shape[-2:]) / size))
+        self.steps = [step if axis in ("y", "x") else 1 for axis in self.axes]
+        _, self.kept = plane_selection(self.shape, self.axes, size)
+        self.reduced: dict[str, int | None] = {"thumbnail": None}
+        if projections:
+            for axis in ("z", "t"):
+                if axis in self.axes and self.shape[self.axes.index(axis)] > 1:
+                    self.reduced[f"max_{axis}"] = self.axes.index(axis)
+        self.targets: dict[str, tuple[dict[int, int], np.ndarray]] | None = None
+
+    def _allocate(self, dtype: np.dtype) -> None:
+        kept_shape = [
+            -(-n // step)
+            for axis, n, step in zip(self.axes, self.shape, self.steps)
+            if axis not in ("t", "z")
+        ]
+        self.targets = {}
+        for name, reduced in self.reduced.items():
+            fixed = {}
+            for i, (axis, n) in enumerate(zip(self.axes, self.shape)):
+                if i != reduced and axis in ("t", "z"):
+                    fixed[i] = 0 if axis == "t" else n // 2
+            initial = 0 if reduced is None else lowest_value(dtype)
+            self.targets[name] = (fixed, np.full(kept_shape, initial, dtype=dtype))
+
+    def add(self, selection: tuple[slice, ...], data: np.ndarray) -> None:
+        """
+        Record the `data` of the block at `selection`
+        """
+        if self.targets is None:
+            self._allocate(data.dtype)
+        for name, (fixed, target) in self.targets.items():
+            reduced = self.reduced[name]
+            index: list = []
+            where = []
+            for i, s in enumerate(selection):
+                if i in fixed:
+                    if not s.start <= fixed[i] < s.stop:
+                        break
+                    index.append(fixed[i] - s.start)
+                elif i == reduced:
+                    index.append(slice(None))
+                else:
+                    step = self.steps[i]
+                    first = -(-s.start // step) * step
+                    if first >= s.stop:
+                        break
+                    index.append(slice(first - s.start, None, step))
+                    where.append(slice(first // step, (s.stop - 1) // step + 1))
+            else:
+                values = data[tuple(index)]
+                if reduced is None:
+                    target[tuple(where)] = values
+                else:
+                    region = target[tuple(where)]
+                    axis = reduced - sum(i < reduced for i in fixed)
+                    np.maximum(region, values.max(axis=axis), out=region)
+
+    def images(self, omero: dict | None = None) -> dict[str, np.ndarray]:
+        """
+        Returns the RGB rendering (see `render`) of the thumbnail and of each
+        projection by name.
+        """
+        if self.targets is None:
+            self._allocate(np.dtype(np.uint8))
+        rendered = {}
+        for name, (_, target) in self.targets.items():
+            planes = target
+            if self.reduced[name] is not None:
+                planes = np.where(target == lowest_value(target.dtype), 0, target)
+            rendered[name] = render(planes, self.kept, omero)
+        return rendered
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import tqdm
+
+from .resave import NGFF_VERSION, add_rocrate_arguments, rocrate_writer
+from .utils import (
+    Config,
+    add_creator,
+    add_store_arguments,
+    configure_logging,
+    strip_version,
+)
+
+LOGGER = logging.getLogger(__file__)
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge update"
+    desc = f"""
+
+
+The `update` subcommand rewrites the metadata of a fileset previously
+converted with `resave` without touching any array data:
+
+    - `ro-crate-metadata.json` is regenerated, keeping the name, description,
+      license, organism and modality it lists unless they are given as
+      RO-Crate arguments
+    - the "ome" attributes in the `zarr.json` of every group (image, plate,
+      well, labels) are normalized to version {NGFF_VERSION} and the
+      `_creator` information is refreshed
+
+Plates are updated one well per thread.
+
+
+BASIC
+
+    Change the license:                      {cmd} --cc0 out.zarr
+    Add an organism and modality:            {cmd} --rocrate-organism=NCBI:txid9606 --rocrate-modality=obo:FBbi_00000369 out.zarr
+    Only refresh the zarr.json attributes:   {cmd} --rocrate-skip out.zarr
+    Update a fileset on S3:                  {cmd} --cc-by --output-bucket=bucket --output-endpoint=https://s3.example.com path/out.zarr
+
+    """
+    parser = subparsers.add_parser(
+        "update",
+        help="update the RO-Crate and OME metadata of a converted fileset",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main, output_overwrite=False)
+    add_store_arguments(parser, "output")
+    add_rocrate_arguments(parser)
+    parser.add_argument(
+        "--conversion-notes",
+        help="replace the free-text notes stored in `_creator`",
+    )
+    parser.add_argument(
+        "--output-threads",
+        type=int,
+        default=16,
+        help="number of wells or images updated simultaneously",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument("output_path", type=Path)
+
+
+def parse(ns: argparse.Namespace):
+    """
+    Parse the namespace arguments provided by the dispatcher
+    """
+    configure_logging(ns, LOGGER)
+
+
+def join(*parts: str | Path) -> str:
+    return "/".join(str(p) for p in parts if str(p))
+
+
+class Updater:
+    """
+    Walks the groups of a converted hierarchy, reading and rewriting only
+    their `zarr.json` documents. Array metadata is never written.
+    """
+
+    def __init__(self, config: Config, notes: str | None):
+        self.config = config
+        self.notes = notes
+
+    def read_group(self, path: str) -> dict:
+        key = join(path, "zarr.json")
+        metadata = self.config.zr_read_json(key)
+        if metadata is None:
+            msg = f"no zarr.json found at {self.config}/{path}"
+            raise ValueError(msg)
+        if metadata.get("node_type") != "group":
+            msg = f"{self.config}/{key} is not a group"
+            raise ValueError(msg)
+        return metadata
+
+    def update_group(self, path: str) -> tuple[dict, bool]:
+        """
+        Returns the "ome" attributes of the group at `path` after updating
+        them, and whether the `zarr.json` was rewritten.
+        """
+        metadata = self.read_group(path)
+        ome = metadata.get("attributes", {}).get("ome")
+        if ome is None:
+            return {}, False
+        before = json.dumps(ome, sort_keys=True)
+        for value in ome.values():
+            # ...replaces all other versions - remove
+            strip_version(value)
+            if isinstance(value, list):
+                for item in value:
+                    strip_version(item)
+        if "version" in ome:
+            ome["version"] = NGFF_VERSION
+        if "_creator" in ome:
+            notes = self.notes or ome["_creator"].get("notes")
+            add_creator(ome, notes)
+        changed = json.dumps(ome, sort_keys=True) != before
+        if changed:
+            self.config.zr_write_text(join(path, "zarr.json"), json.dumps(metadata))
+            LOGGER.debug(f"updated {self.config}/{path}")
+        return ome, changed
+
+    def update_image(self, path: str) -> int:
+        """
+        Update an image group and its labels, returning the number of
+        rewritten groups.
+        """
+        _, changed = self.update_group(path)
+        updated = int(changed)
+        labels_path = join(path, "labels")
+        if self.config.zr_exists(join(labels_path, "zarr.json")):
+            labels, changed = self.update_group(labels_path)
+            updated += changed
+            for label in labels.get("labels", []):
+                updated += self.update_image(join(labels_path, label))
+        return updated
+
+    def update_well(self, path: str) -> int:
+        well, changed = self.update_group(path)
+        updated = int(changed)
+        for image in well["well"]["images"]:
+            updated += self.update_image(join(path, image["path"]))
+        return updated
+
+    def series(self) -> list[str]:
+        """
+        The image paths of a bioformats2raw layout, either from the "OME"
+        group or, since `resave` only copies the OME-XML, by counting up
+        from "0" until no image is found.
+        """
+        if self.config.zr_exists("OME/zarr.json"):
+            ome, _ = self.update_group("OME")
+            return [str(path) for path in ome.get("series", [])]
+        paths: list[str] = []
+        while self.config.zr_exists(f"{len(paths)}/zarr.json"):
+            paths.append(str(len(paths)))
+        return paths
+
+    def run(self, threads: int) -> int:
+        """
+        Update the whole hierarchy and return the number of rewritten groups.
+        """
+        ome, changed = self.update_group("")
+        updated = int(changed)
+        if "plate" in ome:
+            paths = [well["path"] for well in ome["plate"]["wells"]]
+            task = self.update_well
+        elif "bioformats2raw.layout" in ome:
+            paths = self.series()
+            task = self.update_image
+        elif "multiscales" in ome:
+            return updated + self.update_image("")
+        else:
+            msg = f"no OME-Zarr metadata found at {self.config}"
+            raise ValueError(msg)
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for count in tqdm.tqdm(
+                pool.map(task, paths),
+                total=len(paths),
+                colour="green",
+                ncols=80,
+            ):
+                updated += count
+        return updated
+
+
+def crate_settings(crate: dict) -> dict[str, str]:
+    """
+    The values of the RO-Crate arguments (without the "rocrate_" prefix)
+    which were used to write the existing `crate`.
+    """
+    entities = crate.get("@graph", [])
+    root = next((e for e in entities if e.get("@id") == "./"), {})
+    settings = {key: root[key] for key in ("name", "description") if root.get(key)}
+    if isinstance(root.get("license"), str):
+        settings["license"] = root["license"]
+    for entity in entities:
+        types = entity.get("@type", [])
+        if "biosample" in types and "organism_classification" in entity:
+            settings["organism"] = entity["organism_classification"]["@id"]
+        if "image_acquisition" in types and "fbbi_id" in entity:
+            settings["modality"] = entity["fbbi_id"]["@id"]
+    return settings
+
+
+def crate_previews(crate: dict) -> list[str]:
+    """
+    The paths of the PNG previews listed in the existing `crate` (see
+    `resave --output-thumbnails`), with the thumbnail of the dataset first.
+    """
+    entities = crate.get("@graph", [])
+    paths = [
+        entity["@id"]
+        for entity in entities
+        if "ImageObject" in entity.get("@type", [])
+        and entity.get("encodingFormat") == "image/png"
+    ]
+    root = next((e for e in entities if e.get("@id") == "./"), {})
+    thumbnail = root.get("thumbnail", {}).get("@id")
+    if thumbnail in paths:
+        paths.remove(thumbnail)
+        paths.insert(0, thumbnail)
+    return paths
+
+
+def main(ns: argparse.Namespace) -> None:
+    parse(ns)
+    config = Config(ns, "output", "w")
+    if not config.zr_exists("zarr.json"):
+        message = f"no converted fileset found at {config}"
+        raise SystemExit(message)
+    crate = config.zr_read_json("ro-crate-metadata.json") or {}
+    if not ns.rocrate_skip:
+        # Only the metadata given on the command line is replaced
+        for key, value in crate_settings(crate).items():
+            if not getattr(ns, f"rocrate_{key}", None):
+                setattr(ns, f"rocrate_{key}", value)
+    ns.rocrate = rocrate_writer(ns)
+    updated = Updater(config, ns.conversion_notes).run(ns.output_threads)
+    if ns.rocrate is not None:
+        ns.rocrate.write(config, previews=crate_previews(crate))
+    LOGGER.info(f"updated {updated} groups in {config}")
@@ -2,20 +2,36 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import functools
 import itertools
 import json
 import logging
-import shutil
+import os
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from importlib.metadata import version as lib_version
 from pathlib import Path
 
 import numpy as np
 import tensorstore as ts
+import tqdm
 import zarr
 from zarr.api.synchronous import sync
 from zarr.buffer import Buffer, BufferPrototype
 
+from .cli_utils import (  # noqa: F401 (re-exported)
+    add_store_arguments,
+    configure_logging,
+    csv_int,
+)
+from .retry import RetryBudget, is_transient  # noqa: F401 (re-exported)
+
+LOGGER = logging.getLogger(__file__)
+
 
 class Batched:
     """
@@ -50,21 +66,6 @@ class SafeEncoder(json.JSONEncoder):
             return str(o)
 
 
-def configure_logging(ns: argparse.Namespace, logger: logging.Logger):
-    if ns.log.upper() == "TRACE":
-        numeric_level = 5
-    else:
-        numeric_level = getattr(logging, ns.log.upper(), None)
-    if not isinstance(numeric_level, int):
-        raise ValueError(f"Invalid log level: {ns.log}. Use 'info' or 'debug'")
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
-    logger.setLevel(numeric_level)
-
-
 def guess_shards(shape: list, chunks: list):
     """
     Method to calculate best shard sizes. These values can be written to
@@ -98,22 +99,6 @@ def chunk_iter(shape: list, chunks: list):
     return tuple(itertools.product(*chunk_iters))
 
 
-def csv_int(vstr, sep=",") -> list:
-    """Convert a string of comma separated values to integers
-    @returns iterable of floats
-    """
-    values = []
-    for v0 in vstr.split(sep):
-        try:
-            v = int(v0)
-            values.append(v)
-        except ValueError as ve:
-            raise argparse.ArgumentError(
-                message=f"Invalid value {v0}, values must be a number"
-            ) from ve
-    return values
-
-
 def strip_version(possible_dict) -> None:
     """
     If argument is a dict with the key "version", remove it
@@ -122,9 +107,15 @@ def strip_version(possible_dict) -> None:
         del possible_dict["version"]
 
 
+@functools.lru_cache(maxsize=1)
+def package_version() -> str:
+    """The installed version, looked up once rather than per image"""
+    return lib_version("ome2024-ngff-challenge")
+
+
 def add_creator(json_dict: dict, notes: str | None = None) -> None:
     # Add _creator - NB: this will overwrite any existing _creator info
-    pkg_version = lib_version("ome2024-ngff-challenge")
+    pkg_version = package_version()
     json_dict["_creator"] = {
         "name": "ome2024-ngff-challenge",
         "version": pkg_version,
@@ -134,6 +125,74 @@ def add_creator(json_dict: dict, notes: str | None = None) -> None:
         json_dict["_creator"]["notes"] = notes
 
 
+class BackgroundDelete(threading.Thread):
+    """
+    Renames a local directory to a hidden sibling ("trash") location, which
+    is a single atomic operation, and then deletes the trash in a
+    background thread so that a new conversion can start immediately.
+    Files are unlinked by a pool of `threads` workers, one directory at a
+    time, before the emptied directories are removed deepest first.
+
+    Trash left behind by an earlier process which died while deleting
+    (".<name>.trash-*" next to `path`) is deleted as well.
+    """
+
+    def __init__(self, path: Path, threads: int = 16):
+        super().__init__(name=f"delete-{path.name}")
+        self.stale = sorted(path.parent.glob(f".{path.name}.trash-*"))
+        self.trash = path.with_name(f".{path.name}.trash-{uuid.uuid4().hex[:8]}")
+        self.threads = threads
+        self.error: OSError | None = None
+        path.rename(self.trash)
+        LOGGER.info(f"moved {path} to {self.trash} for deletion")
+        if self.stale:
+            LOGGER.info(f"deleting stale {', '.join(map(str, self.stale))}")
+        self.start()
+
+    def run(self):
+        for trash in [self.trash, *self.stale]:
+            try:
+                self.delete(trash)
+            except OSError as ose:
+                self.error = ose
+
+    def delete(self, trash: Path) -> None:
+        directories = []
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            futures = []
+            for root, _, files in os.walk(trash):
+                directories.append(root)
+                if files:
+                    futures.append(pool.submit(_unlink_all, root, files))
+            for future in futures:
+                future.result()
+        for directory in reversed(directories):
+            Path(directory).rmdir()
+
+    def wait(self) -> None:
+        if self.is_alive():
+            LOGGER.info(f"waiting for deletion of {self.trash}")
+        self.join()
+        if self.error is not None:
+            LOGGER.warning(f"could not delete all of {self.trash}: {self.error}")
+
+
+def _unlink_all(root: str, files: list[str]) -> None:
+    for name in files:
+        os.unlink(os.path.join(root, name))  # noqa: PTH108,PTH118
+
+
+async def _bulk_delete(fs, batches: list[list[str]], concurrency: int, progress):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def delete(batch):
+        async with semaphore:
+            await fs._bulk_delete(batch)
+        progress.update(len(batch))
+
+    await asyncio.gather(*(delete(batch) for batch in batches))
+
+
 class TextBuffer(Buffer):
     """
     Zarr Buffer implementation that simplify saves text at a given location.
@@ -196,7 +255,10 @@ class TSMetrics:
                 rv = v[0]["value"]
                 break
         if rv is None:
-            raise Exception(f"unknown key: {key} from {self.data}")
+            # Metrics are only registered once first used, e.g. on the
+            # first write of a given kvstore driver.
+            LOGGER.debug(f"unknown key: {key}")
+            rv = 0
 
         orig = self.start.value(key) if self.start is not None else 0
 
@@ -212,32 +274,79 @@ class TSMetrics:
         return self.start is not None and (self.time - self.start.time) or self.time
 
 
+@dataclass
+class StoreSettings:
+    """
+    Location and S3 settings of an input or output hierarchy, i.e. the values
+    of the `--{input,output}-*` arguments for use without argparse.
+    """
+
+    path: Path
+    bucket: str | None = None
+    endpoint: str | None = None
+    anon: bool = False
+    region: str = "us-east-1"
+    overwrite: bool = False
+
+    @classmethod
+    def of(cls, value: StoreSettings | str | Path) -> StoreSettings:
+        """Accept a local path in place of settings"""
+        return value if isinstance(value, StoreSettings) else cls(Path(value))
+
+    @classmethod
+    def from_namespace(cls, ns: argparse.Namespace, selection: str) -> StoreSettings:
+        return cls(
+            path=Path(getattr(ns, f"{selection}_path")),
+            bucket=getattr(ns, f"{selection}_bucket"),
+            endpoint=getattr(ns, f"{selection}_endpoint"),
+            anon=getattr(ns, f"{selection}_anon"),
+            region=getattr(ns, f"{selection}_region"),
+            overwrite=selection == "output" and ns.output_overwrite,
+        )
+
+    def cache_key(self) -> str:
+        """Identifies the hierarchy for the MetadataCache"""
+        if self.bucket:
+            return f"{self.endpoint or ''}/{self.bucket}/{self.path}"
+        return str(self.path.resolve())
+
+
 class Config:
     """
     Filesystem and S3 configuration information for both tensorstore and zarr-python
+
+    The settings are either taken from the parsed command-line arguments for
+    `selection` ("input" or "output") or passed in as `StoreSettings`. All
+    sub-configurations share the same metadata `cache` (inputs only) and
+    tensorstore `context`.
     """
 
     def __init__(
         self,
-        ns: argparse.Namespace,
+        ns: argparse.Namespace | StoreSettings,
         selection: str,
         mode: str,
         subpath: Path | str | None = None,
+        cache=None,
+        context: ts.Context | None = None,
     ):
-        self.ns = ns
+        if not isinstance(ns, StoreSettings):
+            ns = StoreSettings.from_namespace(ns, selection)
+        self.settings = ns
         self.selection = selection
         self.mode = mode
         self.subpath = None if not subpath else Path(subpath)
 
-        self.overwrite = False
-        if selection == "output":
-            self.overwrite = ns.output_overwrite
+        self.overwrite = ns.overwrite if selection == "output" else False
+        self.path = ns.path
+        self.anon = ns.anon
+        self.bucket = ns.bucket
+        self.endpoint = ns.endpoint
+        self.region = ns.region
 
-        self.path = getattr(ns, f"{selection}_path")
-        self.anon = getattr(ns, f"{selection}_anon")
-        self.bucket = getattr(ns, f"{selection}_bucket")
-        self.endpoint = getattr(ns, f"{selection}_endpoint")
-        self.region = getattr(ns, f"{selection}_region")
+        # Only input metadata is cached; see MetadataCache
+        self.cache = cache if selection == "input" else None
+        self.context = context
 
         if self.bucket:
             self.ts_store = {
@@ -298,6 +407,22 @@ class Config:
             return "default"
         return ""
 
+    def cli_args(self) -> list[str]:
+        """
+        Returns the command-line arguments needed to recreate the store
+        configuration (but not the path) of this instance, e.g. for scripts.
+        """
+        args = []
+        if self.is_s3():
+            args.append(f"--{self.selection}-bucket={self.bucket}")
+            if self.endpoint:
+                args.append(f"--{self.selection}-endpoint={self.endpoint}")
+            if self.anon:
+                args.append(f"--{self.selection}-anon")
+            if self.region:
+                args.append(f"--{self.selection}-region={self.region}")
+        return args
+
     def __str__(self):
         if self.is_s3():
             return self.s3_string()
@@ -308,39 +433,87 @@ class Config:
             f"Config<{self.__str__()}, {self.selection}, {self.mode}, {self.overwrite}>"
         )
 
-    def check_or_delete_path(self):
-        # If this is local, then delete.
+    def check_or_delete_path(self) -> BackgroundDelete | None:
+        """
+        Refuse to continue if the output exists, unless overwriting. Local
+        directories are deleted in the background; the returned
+        `BackgroundDelete` (if any) should be waited on before exiting.
+        """
         if self.bucket:
-            raise Exception(f"bucket set ({self.bucket}). Refusing to delete.")
+            # Writing to an empty prefix needs no deletion
+            if not self.zr_exists():
+                return None
+            if not self.overwrite:
+                raise Exception(f"{self} exists. Use --output-overwrite to overwrite")
+            self.s3_delete_prefix()
+            return None
+
+        # If this is local, then delete.
 
         if self.path.exists():
             # TODO: This should really be an option on zarr-python
             # as with tensorstore.
             if self.overwrite:
-                if self.path.is_file():
-                    self.path.unlink()
-                else:
-                    shutil.rmtree(self.path)
+                if not self.path.is_file():
+                    return BackgroundDelete(self.path)
+                self.path.unlink()
             else:
                 raise Exception(
                     f"{self.path} exists. Use --output-overwrite to overwrite"
                 )
+        return None
+
+    def s3_delete_prefix(self, batch_size: int = 1000, concurrency: int = 32):
+        """
+        Delete every object below the output prefix using multi-object delete
+        requests of up to `batch_size` keys, `concurrency` of which are in
+        flight at once. Only keys strictly below "{bucket}/{path}/" are
+        touched so that neither the bucket root nor sibling prefixes sharing
+        the same name (e.g. "out.zarr2") can be removed.
+        """
+        path = self.fs_string().strip("/")
+        if path in ("", "."):
+            raise Exception(f"refusing to delete the root of bucket {self.bucket}")
+        prefix = f"{self.bucket}/{path}/"
+        fs = self.zr_store._fs
+
+        # Note: calls must go through the zarr event loop which owns the session
+        keys = [k for k in sync(fs._find(prefix)) if k.startswith(prefix)]
+        LOGGER.info(f"deleting {len(keys)} objects below s3://{prefix}")
+        batches = [keys[i : i + batch_size] for i in range(0, len(keys), batch_size)]
+        with tqdm.tqdm(total=len(keys), unit="obj", ncols=80) as progress:
+            sync(_bulk_delete(fs, batches, concurrency, progress))
+        fs.invalidate_cache(prefix)
+
+        remaining = sync(fs._find(prefix))
+        if remaining:
+            raise Exception(f"{len(remaining)} objects could not be deleted: {prefix}")
 
     def open_group(self):
+        if self.cache is not None:
+            # Read the v2 metadata directly so that it can be served from the cache
+            if self.zr_read_text(".zgroup") is None:
+                raise ValueError(f"no group found at {self}")
+            self.zr_attrs = self.zr_read_json(".zattrs") or {}
+            return
         # Needs zarr_format=2 or we get ValueError("store mode does not support writing")
         self.zr_group = zarr.open_group(store=self.zr_store, zarr_format=2)
         self.zr_attrs = self.zr_group.attrs
 
     def create_group(self):
-        self.zr_group = zarr.Group.create(self.zr_store)
+        # Note: the default `attributes` dict is shared by all groups created
+        # without one, so later updates would leak between groups
+        self.zr_group = zarr.Group.create(self.zr_store, attributes={})
         self.zr_attrs = self.zr_group.attrs
 
     def sub_config(self, subpath: str, create_or_open_group: bool = True):
         sub = Config(
-            self.ns,
+            self.settings,
             self.selection,
             self.mode,
             subpath if not self.subpath else self.subpath / subpath,
+            cache=self.cache,
+            context=self.context,
         )
         if create_or_open_group:
             if sub.selection == "input":
@@ -352,14 +525,60 @@ class Config:
         return sub
 
     def ts_read(self):
-        return ts.open(self.ts_config).result()
+        return ts.open(self.ts_config, context=self.context).result()
 
     def zr_write_text(self, path: Path, text: str):
+        # Note: the store is already rooted at the subpath
         text = TextBuffer(text)
-        filename = self.subpath / path if self.subpath else path
-        sync(self.zr_store.set(str(filename), text))
+        sync(self.zr_store.set(str(path), text))
 
-    def zr_read_text(self, path: str | Path):
+    def zr_write_bytes(self, path: Path, data: bytes):
+        # Note: unlike np.array(bytes), frombuffer keeps trailing null bytes
+        sync(self.zr_store.set(str(path), TextBuffer.from_bytes(data)))
+
+    def zr_delete(self, path: str | Path) -> None:
+        sync(self.zr_store.delete(str(path)))
+
+    def zr_exists(self, path: str | Path = "") -> bool:
+        """
+        Returns whether anything (a file or, for S3, a prefix) exists at `path`
+        """
+        if self.is_s3():
+            # Note: calls must go through the zarr event loop which owns the session
+            key = f"{self.zr_store.path}/{path}".rstrip("/")
+            return sync(self.zr_store._fs._exists(key))
+        return (Path(self.fs_string()) / path).exists()
+
+    def zr_info(self, path: str | Path) -> dict | None:
+        """
+        Returns the fsspec info (size, ETag, ...) of the S3 object at `path`
+        or None if it does not exist.
+        """
+        try:
+            return sync(self.zr_store._fs._info(f"{self.zr_store.path}/{path}"))
+        except FileNotFoundError:
+            return None
+
+    def zr_get(self, path: str | Path):
         return sync(
             self.zr_store.get(str(path), prototype=BufferPrototype(TextBuffer, None))
         )
+
+    def zr_read_text(self, path: str | Path):
+        if self.cache is not None:
+            text = self.cache.read_text(self, str(path))
+            return None if text is None else TextBuffer.from_bytes(text.encode())
+        return self.zr_get(path)
+
+    def zr_read_json(self, path: str | Path) -> dict | None:
+        buf = self.zr_read_text(path)
+        return None if buf is None else json.loads(buf.to_bytes())
+
+    def array_metadata(self, path: str | Path) -> dict:
+        """
+        Return the v2 `.zarray` metadata of the array at `path` below this group.
+        """
+        metadata = self.zr_read_json(Path(path) / ".zarray")
+        if metadata is None:
+            raise ValueError(f"no array found at {self}/{path}")
+        return metadata
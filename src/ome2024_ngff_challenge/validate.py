@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+import tqdm
+
+from .resave import NGFF_VERSION
+from .shards import EMPTY, ShardIndexError, ShardLayout, list_objects, read_ranges
+from .utils import Config, add_store_arguments, configure_logging
+
+LOGGER = logging.getLogger(__file__)
+
+
+def cli(subparsers: argparse._SubParsersAction):
+    cmd = "ome2024-ngff-challenge validate"
+    desc = f"""
+
+
+The `validate` subcommand checks a fileset converted with `resave` without
+decompressing any chunks:
+
+    - the `zarr.json` of every group and array is read and checked against
+      OME-Zarr {NGFF_VERSION} (versions, multiscales, plates, wells, labels)
+    - the objects of every array are listed once and only the index at the
+      end of each shard is fetched with a ranged read. The index checksum
+      (crc32c) is verified and each chunk it references must lie within the
+      shard without overlapping another
+
+Shards which are not present are reported but only considered an error with
+`--strict`, since shards containing only the fill value are never written.
+
+
+BASIC
+
+    Validate a local fileset:                {cmd} out.zarr
+    Require every shard to exist:            {cmd} --strict out.zarr
+    Validate a fileset on S3:                {cmd} --input-bucket=bucket --input-endpoint=https://s3.example.com path/out.zarr
+
+    """
+    parser = subparsers.add_parser(
+        "validate",
+        help="check the metadata and shard indexes of a converted fileset",
+        description=desc,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.set_defaults(func=main, output_overwrite=False)
+    add_store_arguments(parser, "input")
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="treat missing shards as errors",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=16,
+        help="number of groups or arrays checked simultaneously",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=64,
+        help="number of shard index reads in flight",
+    )
+    parser.add_argument(
+        "--log", default="warn", help="'error', 'warn', 'info', 'debug' or 'trace'"
+    )
+    parser.add_argument("input_path", type=Path)
+
+
+def join(*parts: str | Path) -> str:
+    return "/".join(str(p) for p in parts if str(p))
+
+
+@dataclass
+class Report:
+    groups: int = 0
+    arrays: int = 0
+    shards: int = 0
+    missing: int = 0
+    chunks: int = 0
+    stored_bytes: int = 0
+    problems: list[str] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def problem(self, path: str, message: str) -> None:
+        LOGGER.error(f"{path}: {message}")
+        with self.lock:
+            self.problems.append(f"{path}: {message}")
+
+    def add(self, **counts: int) -> None:
+        with self.lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def summary(self) -> str:
+        return (
+            f"{self.groups} groups, {self.arrays} arrays, {self.shards} shards "
+            f"({self.missing} missing), {self.chunks} chunks, "
+            f"{self.stored_bytes} bytes: {len(self.problems)} problems"
+        )
+
+
+class Validator:
+    """
+    Checks the metadata of a converted hierarchy, collecting its arrays,
+    and then the shard indexes of all arrays together so that the ranged
+    reads of the whole fileset share one pool of `requests` connections.
+    """
+
+    def __init__(self, config: Config, threads: int, requests: int, strict: bool):
+        self.config = config
+        self.threads = threads
+        self.requests = requests
+        self.strict = strict
+        self.report = Report()
+        # (path, metadata, resolution level) of every array found
+        self.arrays: list[tuple[str, dict, int]] = []
+        self.lock = threading.Lock()
+
+    def read(self, path: str, node_type: str) -> dict | None:
+        metadata = self.config.zr_read_json(join(path, "zarr.json"))
+        if metadata is None:
+            self.report.problem(path or ".", "zarr.json not found")
+            return None
+        if metadata.get("zarr_format") != 3:
+            self.report.problem(path or ".", "zarr_format is not 3")
+        if metadata.get("node_type") != node_type:
+            self.report.problem(path or ".", f"node_type is not {node_type}")
+            return None
+        return metadata
+
+    def check_group(self, path: str) -> dict:
+        """
+        Returns the "ome" attributes of the group at `path`, or {} if the
+        group is invalid.
+        """
+        metadata = self.read(path, "group")
+        if metadata is None:
+            return {}
+        self.report.add(groups=1)
+        ome = metadata.get("attributes", {}).get("ome")
+        if ome is None:
+            self.report.problem(path or ".", "no 'ome' attributes")
+            return {}
+        if ome.get("version") != NGFF_VERSION:
+            self.report.problem(
+                path or ".", f"version {ome.get('version')!r} != {NGFF_VERSION!r}"
+            )
+        return ome
+
+    def check_image(self, path: str) -> None:
+        ome = self.check_group(path)
+        if "multiscales" not in ome:
+            if ome:
+                self.report.problem(path or ".", "no multiscales")
+            return
+        for multiscale in ome["multiscales"]:
+            axes = [axis["name"] for axis in multiscale.get("axes", [])]
+            for level, dataset in enumerate(multiscale.get("datasets", [])):
+                array_path = join(path, dataset["path"])
+                for transform in dataset.get("coordinateTransformations", []):
+                    values = transform.get(transform.get("type"), [])
+                    if isinstance(values, list) and len(values) != len(axes):
+                        self.report.problem(
+                            array_path,
+                            f"{transform.get('type')} does not match {len(axes)} axes",
+                        )
+                metadata = self.read(array_path, "array")
+                if metadata is None:
+                    continue
+                if len(metadata.get("shape", [])) != len(axes):
+                    self.report.problem(array_path, f"shape does not match axes {axes}")
+                names = metadata.get("dimension_names")
+                if names is not None and list(names) != axes:
+                    self.report.problem(
+                        array_path, f"dimension_names {names} != axes {axes}"
+                    )
+                with self.lock:
+                    self.arrays.append((array_path, metadata, level))
+
+        labels_path = join(path, "labels")
+        if self.config.zr_exists(join(labels_path, "zarr.json")):
+            labels = self.check_group(labels_path)
+            for label in labels.get("labels", []):
+                self.check_image(join(labels_path, label))
+
+    def check_well(self, path: str) -> None:
+        well = self.check_group(path)
+        if "well" not in well:
+            if well:
+                self.report.problem(path, "no well metadata")
+            return
+        for image in well["well"].get("images", []):
+            self.check_image(join(path, image["path"]))
+
+    def series(self) -> list[str]:
+        paths: list[str] = []
+        while self.config.zr_exists(f"{len(paths)}/zarr.json"):
+            paths.append(str(len(paths)))
+        if not paths:
+            self.report.problem(".", "bioformats2raw.layout without any series")
+        return paths
+
+    def check_metadata(self) -> None:
+        ome = self.check_group("")
+        if "plate" in ome:
+            paths = [well["path"] for well in ome["plate"].get("wells", [])]
+            task = self.check_well
+        elif "bioformats2raw.layout" in ome:
+            paths = self.series()
+            task = self.check_image
+        else:
+            paths = [""]
+            task = self.check_image
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            list(pool.map(task, paths))
+
+        if not self.config.zr_exists("ro-crate-metadata.json"):
+            LOGGER.warning(f"{self.config}: no ro-crate-metadata.json")
+
+    def list_shards(self, path: str, metadata: dict) -> list[tuple[str, int]]:
+        """
+        Returns the (key, size) of every shard stored for the array at
+        `path` after checking that no unexpected objects exist.
+        """
+        self.report.add(arrays=1)
+        try:
+            layout = ShardLayout.from_metadata(metadata)
+        except (KeyError, ValueError) as e:
+            self.report.problem(path, str(e))
+            return []
+        objects = list_objects(self.config, path)
+        objects.pop("zarr.json", None)
+        if layout is None:
+            # Unsharded: nothing to check without decompressing chunks
+            self.report.add(chunks=len(objects), stored_bytes=sum(objects.values()))
+            return []
+
+        expected = layout.keys()
+        unexpected = sorted(set(objects) - set(expected))
+        for key in unexpected[:10]:
+            self.report.problem(join(path, key), "not a shard of this array")
+        if len(unexpected) > 10:
+            self.report.problem(path, f"{len(unexpected) - 10} more unexpected objects")
+        missing = len(expected) - len(set(objects) & set(expected))
+        if missing and self.strict:
+            self.report.problem(path, f"{missing} of {len(expected)} shards missing")
+        self.report.add(missing=missing)
+        return [(key, size) for key, size in objects.items() if key in expected]
+
+    def check_shards(self) -> None:
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            listings = list(pool.map(lambda a: self.list_shards(*a[:2]), self.arrays))
+
+        shards = []
+        for (path, metadata, _), listing in zip(self.arrays, listings):
+            if listing:
+                layout = ShardLayout.from_metadata(metadata)
+                shards.extend((path, layout, key, size) for key, size in listing)
+
+        batch = max(1, self.requests) * 16
+        with tqdm.tqdm(total=len(shards), unit="shard", ncols=80) as progress:
+            for i in range(0, len(shards), batch):
+                group = shards[i : i + batch]
+                ranges = [
+                    (join(path, key), *layout.index_range(size))
+                    for path, layout, key, size in group
+                ]
+                results = read_ranges(self.config, ranges, self.requests)
+                for (path, layout, key, size), data in zip(group, results):
+                    self.check_shard(path, key, layout, size, data)
+                progress.update(len(group))
+
+    def check_shard(
+        self,
+        path: str,
+        key: str,
+        layout: ShardLayout,
+        size: int,
+        data: bytes | Exception,
+    ) -> np.ndarray | None:
+        """
+        Check the index `data` of the shard `key` of the array at `path`,
+        returning the decoded index or None if it is invalid.
+        """
+        self.report.add(shards=1, stored_bytes=size)
+        if isinstance(data, Exception):
+            self.report.problem(join(path, key), f"failed to read shard index: {data}")
+            return None
+        try:
+            index = layout.check(data, size)
+        except ShardIndexError as e:
+            self.report.problem(join(path, key), str(e))
+            return None
+        self.report.add(chunks=int((index[:, 0] != EMPTY).sum()))
+        return index
+
+    def run(self) -> Report:
+        self.check_metadata()
+        self.check_shards()
+        return self.report
+
+
+def main(ns: argparse.Namespace) -> None:
+    configure_logging(ns, LOGGER)
+    config = Config(ns, "input", "r")
+    if not config.zr_exists("zarr.json"):
+        message = f"no converted fileset found at {config}"
+        raise SystemExit(message)
+    report = Validator(config, ns.threads, ns.requests, ns.strict).run()
+    print(f"{config}: {report.summary()}")  # noqa: T201
+    if report.problems:
+        raise SystemExit(1)
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import collections
+import functools
+import http.server
+import io
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+DATA = Path(__file__).parent / "data"
+
+
+class FaultInjector:
+    """
+    WSGI middleware placed in front of the moto S3 server which counts
+    requests and can add latency, limit bandwidth and fail a fraction of
+    requests with "503 Slow Down". Failures can be limited to the requests
+    whose "METHOD /path" matches `error_pattern`, and `error_burst` fails
+    the first attempts at each of them, outlasting the client's own retries.
+    All settings can be changed while the server is running.
+    """
+
+    SLOW_DOWN = (
+        b'<?xml version="1.0" encoding="UTF-8"?>'
+        b"<Error><Code>SlowDown</Code><Message>Injected</Message></Error>"
+    )
+
+    def __init__(self, app):
+        self.app = app
+        self.latency = 0.0  # seconds per request
+        self.bandwidth = None  # bytes per second in each direction
+        self.error_rate = 0.0  # fraction of requests failing with 503
+        self.error_pattern = None  # regex of the "METHOD /path" which may fail
+        self.error_burst = 0  # failures of each matching request before success
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = collections.Counter()
+            self.errors = 0
+            self.attempts = collections.Counter()
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def throttle(self, nbytes):
+        if self.bandwidth:
+            time.sleep(nbytes / self.bandwidth)
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        request = f"{method} {environ.get('PATH_INFO', '')}"
+        with self.lock:
+            self.requests[method] += 1
+            self.bytes_in += length
+            fail = False
+            if self.error_pattern is None or re.search(self.error_pattern, request):
+                self.attempts[request] += 1
+                fail = self.random.random() < self.error_rate
+                fail = fail or self.attempts[request] <= self.error_burst
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        self.throttle(length)
+
+        if fail:
+            environ["wsgi.input"].read(length)
+            start_response(
+                "503 Slow Down",
+                [
+                    ("Content-Type", "application/xml"),
+                    ("Content-Length", str(len(self.SLOW_DOWN))),
+                ],
+            )
+            yield self.SLOW_DOWN
+            return
+
+        for chunk in self.app(environ, start_response):
+            with self.lock:
+                self.bytes_out += len(chunk)
+            self.throttle(len(chunk))
+            yield chunk
+
+
+class S3Server:
+    """
+    Local S3-compatible server (moto) with a `FaultInjector` in front of it.
+    """
+
+    def __init__(self):
+        # Optional test dependency: `pip install moto[server]`
+        from moto.server import DomainDispatcherApplication, create_backend_app
+        from werkzeug.serving import make_server
+
+        self.faults = FaultInjector(DomainDispatcherApplication(create_backend_app))
+        self.server = make_server("127.0.0.1", 0, self.faults, threaded=True)
+        host, port = self.server.server_address[:2]
+        self.endpoint = f"http://{host}:{port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def client(self):
+        import boto3
+
+        return boto3.client("s3", endpoint_url=self.endpoint, region_name="us-east-1")
+
+    def create_bucket(self, name):
+        self.client().create_bucket(Bucket=name)
+
+    def upload(self, bucket, source, prefix):
+        client = self.client()
+        for path in Path(source).rglob("*"):
+            if path.is_file():
+                key = f"{prefix}/{path.relative_to(source).as_posix()}"
+                client.upload_file(str(path), bucket, key)
+
+    def keys(self, bucket, prefix=""):
+        paginator = self.client().get_paginator("list_objects_v2")
+        return sorted(
+            obj["Key"]
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get("Contents", [])
+        )
+
+    def stop(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+@pytest.fixture(scope="session")
+def s3_server():
+    """
+    Session-wide local S3 server with the test data from `data/` uploaded
+    to the "input" bucket and an empty "output" bucket.
+    """
+    pytest.importorskip("moto")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("AWS_ACCESS_KEY_ID", "testing")
+        mp.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        mp.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        mp.setenv("AWS_EC2_METADATA_DISABLED", "true")
+        server = S3Server()
+        server.create_bucket("input")
+        server.create_bucket("output")
+        for name in ("2d", "bf2raw", "hcs"):
+            server.upload("input", DATA / f"{name}.zarr", f"data/{name}.zarr")
+        yield server
+        server.stop()
+
+
+@pytest.fixture()
+def s3(s3_server):
+    """
+    The session S3 server with faults and counters reset for each test
+    """
+    faults = s3_server.faults
+    faults.latency, faults.bandwidth, faults.error_rate = 0.0, None, 0.0
+    faults.error_pattern, faults.error_burst = None, 0
+    faults.random.seed(0)
+    faults.reset()
+    yield s3_server
+    faults.latency, faults.bandwidth, faults.error_rate = 0.0, None, 0.0
+    faults.error_pattern, faults.error_burst = None, 0
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Static file handler which also answers single byte-range requests as
+    needed for reading shards, and counts the requested paths.
+    """
+
+    requests: collections.Counter
+
+    def send_head(self):
+        self.requests[self.path] += 1
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        path = Path(self.translate_path(self.path))
+        if match is None or not path.is_file():
+            return super().send_head()
+        data = path.read_bytes()
+        start, stop = match.groups()
+        if not start:
+            start, stop = max(0, len(data) - int(stop)), len(data)
+        else:
+            start, stop = (
+                int(start),
+                min(len(data), int(stop) + 1 if stop else len(data)),
+            )
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{len(data)}")
+        self.send_header("Content-Length", str(stop - start))
+        self.end_headers()
+        return io.BytesIO(data[start:stop])
+
+    def log_message(self, *_):
+        pass
+
+
+@pytest.fixture()
+def server(tmp_path):
+    """
+    Serves `tmp_path/www` over HTTP and counts the requested paths
+    """
+    root = tmp_path / "www"
+    root.mkdir()
+    handler = type("Handler", (RangeRequestHandler,), {})
+    handler.requests = collections.Counter()
+    httpd = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(handler, directory=str(root))
+    )
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.root = root
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.requests = handler.requests
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
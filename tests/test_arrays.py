@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import json
+
+import numpy as np
+import pytest
+import tensorstore as ts
+
+from ome2024_ngff_challenge.arrays import write_image
+from ome2024_ngff_challenge.resave import ROCrateWriter
+
+CC_BY = "https://creativecommons.org/licenses/by/4.0/"
+
+
+def read_level(path):
+    return (
+        ts.open({"driver": "zarr3", "kvstore": {"driver": "file", "path": str(path)}})
+        .result()
+        .read()
+        .result()
+    )
+
+
+def test_numpy_pyramid(tmp_path):
+    data = np.arange(2 * 3 * 300 * 200, dtype="uint16").reshape(2, 3, 300, 200)
+    levels = [data, data[:, :, ::2, ::2]]
+    out = tmp_path / "out.zarr"
+    write_image(
+        levels,
+        out,
+        axes=["c", "z", "y", "x"],
+        scale=[1, 2, 0.5, 0.5],
+        name="test",
+        rocrate=ROCrateWriter(data_license=CC_BY),
+    )
+
+    ome = json.loads((out / "zarr.json").read_text())["attributes"]["ome"]
+    assert ome["version"] == "0.5"
+    multiscale = ome["multiscales"][0]
+    assert [a["type"] for a in multiscale["axes"]] == [
+        "channel",
+        "space",
+        "space",
+        "space",
+    ]
+    scales = [
+        d["coordinateTransformations"][0]["scale"] for d in multiscale["datasets"]
+    ]
+    assert scales == [[1, 2, 0.5, 0.5], [1, 2, 1, 1]]
+    assert (out / "ro-crate-metadata.json").is_file()
+
+    for i, level in enumerate(levels):
+        np.testing.assert_array_equal(read_level(out / str(i)), level)
+        metadata = json.loads((out / str(i) / "zarr.json").read_text())
+        assert metadata["dimension_names"] == ["c", "z", "y", "x"]
+
+
+def test_memmap(tmp_path):
+    raw = tmp_path / "raw.bin"
+    data = np.memmap(raw, dtype="float32", mode="w+", shape=(64, 96))
+    data[:] = np.random.default_rng(0).random((64, 96))
+    data.flush()
+    data = np.memmap(raw, dtype="float32", mode="r", shape=(64, 96))
+    write_image(data, tmp_path / "out.zarr", axes=["y", "x"], chunks=[32, 32])
+    np.testing.assert_array_equal(read_level(tmp_path / "out.zarr" / "0"), data)
+
+
+class Lazy:
+    """
+    Minimal stand-in for a lazy (e.g. dask) array recording which regions
+    were computed
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.requests = []
+
+    def __getitem__(self, key):
+        self.requests.append(key)
+        return self.data[key]
+
+
+def test_lazy_blocks(tmp_path):
+    lazy = Lazy(np.arange(256 * 256, dtype="uint8").reshape(1, 256, 256))
+    write_image(
+        lazy,
+        tmp_path / "out.zarr",
+        axes=["t", "y", "x"],
+        chunks=[1, 64, 64],
+        shards=[1, 128, 128],
+    )
+    np.testing.assert_array_equal(read_level(tmp_path / "out.zarr" / "0"), lazy.data)
+    # only whole shards are requested, never the whole array
+    for key in lazy.requests:
+        assert [s.stop - s.start for s in key] == [1, 128, 128]
+
+
+def test_axes_mismatch(tmp_path):
+    with pytest.raises(ValueError, match="axes"):
+        write_image(np.zeros((4, 4)), tmp_path / "out.zarr", axes=["z", "y", "x"])
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import io
+import json
+import sys
+import threading
+import time
+import urllib.parse
+
+import pytest
+import requests
+
+from ome2024_ngff_challenge import dispatch
+from ome2024_ngff_challenge.ontology import OntologyIndex, parse_obo
+
+OBO = """
+format-version: 1.2
+ontology: fbbi
+
+[Term]
+id: FBbi:00000369
+name: light sheet fluorescence microscopy
+def: "A fluorescence microscopy technique using a thin sheet of light." []
+synonym: "LSFM" EXACT []
+synonym: "SPIM" RELATED []
+
+[Term]
+id: FBbi:00000246
+name: fluorescence microscopy
+def: "Microscopy using fluorescence." []
+
+[Term]
+id: FBbi:00000000
+name: obsolete technique
+is_obsolete: true
+
+[Term]
+id: NCBITaxon:9606
+name: Homo sapiens
+synonym: "human" EXACT []
+
+[Typedef]
+id: part_of
+name: part of
+"""
+
+
+@pytest.fixture()
+def obo(tmp_path):
+    path = tmp_path / "test.obo"
+    path.write_text(OBO)
+    return path
+
+
+@pytest.fixture()
+def index(tmp_path, obo):
+    index = OntologyIndex(tmp_path / "index.sqlite")
+    index.add(parse_obo(obo.read_text().splitlines()))
+    yield index
+    index.close()
+
+
+def terms(docs):
+    return [doc["short_form"] for doc in docs]
+
+
+def test_parse_obo(obo):
+    records = list(parse_obo(obo.read_text().splitlines()))
+    assert [r["term"] for r in records] == [
+        "FBbi_00000369",
+        "FBbi_00000246",
+        "NCBITaxon_9606",
+    ]
+    assert records[0]["ontology"] == "fbbi"
+    assert records[0]["synonyms"] == ["LSFM", "SPIM"]
+    assert records[0]["description"].startswith("A fluorescence microscopy")
+
+
+def test_search(index):
+    assert len(index) == 3
+    assert terms(index.search("homo")) == ["NCBITaxon_9606"]
+    assert terms(index.search("HUMAN")) == ["NCBITaxon_9606"]
+    assert terms(index.search("spim")) == ["FBbi_00000369"]
+    # exact matches before prefix and trigram matches
+    assert terms(index.search("fluorescence microscopy"))[0] == "FBbi_00000246"
+    # misspelled
+    assert terms(index.search("ligth sheet"))[0] == "FBbi_00000369"
+    assert index.search("zebrafish") == []
+
+
+def test_rebuild_replaces(index, obo):
+    index.add(parse_obo(obo.read_text().splitlines()))
+    assert len(index) == 3
+    assert terms(index.search("human")) == ["NCBITaxon_9606"]
+
+
+def test_lookup_offline(tmp_path, obo, capsys, monkeypatch):
+    def offline(*_, **__):
+        msg = "no network access expected"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr(requests, "get", offline)
+    monkeypatch.setattr(requests.Session, "get", offline)
+    idx = f"--index={tmp_path / 'index.sqlite'}"
+    with pytest.raises(SystemExit, match="--build-index"):
+        dispatch(["lookup", idx, "homo"])
+    dispatch(["lookup", idx, "--build-index", str(obo)])
+    dispatch(["lookup", idx, "homo"])
+    assert "NCBITaxon_9606" in capsys.readouterr().out
+
+
+class FakeResponse:
+    def __init__(self, label="Danio rerio", status_code=200):
+        self.label = label
+        self.status_code = status_code
+
+    def json(self):
+        return {
+            "response": {
+                "docs": [
+                    {
+                        "ontology_name": "ncbitaxon",
+                        "short_form": "NCBITaxon_7955",
+                        "label": self.label,
+                        "description": [],
+                    }
+                ]
+            }
+        }
+
+
+def test_lookup_remote_cache(tmp_path, obo, capsys, monkeypatch):
+    calls = []
+
+    def get(_, url, **__):
+        calls.append(url)
+        return FakeResponse()
+
+    monkeypatch.setattr(requests.Session, "get", get)
+    idx = f"--index={tmp_path / 'index.sqlite'}"
+    dispatch(["lookup", idx, "--build-index", str(obo)])
+
+    # local matches never go to OLS
+    dispatch(["lookup", idx, "--remote", "homo"])
+    assert calls == []
+
+    dispatch(["lookup", idx, "--remote", "danio"])
+    dispatch(["lookup", idx, "--remote", "danio"])
+    assert len(calls) == 1
+    assert capsys.readouterr().out.count("NCBITaxon_7955") == 2
+
+    # expired
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 3600)
+    dispatch(["lookup", idx, "--remote", "--ttl=60", "danio"])
+    assert len(calls) == 2
+
+
+def test_lookup_batch(tmp_path, obo, capsys, monkeypatch):
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def get(_, url, **__):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)["q"][0]
+        with lock:
+            active.append(url)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(url)
+        if query == "broken":
+            return FakeResponse(status_code=500)
+        return FakeResponse(label=query)
+
+    monkeypatch.setattr(requests.Session, "get", get)
+    idx = f"--index={tmp_path / 'index.sqlite'}"
+    dispatch(["lookup", idx, "--build-index", str(obo)])
+    capsys.readouterr()
+
+    remote = [f"species {i}" for i in range(12)]
+    terms = tmp_path / "terms.txt"
+    terms.write_text("\n".join(["human", *remote, "", "broken"]) + "\n")
+    monkeypatch.setattr(sys, "stdin", io.StringIO("homo\n"))
+    args = ["lookup", idx, "--remote", "--workers=4", "--format=json"]
+    with pytest.raises(SystemExit):
+        dispatch([*args, f"--input={terms}", "first"])
+
+    records = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    assert [r["query"] for r in records] == ["first", "human", *remote, "broken"]
+    assert records[1]["results"][0]["short_form"] == "NCBITaxon_9606"
+    assert [r["results"][0]["label"] for r in records[2:-1]] == remote
+    assert "error" in records[-1]
+    assert 1 < max(peak) <= 4
+
+    dispatch(["lookup", idx, "--format=tsv", "--input=-"])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("QUERY\t")
+    assert lines[1].startswith("homo\tncbitaxon\tNCBITaxon_9606\tHomo sapiens")
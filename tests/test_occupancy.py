@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import json
+
+import numpy as np
+
+from ome2024_ngff_challenge import dispatch
+from ome2024_ngff_challenge.arrays import write_image
+from ome2024_ngff_challenge.occupancy import occupancy_map
+
+
+def test_occupancy_map():
+    grid = np.zeros((2, 4, 6), dtype=bool)
+    grid[0, :2, :3] = True
+    grid[1, :2, :3] = True
+    grid[0, 3, 5] = True
+    assert occupancy_map(grid, 64) == ["###...", "###...", "......", ".....+"]
+    assert occupancy_map(grid, 3) == ["#+.", "..+"]
+
+
+def test_inspect_sparse(tmp_path, capsys):
+    # Only the top-left 40x40 pixels are non-zero; the rest is never written
+    data = np.zeros((100, 70), dtype="uint16")
+    data[:40, :40] = np.arange(1600).reshape(40, 40) + 1
+    out = tmp_path / "out.zarr"
+    write_image(data, out, axes=["y", "x"], chunks=[16, 16], shards=[32, 32])
+
+    dispatch(["inspect", "--format=json", str(out)])
+    report = json.loads(capsys.readouterr().out)
+    (array,) = report["arrays"]
+    assert array["chunks_total"] == 7 * 5
+    assert array["chunks_stored"] == 9
+    assert array["shards_stored"] == 4
+    assert array["shards_total"] == 4 * 3
+    assert array["padding"] == 0
+    assert array["compression_ratio"] > 1
+    assert array["map"][:3] == ["###..", "###..", "###.."]
+    assert set("".join(array["map"][3:])) == {"."}
+    assert report["levels"][0]["chunks_stored"] == 9
+
+    dispatch(["inspect", str(out / "0")])
+    text = capsys.readouterr().out
+    assert "chunks 9/35 (25.7%)" in text
@@ -1,9 +1,57 @@
 from __future__ import annotations
 
 import importlib.metadata
+import subprocess
+import sys
+
+import pytest
 
 import ome2024_ngff_challenge as m
 
+HEAVY = ("tensorstore", "zarr", "numpy", "s3fs", "rocrate", "requests", "aiohttp")
+
 
 def test_version():
     assert importlib.metadata.version("ome2024_ngff_challenge") == m.__version__
+
+
+def loaded_after(code: str) -> list[str]:
+    """Run `code` in a fresh interpreter and return the heavy modules it loaded"""
+    script = f"""
+import sys
+{code}
+print("LOADED:" + ",".join(m for m in {HEAVY!r} if m in sys.modules))
+"""
+    proc = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    loaded = proc.stdout.rsplit("LOADED:", 1)[1].strip()
+    return [x for x in loaded.split(",") if x]
+
+
+HELP = """
+from ome2024_ngff_challenge import dispatch
+try:
+    dispatch({args!r})
+except SystemExit:
+    pass
+"""
+
+
+@pytest.mark.parametrize(
+    ("code", "expected"),
+    [
+        ("import ome2024_ngff_challenge", []),
+        (HELP.format(args=["--help"]), []),
+        (HELP.format(args=["lookup", "--help"]), []),
+        (HELP.format(args=["run-scripts", "--help"]), []),
+    ],
+)
+def test_lazy_imports(code, expected):
+    assert loaded_after(code) == expected
+
+
+def test_local_lookup_imports(tmp_path):
+    # only --remote and --build-index need requests
+    args = ["lookup", f"--index={tmp_path / 'index.sqlite'}", "homo"]
+    assert loaded_after(HELP.format(args=args)) == []
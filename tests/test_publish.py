@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import json
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from ome2024_ngff_challenge import dispatch
+from ome2024_ngff_challenge.thumbnails import (
+    PreviewAccumulator,
+    encode_png,
+    plane_selection,
+    render,
+)
+from ome2024_ngff_challenge.utils import chunk_iter
+
+DATA = Path(__file__).parent / "data"
+
+
+def decode_png(data):
+    """
+    Minimal decoder for the unfiltered RGB files written by `encode_png`
+    """
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    pos, chunks = 8, {}
+    while pos < len(data):
+        (length,) = struct.unpack(">I", data[pos : pos + 4])
+        tag = data[pos + 4 : pos + 8]
+        chunks[tag] = chunks.get(tag, b"") + data[pos + 8 : pos + 8 + length]
+        pos += length + 12
+    width, height = struct.unpack(">II", chunks[b"IHDR"][:8])
+    rows = np.frombuffer(zlib.decompress(chunks[b"IDAT"]), dtype=np.uint8)
+    rows = rows.reshape(height, width * 3 + 1)
+    assert not rows[:, 0].any()
+    return rows[:, 1:].reshape(height, width, 3)
+
+
+def test_render():
+    data = np.zeros((1, 2, 5, 300, 200), dtype=np.uint16)
+    data[0, 0, 2, :, :100] = 1000
+    data[0, 1, 2, :150] = 500
+    selection, kept = plane_selection(list(data.shape), list("tczyx"), 100)
+    assert kept == ["c", "y", "x"]
+    omero = {
+        "channels": [
+            {"color": "FF0000", "window": {"start": 0, "end": 1000}},
+            {"color": "00FF00", "window": {"start": 0, "end": 500}},
+        ]
+    }
+    rgb = render(data[selection], kept, omero)
+    assert rgb.shape == (100, 67, 3)
+    assert tuple(rgb[0, 0]) == (255, 255, 0)
+    assert tuple(rgb[-1, -1]) == (0, 0, 0)
+    assert (decode_png(encode_png(rgb)) == rgb).all()
+
+
+def test_preview_accumulator():
+    data = np.random.default_rng(0).integers(-100, 1000, (3, 2, 5, 70, 45))
+    data = data.astype(np.int16)
+    axes = list("tczyx")
+    accumulator = PreviewAccumulator(list(data.shape), axes, 20, projections=True)
+    blocks = chunk_iter(data.shape, [1, 1, 2, 16, 32])
+    # in any order, and more than once
+    for block in [*reversed(blocks), *blocks[:3]]:
+        accumulator.add(block, data[block])
+    selection, kept = plane_selection(list(data.shape), axes, 20)
+    strided = (slice(None), slice(None), slice(None), *selection[-2:])
+    expected = {
+        "thumbnail": data[selection],
+        "max_z": data[strided][0].max(axis=1),
+        "max_t": data[strided][:, :, 2].max(axis=0),
+    }
+    images = accumulator.images()
+    assert list(images) == list(expected)
+    for name, planes in expected.items():
+        assert (images[name] == render(planes, kept)).all()
+
+
+def test_publish(tmp_path, server):
+    urls = {}
+    for name in ("2d", "hcs"):
+        dispatch(
+            [
+                "resave",
+                "--cc-by",
+                str(DATA / f"{name}.zarr"),
+                str(server.root / f"{name}.zarr"),
+            ]
+        )
+        urls[name] = f"{server.url}/{name}.zarr"
+    samples = tmp_path / "samples.csv"
+    samples.write_text("\n".join(urls.values()) + "\n")
+    catalogue = f"--catalogue={tmp_path / 'catalogue.sqlite'}"
+    dispatch(["stats", catalogue, str(samples)])
+
+    site = tmp_path / "site"
+    dispatch(["publish", catalogue, "--processes=2", "--size=32", str(site)])
+    index = json.loads((site / "index.json").read_text())
+    rows = [dict(zip(index["columns"], row)) for row in index["rows"]]
+    assert [r["url"] for r in rows] == [urls["hcs"], urls["2d"]]  # largest first
+    image, plate = rows[1], rows[0]
+    assert image["type"] == "image"
+    assert image["size_x"] == 64
+    assert image["size_c"] == 3
+    assert image["chunk_pixels"] == 64 * 64
+    assert plate["image"] == "A/1/0"
+    assert plate["images"] == 8
+
+    thumbnails = {}
+    for row in rows:
+        rgb = decode_png((site / row["thumbnail"]).read_bytes())
+        assert rgb.shape == (32, 32, 3)
+        assert rgb.any()
+        thumbnails[row["thumbnail"]] = (site / row["thumbnail"]).stat().st_mtime_ns
+
+    # unchanged datasets keep their thumbnails
+    dispatch(["publish", catalogue, "--sort=written", str(site)])
+    index = json.loads((site / "index.json").read_text())
+    assert [row[0] for row in index["rows"]] == [urls["2d"], urls["hcs"]]
+    for name, mtime in thumbnails.items():
+        assert (site / name).stat().st_mtime_ns == mtime
@@ -1,8 +1,33 @@
 from __future__ import annotations
 
+import json
+import shlex
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
 import pytest
+import tensorstore as ts
 
+from ome2024_ngff_challenge import cache as cache_module
 from ome2024_ngff_challenge import dispatch
+from ome2024_ngff_challenge.channels import PERCENTILES, ChannelStatistics
+from ome2024_ngff_challenge.resave import (
+    STATS_KEY,
+    ROCrateWriter,
+    Session,
+    convert_array,
+)
+from ome2024_ngff_challenge.thumbnails import encode_png, render
+from ome2024_ngff_challenge.utils import (
+    BackgroundDelete,
+    Config,
+    RetryBudget,
+    StoreSettings,
+    chunk_iter,
+    is_transient,
+)
 
 #
 # Helpers
@@ -119,6 +144,758 @@ def test_rocrate_full_example(tmp_path):
     )
 
 
+#
+# Script manifests
+#
+
+
+def run_jobs(jobs):
+    """
+    Run the commands of the `jobs` of a manifest in order
+    """
+    for job in jobs:
+        for command in job["commands"]:
+            args = shlex.split(command)
+            assert args[0] == "ome2024-ngff-challenge"
+            assert dispatch(args[1:]) is None
+
+
+def test_manifest_packing(tmp_path):
+    out = tmp_path / "out.zarr"
+    args = ["--output-script", "--output-job-bytes=30000"]
+    assert dispatch(["resave", "--cc-by", *args, "data/hcs.zarr", str(out)]) == 8
+    jobs = [json.loads(x) for x in (out / "jobs.jsonl").read_text().splitlines()]
+    *work, final = jobs
+    # 8 arrays of 12288 bytes each
+    assert len(work) == 4
+    assert {job["bytes"] for job in work} == {24576}
+    assert final["depends_on"] == [job["id"] for job in work]
+    assert "finalize: job-00000" in (out / "Makefile").read_text()
+    assert len(list(out.rglob("convert.sh"))) == 8, all_files(out)
+
+    # every array is converted whole by the same subcommand
+    commands = [command for job in work for command in job["commands"]]
+    assert len(commands) == 8
+    for command in commands:
+        args = shlex.split(command)
+        assert args[1] == "reencode"
+        assert not any(arg.startswith("--blocks") for arg in args)
+    run_jobs(jobs)
+
+    totals = json.loads((out / "zarr.json").read_text())["attributes"][STATS_KEY]
+    assert totals["images"] == 8
+    assert totals["arrays"] == 8
+    well = json.loads((out / "A" / "1" / "zarr.json").read_text())
+    assert well["attributes"][STATS_KEY]["images"] == 2
+    assert (
+        sum(
+            json.loads((out / task["path"] / "zarr.json").read_text())["attributes"][
+                STATS_KEY
+            ]["stored"]
+            for job in work
+            for task in job["tasks"]
+        )
+        == totals["bytes"]
+    )
+
+
+def test_manifest_shard_ranges(tmp_path):
+    out = tmp_path / "out.zarr"
+    args = [
+        "--output-script",
+        "--output-job-bytes=2048",
+        "--output-chunks=1,1,1,32,32",
+        "--output-shards=1,1,1,32,32",
+    ]
+    assert dispatch(["resave", "--cc-by", *args, "data/2d.zarr", str(out)]) == 1
+    jobs = [json.loads(x) for x in (out / "jobs.jsonl").read_text().splitlines()]
+    *work, final = jobs
+    # 12 shards of 1024 bytes, two per job
+    assert len(work) == 6
+    ranges = sorted(task["blocks"] for job in work for task in job["tasks"])
+    assert ranges == [[x, x + 2] for x in range(0, 12, 2)]
+
+    run_jobs(work)
+    # the jobs of a split array only store their own stats
+    array = json.loads((out / "0" / "zarr.json").read_text())
+    assert STATS_KEY not in array.get("attributes", {})
+    assert len(list((out / "0" / "_block_stats").iterdir())) == 6
+
+    run_jobs([final])
+    assert not (out / "0" / "_block_stats").exists()
+    stats = json.loads((out / "0" / "zarr.json").read_text())["attributes"][STATS_KEY]
+    assert stats["written"] > 0
+    assert stats["objects"] == 12 + 1  # shards and convert.sh
+    totals = json.loads((out / "zarr.json").read_text())["attributes"][STATS_KEY]
+    assert totals["images"] == 1
+    assert totals["arrays"] == 1
+    assert totals["bytes"] == stats["stored"]
+    # finalizing again keeps the merged stats
+    run_jobs([final])
+    assert (
+        json.loads((out / "zarr.json").read_text())["attributes"][STATS_KEY]["bytes"]
+        == totals["bytes"]
+    )
+
+    before = ts.open(
+        {"driver": "zarr", "kvstore": {"driver": "file", "path": "data/2d.zarr/0"}}
+    )
+    after = ts.open(
+        {"driver": "zarr3", "kvstore": {"driver": "file", "path": str(out / "0")}}
+    )
+    assert (before.result().read().result() == after.result().read().result()).all()
+
+
+def test_finalize_incomplete(tmp_path):
+    out = tmp_path / "out.zarr"
+    args = ["--output-script", "--output-job-bytes=2048"]
+    args += ["--output-chunks=1,1,1,32,32", "--output-shards=1,1,1,32,32"]
+    assert dispatch(["resave", "--cc-by", *args, "data/2d.zarr", str(out)]) == 1
+    *work, final = (
+        json.loads(x) for x in (out / "jobs.jsonl").read_text().splitlines()
+    )
+    run_jobs(work[:-1])
+    with pytest.raises(ValueError, match=r"blocks \[\(10, 12\)\]"):
+        run_jobs([final])
+
+
+#
+# Retries
+#
+
+
+def test_retry_budget(monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda _: None)
+    failures = [OSError("503"), OSError("timeout")]
+
+    def flaky():
+        if failures:
+            raise failures.pop(0)
+        return "ok"
+
+    retry = RetryBudget(3)
+    assert retry.call(flaky) == "ok"
+    assert retry.retries == 2
+
+    def broken():
+        msg = "500"
+        raise OSError(msg)
+
+    with pytest.raises(OSError, match="500"):
+        retry.call(broken)
+    assert retry.remaining() == 0
+
+
+def test_retry_only_transient(tmp_path, monkeypatch):
+    calls = []
+
+    def wrong():
+        calls.append(1)
+        msg = "INVALID_ARGUMENT: data type mismatch"
+        raise ValueError(msg)
+
+    retry = RetryBudget(10)
+    with pytest.raises(ValueError, match="mismatch"):
+        retry.call(wrong)
+    assert len(calls) == 1
+    assert retry.retries == 0
+    assert is_transient(ValueError("UNAVAILABLE: [http_response_code='503']"))
+    assert is_transient(ConnectionResetError())
+    assert not is_transient(FileNotFoundError())
+    assert not is_transient(AssertionError())
+
+    # a failing batch is not rewritten block by block either
+    def no_sleep(_):
+        raise AssertionError
+
+    monkeypatch.setattr(time, "sleep", no_sleep)
+
+    class BrokenTransaction(ts.Transaction):
+        def __exit__(self, *exc):
+            self.abort()
+            raise TypeError
+
+    monkeypatch.setattr(ts, "Transaction", BrokenTransaction)
+    with pytest.raises(TypeError):
+        dispatch(
+            [
+                "resave",
+                "--cc-by",
+                "--output-retries=10",
+                "--output-chunks=1,1,1,32,32",
+                "data/2d.zarr",
+                str(tmp_path / "out.zarr"),
+            ]
+        )
+
+
+def test_retry_failed_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda _: None)
+    transaction = ts.Transaction
+    failures = [ValueError("UNAVAILABLE: injected [http_response_code='503']")]
+
+    class FlakyTransaction:
+        # Fails the first commit after partially writing it
+        def __init__(self):
+            self.txn = transaction()
+
+        def __enter__(self):
+            return self.txn
+
+        def __exit__(self, *exc):
+            if failures:
+                self.txn.abort()
+                raise failures.pop(0)
+            self.txn.commit_sync()
+
+    monkeypatch.setattr(ts, "Transaction", FlakyTransaction)
+    out = tmp_path / "out.zarr"
+    args = [
+        "--output-chunks=1,1,1,32,32",
+        "--output-shards=1,1,1,32,32",
+        "--output-threads=4",
+    ]
+    assert dispatch(["resave", "--cc-by", *args, "data/2d.zarr", str(out)]) == 1
+    metadata = json.loads((out / "0" / "zarr.json").read_text())
+    stats = metadata["attributes"]["_ome2024_ngff_challenge_stats"]
+    # each shard of the failed batch was retried on its own
+    assert stats["retries"] == 4
+    assert stats["failed_batches"] == 1
+
+    before = ts.open(
+        {"driver": "zarr", "kvstore": {"driver": "file", "path": "data/2d.zarr/0"}}
+    )
+    after = ts.open(
+        {"driver": "zarr3", "kvstore": {"driver": "file", "path": str(out / "0")}}
+    )
+    assert (before.result().read().result() == after.result().read().result()).all()
+
+
+def test_retry_budget_exhausted(tmp_path, monkeypatch):
+    class BrokenTransaction(ts.Transaction):
+        def __exit__(self, *exc):
+            self.abort()
+            msg = "injected 500"
+            raise ValueError(msg)
+
+    monkeypatch.setattr(ts, "Transaction", BrokenTransaction)
+    with pytest.raises(ValueError, match="injected 500"):
+        dispatch(
+            [
+                "resave",
+                "--cc-by",
+                "--output-retries=0",
+                # re-encoded rather than copied (see test_passthrough)
+                "--output-chunks=1,1,1,32,32",
+                "data/2d.zarr",
+                str(tmp_path / "out.zarr"),
+            ]
+        )
+
+
+#
+# Details files
+#
+
+
+@pytest.mark.parametrize("input", ["2d", "bf2raw", "hcs"])
+@pytest.mark.parametrize("suffix", ["json", "jsonl"])
+def test_details_roundtrip(tmp_path, input, suffix):
+    details = tmp_path / f"details.{suffix}"
+    args = ["resave", "--cc-by", f"data/{input}.zarr"]
+    expected = dispatch([*args, str(details), "--output-write-details"])
+
+    if suffix == "jsonl":
+        records = [json.loads(x) for x in details.read_text().splitlines()]
+        keys = {x["key"] for x in records}
+        # append a correction for the first array which should win
+        first = dict(records[0])
+        first["chunks"] = [1, 1, 1, 32, 32]
+        first["shards"] = [1, 1, 1, 64, 64]
+        with details.open("a") as o:
+            o.write(json.dumps(first) + "\n")
+    else:
+        keys = set(json.loads(details.read_text()))
+    assert len(keys) == {"2d": 1, "bf2raw": 2, "hcs": 8}[input]
+
+    out = tmp_path / "out.zarr"
+    assert dispatch([*args, str(out), f"--output-read-details={details}"]) == expected
+    if suffix == "jsonl":
+        path = first["key"].replace(f"data/{input}.zarr", str(out))
+        metadata = json.loads((Path(path) / "zarr.json").read_text())
+        sharding = metadata["codecs"][0]["configuration"]
+        assert sharding["chunk_shape"] == [1, 1, 1, 32, 32]
+
+
+#
+# Roll-up statistics
+#
+
+
+def group_totals(path):
+    metadata = json.loads((path / "zarr.json").read_text())
+    return metadata["attributes"]["_ome2024_ngff_challenge_stats"]
+
+
+@pytest.mark.parametrize(("input", "images"), [("hcs", 8), ("bf2raw", 2)])
+def test_rollup_totals(tmp_path, input, images):
+    out = tmp_path / "out.zarr"
+    assert dispatch(["resave", "--cc-by", f"data/{input}.zarr", str(out)]) == images
+
+    arrays = [
+        json.loads(p.read_text())
+        for p in out.rglob("zarr.json")
+        if json.loads(p.read_text())["node_type"] == "array"
+    ]
+    shards = [
+        p
+        for p in out.rglob("*")
+        if p.is_file() and p.name != "zarr.json" and "c" in p.relative_to(out).parts
+    ]
+    totals = group_totals(out)
+    assert totals["images"] == images
+    assert totals["arrays"] == len(arrays)
+    assert totals["objects"] == len(shards)
+    assert totals["bytes"] == sum(p.stat().st_size for p in shards)
+    assert totals["elapsed"] > 0
+
+    if input == "hcs":
+        wells = [group_totals(out / well) for well in ("A/1", "A/2", "B/1", "B/2")]
+        assert sum(w["bytes"] for w in wells) == totals["bytes"]
+        assert all(w["images"] == 2 for w in wells)
+        # the well attributes are not replaced by those of its images
+        well = json.loads((out / "A/1/zarr.json").read_text())
+        assert "well" in well["attributes"]["ome"]
+
+
+#
+# Sparse inputs
+#
+
+
+def test_sparse_input(tmp_path):
+    shutil.copytree("data/2d.zarr", tmp_path / "in.zarr")
+    # Only the first channel has any data
+    shutil.rmtree(tmp_path / "in.zarr" / "0" / "0" / "1")
+    shutil.rmtree(tmp_path / "in.zarr" / "0" / "0" / "2")
+    out = tmp_path / "out.zarr"
+    args = [
+        "resave",
+        "--cc-by",
+        "--output-chunks=1,1,1,32,32",
+        "--output-shards=1,1,1,64,64",
+        str(tmp_path / "in.zarr"),
+        str(out),
+    ]
+    assert dispatch(args) == 1
+
+    metadata = json.loads((out / "0" / "zarr.json").read_text())
+    assert (
+        metadata["attributes"]["_ome2024_ngff_challenge_stats"]["skipped_blocks"] == 2
+    )
+    assert [p.name for p in (out / "0" / "c" / "0").iterdir()] == ["0"]
+
+    written = ts.open(
+        {"driver": "zarr3", "kvstore": {"driver": "file", "path": str(out / "0")}}
+    ).result()
+    original = ts.open(
+        {"driver": "zarr", "kvstore": {"driver": "file", "path": "data/2d.zarr/0"}}
+    ).result()
+    assert (written[:, 0].read().result() == original[:, 0].read().result()).all()
+    assert not written[:, 1:].read().result().any()
+
+
+@pytest.mark.parametrize(
+    ("dtype", "fill", "chunks"),
+    [
+        ("uint16", 7, [1, 1, 1, 32, 32]),  # compressed chunks copied
+        ("uint16", 7, [1, 1, 1, 16, 16]),  # re-encoded
+        ("float32", "NaN", [1, 1, 1, 32, 32]),
+    ],
+)
+def test_sparse_fill_value(tmp_path, dtype, fill, chunks):
+    source = tmp_path / "in.zarr"
+    array = ts.open(
+        {
+            "driver": "zarr",
+            "kvstore": {"driver": "file", "path": str(source)},
+            "metadata": {
+                "shape": [1, 1, 1, 64, 128],
+                "chunks": [1, 1, 1, 32, 32],
+                "dtype": np.dtype(dtype).str,
+                "fill_value": fill,
+                "compressor": {"id": "blosc", "cname": "lz4", "shuffle": 1},
+            },
+            "create": True,
+        }
+    ).result()
+    # only one chunk is stored
+    array[..., :32, :32].write(np.ones((32, 32), dtype=dtype)).result()
+
+    output_config = Config(StoreSettings(tmp_path / "0"), "output", "w")
+    stats = convert_array(
+        Config(StoreSettings(source), "input", "r"),
+        output_config,
+        ["t", "c", "z", "y", "x"],
+        chunks,
+        [1, 1, 1, 64, 64],
+        threads=2,
+    )
+    assert stats["passthrough"] == (chunks == [1, 1, 1, 32, 32])
+    assert stats["skipped_blocks"] == 1
+    metadata = json.loads((tmp_path / "0" / "zarr.json").read_text())
+    assert metadata["fill_value"] == fill
+    written = ts.open(
+        {"driver": "zarr3", "kvstore": {"driver": "file", "path": str(tmp_path / "0")}}
+    ).result()
+    np.testing.assert_array_equal(written.read().result(), array.read().result())
+
+
+def test_passthrough(tmp_path):
+    out = tmp_path / "out.zarr"
+    # input chunks are [1, 1, 1, 64, 64] and compressed with blosc/lz4
+    args = ["resave", "--cc-by", "--output-shards=1,3,1,64,64"]
+    assert dispatch([*args, "data/2d.zarr", str(out)]) == 1
+
+    metadata = json.loads((out / "0" / "zarr.json").read_text())
+    assert metadata["attributes"]["_ome2024_ngff_challenge_stats"]["passthrough"]
+    inner = metadata["codecs"][0]["configuration"]["codecs"]
+    assert inner[1]["configuration"]["cname"] == "lz4"
+
+    # the compressed chunks are stored byte for byte
+    shard = (out / "0" / "c" / "0" / "0" / "0" / "0" / "0").read_bytes()
+    for channel in range(3):
+        chunk = Path(f"data/2d.zarr/0/0/{channel}/0/0/0").read_bytes()
+        assert chunk in shard
+
+    before = ts.open(
+        {"driver": "zarr", "kvstore": {"driver": "file", "path": "data/2d.zarr/0"}}
+    )
+    after = ts.open(
+        {"driver": "zarr3", "kvstore": {"driver": "file", "path": str(out / "0")}}
+    )
+    assert (before.result().read().result() == after.result().read().result()).all()
+    dispatch(["validate", str(out)])
+
+
+@pytest.mark.parametrize("chunks", [[1, 1, 1, 64, 64], [1, 1, 1, 16, 32]])
+def test_streamed_shards(tmp_path, chunks):
+    # the first chunk shape is copied, the second re-encoded
+    input_config = Config(StoreSettings(Path("data/2d.zarr/0")), "input", "r")
+    output_config = Config(StoreSettings(tmp_path / "0"), "output", "w")
+    convert_array(
+        input_config,
+        output_config,
+        ["t", "c", "z", "y", "x"],
+        chunks,
+        [1, 3, 1, 64, 64],
+        threads=2,
+        stream_bytes=0,
+    )
+    metadata = json.loads((tmp_path / "0" / "zarr.json").read_text())
+    assert metadata["attributes"]["_ome2024_ngff_challenge_stats"]["streamed"]
+    assert [p.name for p in tmp_path.rglob("*") if ".partial-" in p.name] == []
+
+    before = ts.open(
+        {"driver": "zarr", "kvstore": {"driver": "file", "path": "data/2d.zarr/0"}}
+    )
+    after = ts.open(
+        {"driver": "zarr3", "kvstore": {"driver": "file", "path": str(tmp_path / "0")}}
+    )
+    assert (before.result().read().result() == after.result().read().result()).all()
+
+
+#
+# Thumbnails
+#
+
+
+def write_input(source, data, omero=True, *lower):
+    """
+    Write `data` as the only level (or followed by the `lower` resolution
+    levels) of a copy of 2d.zarr at `source`
+    """
+    source.mkdir()
+    shutil.copy("data/2d.zarr/.zgroup", source)
+    attrs = json.loads(Path("data/2d.zarr/.zattrs").read_text())
+    if not omero:
+        del attrs["omero"]
+    elif isinstance(omero, dict):
+        attrs["omero"] = omero
+    datasets = attrs["multiscales"][0]["datasets"]
+    for level in range(1, len(lower) + 1):
+        scale = [1.0, 1.0, 1.0, 2.0**level, 2.0**level]
+        transformations = [{"scale": scale, "type": "scale"}]
+        datasets.append(
+            {"path": str(level), "coordinateTransformations": transformations}
+        )
+    (source / ".zattrs").write_text(json.dumps(attrs))
+    for level, values in enumerate([data, *lower]):
+        array = ts.open(
+            {
+                "driver": "zarr",
+                "kvstore": {"driver": "file", "path": str(source / str(level))},
+                "metadata": {"shape": values.shape, "chunks": [1, 1, 1, 32, 32]},
+                "dtype": values.dtype.name,
+                "create": True,
+            }
+        ).result()
+        array.write(values).result()
+
+
+def test_thumbnails(tmp_path):
+    # with several timepoints and Z planes
+    source = tmp_path / "in.zarr"
+    data = np.random.default_rng(0).integers(0, 64, (2, 3, 4, 64, 64), dtype="u1")
+    write_input(source, data)
+
+    out = tmp_path / "out.zarr"
+    args = ["resave", "--cc-by", "--output-projections", "--output-shards=1,1,2,64,64"]
+    assert dispatch([*args, "--output-chunks=1,1,1,32,32", str(source), str(out)]) == 1
+
+    omero = json.loads((source / ".zattrs").read_text())["omero"]
+    expected = {
+        "thumbnail": data[0, :, 2],
+        "max_z": data[0].max(axis=1),
+        "max_t": data[:, :, 2].max(axis=0),
+    }
+    for name, planes in expected.items():
+        png = (out / "thumbnails" / f"{name}.png").read_bytes()
+        assert png == encode_png(render(planes, ["c", "y", "x"], omero))
+
+    crate = json.loads((out / "ro-crate-metadata.json").read_text())
+    entities = {entity["@id"]: entity for entity in crate["@graph"]}
+    assert entities["./"]["thumbnail"] == {"@id": "thumbnails/thumbnail.png"}
+    assert entities["thumbnails/max_t.png"]["encodingFormat"] == "image/png"
+
+    # observed blocks are re-encoded rather than copied
+    metadata = json.loads((out / "0" / "zarr.json").read_text())
+    assert not metadata["attributes"]["_ome2024_ngff_challenge_stats"]["passthrough"]
+    written = ts.open(
+        {"driver": "zarr3", "kvstore": {"driver": "file", "path": str(out / "0")}}
+    ).result()
+    assert (written.read().result() == data).all()
+
+
+def test_plate_thumbnails(tmp_path):
+    out = tmp_path / "out.zarr"
+    args = ["resave", "--cc-by", "--output-thumbnails", "data/hcs.zarr", str(out)]
+    assert dispatch(args) == 8
+    thumbnails = sorted(p.relative_to(out) for p in out.rglob("*.png"))
+    assert len(thumbnails) == 8
+    assert str(thumbnails[0]) == "A/1/0/thumbnails/thumbnail.png"
+    crate = json.loads((out / "ro-crate-metadata.json").read_text())
+    entities = {entity["@id"]: entity for entity in crate["@graph"]}
+    assert all(str(p) in entities for p in thumbnails)
+
+
+#
+# Channel statistics
+#
+
+
+def test_channel_statistics():
+    data = np.random.default_rng(0).gamma(2, 500, (2, 3, 4, 64, 64))
+    data = data.astype(np.uint16)
+    statistics = ChannelStatistics(list(data.shape), list("tczyx"))
+    blocks = chunk_iter(data.shape, [1, 2, 2, 32, 32])
+    # in any order, and more than once
+    for block in [*reversed(blocks), *blocks[:3]]:
+        statistics.add(block, data[block])
+    for channel, summary in enumerate(statistics.summary()):
+        values = data[:, channel]
+        assert summary["min"] == values.min()
+        assert summary["max"] == values.max()
+        # the fraction of values below the window is close to the percentiles
+        lower, upper = PERCENTILES
+        assert abs((values < summary["start"]).mean() * 100 - lower) < 0.05
+        assert abs((values <= summary["end"]).mean() * 100 - upper) < 0.05
+
+
+@pytest.mark.parametrize("omero", [True, False])
+def test_channel_stats(tmp_path, omero):
+    source = tmp_path / "in.zarr"
+    data = np.random.default_rng(0).integers(10, 50, (1, 3, 1, 64, 64), dtype="u1")
+    data[0, 1] += 100  # outside the window of 2d.zarr's second channel
+    write_input(source, data, omero)
+    out = tmp_path / "out.zarr"
+    args = ["resave", "--cc-by", "--output-channel-stats", "--output-thumbnails"]
+    assert dispatch([*args, str(source), str(out)]) == 1
+
+    attrs = json.loads((out / "zarr.json").read_text())["attributes"]["ome"]
+    channels = attrs["omero"]["channels"]
+    assert len(channels) == 3
+    if omero:
+        # a range including all values is kept, one excluding some widened
+        assert [c["window"]["min"] for c in channels] == [0, 0, 0]
+        assert [c["window"]["max"] for c in channels] == [63, data[0, 1].max(), 63]
+        # a window selecting some values is kept
+        assert channels[0]["label"] == "Channel 0"
+        assert channels[0]["window"]["start"] == 0
+        assert channels[0]["window"]["end"] == 63
+    else:
+        for channel, values in zip(channels, data[0]):
+            window = channel["window"]
+            assert window["min"] == values.min()
+            assert window["max"] == values.max()
+    assert channels[1]["window"]["start"] >= 110
+    assert channels[1]["window"]["end"] < 150
+
+    # previews are rendered with the new windows
+    png = (out / "thumbnails" / "thumbnail.png").read_bytes()
+    assert png == encode_png(render(data[0, :, 0], ["c", "y", "x"], attrs["omero"]))
+
+
+def test_channel_stats_multiscale(tmp_path):
+    # the extremes of the full resolution are not in the lower level
+    data = np.random.default_rng(0).integers(10, 50, (1, 3, 1, 64, 64), dtype="u1")
+    data[..., 1, 1] = 0
+    data[..., 3, 3] = 255
+    lower = data[..., ::2, ::2]
+    omero = json.loads(Path("data/2d.zarr/.zattrs").read_text())["omero"]
+    for channel in omero["channels"]:
+        channel["window"] = {"min": 0, "max": 255, "start": 10, "end": 49}
+    del omero["channels"][2]["window"]["max"]
+    source = tmp_path / "in.zarr"
+    write_input(source, data, omero, lower)
+    out = tmp_path / "out.zarr"
+    args = ["resave", "--cc-by", "--output-channel-stats"]
+    assert dispatch([*args, str(source), str(out)]) == 1
+
+    attrs = json.loads((out / "zarr.json").read_text())["attributes"]["ome"]
+    windows = [channel["window"] for channel in attrs["omero"]["channels"]]
+    # correct windows are kept
+    assert windows[:2] == [{"min": 0, "max": 255, "start": 10, "end": 49}] * 2
+    # an incomplete range is taken from the lowest resolution
+    assert windows[2]["min"] == lower[0, 2].min()
+    assert windows[2]["max"] == lower[0, 2].max()
+
+
+#
+# Metadata cache
+#
+
+
+def test_input_cache(tmp_path):
+    cache = tmp_path / "cache"
+    args = [
+        "resave",
+        "--cc-by",
+        f"--input-cache={cache}",
+        "data/2d.zarr",
+    ]
+    assert dispatch([*args, str(tmp_path / "a.json"), "--output-write-details"]) == 1
+    (cached,) = cache.glob("*.json")
+    entries = json.loads(cached.read_text())["entries"]
+    assert "data/2d.zarr/0/.zarray" in entries
+    # missing files are cached as well
+    assert entries["data/2d.zarr/labels/.zgroup"]["value"] is None
+
+    assert dispatch([*args, str(tmp_path / "out.zarr"), "--output-script"]) == 1
+    assert json.loads(cached.read_text())["entries"] == entries
+
+
+def test_input_cache_validation(tmp_path, monkeypatch):
+    shutil.copytree("data/2d.zarr", tmp_path / "in.zarr")
+    cache = tmp_path / "cache"
+    args = ["resave", "--cc-by", f"--input-cache={cache}", str(tmp_path / "in.zarr")]
+    assert dispatch([*args, str(tmp_path / "a.json"), "--output-write-details"]) == 1
+
+    # recent entries are reused without checking the source
+    checks = []
+    validator = cache_module.validator
+    monkeypatch.setattr(
+        cache_module, "validator", lambda *a: checks.append(a) or validator(*a)
+    )
+    assert dispatch([*args, str(tmp_path / "b.json"), "--output-write-details"]) == 1
+    assert checks == []
+    args.append("--input-cache-max-age=0")
+
+    zarray = tmp_path / "in.zarr" / "0" / ".zarray"
+    metadata = json.loads(zarray.read_text())
+    metadata["chunks"] = [1, 1, 1, 128, 128]
+    zarray.write_text(json.dumps(metadata))
+    assert dispatch([*args, str(tmp_path / "c.json"), "--output-write-details"]) == 1
+    details = json.loads((tmp_path / "c.json").read_text())
+    assert [1, 1, 1, 128, 128] in [x["chunks"] for x in details.values()]
+
+
+#
+# Session API
+#
+
+
+def test_session_reuse(tmp_path):
+    cache = tmp_path / "cache"
+    rocrate = ROCrateWriter(data_license="https://creativecommons.org/licenses/by/4.0/")
+    with Session(rocrate=rocrate, cache_directory=cache) as session:
+        assert session.convert("data/2d.zarr", tmp_path / "a.zarr") == 1
+        assert session.convert_plate("data/hcs.zarr", tmp_path / "b.zarr") == 8
+        assert session.convert_image("data/2d.zarr", tmp_path / "c.zarr") == 1
+        # one cache per input hierarchy, reused between conversions
+        assert len(session.caches) == 2
+        hits = session.caches[StoreSettings(Path("data/2d.zarr")).cache_key()].hits
+        assert hits > 0
+        with pytest.raises(ValueError, match="plate"):
+            session.convert_plate("data/2d.zarr", tmp_path / "d.zarr")
+    assert len(list(cache.glob("*.json"))) == 2
+    for name in "abc":
+        assert (tmp_path / f"{name}.zarr" / "ro-crate-metadata.json").is_file()
+
+
+#
+# Overwriting
+#
+
+
+def test_overwrite(tmp_path):
+    out = tmp_path / "out.zarr"
+    args = ["resave", "--cc-by", "data/hcs.zarr", str(out)]
+    assert dispatch(args) == 8
+    stale = out / "stale" / "c" / "0"
+    stale.mkdir(parents=True)
+    (stale / "0").write_bytes(b"x")
+    with pytest.raises(Exception, match="--output-overwrite"):
+        dispatch(args)
+
+    assert dispatch([*args, "--output-overwrite"]) == 8
+    assert not (out / "stale").exists()
+    assert (out / "zarr.json").is_file()
+    # the renamed tree has been deleted before returning
+    assert [x.name for x in tmp_path.iterdir()] == ["out.zarr"]
+
+
+def test_background_delete(tmp_path):
+    tree = tmp_path / "tree"
+    for i in range(20):
+        (tree / str(i) / "c").mkdir(parents=True)
+        for j in range(5):
+            (tree / str(i) / "c" / str(j)).write_bytes(b"x")
+    deleter = BackgroundDelete(tree, threads=4)
+    # the original location is free immediately
+    assert not tree.exists()
+    deleter.wait()
+    assert deleter.error is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_background_delete_stale(tmp_path):
+    # trash of a process which died while deleting
+    stale = tmp_path / ".out.zarr.trash-0123abcd"
+    (stale / "0" / "c").mkdir(parents=True)
+    (stale / "0" / "c" / "0").write_bytes(b"x")
+    other = tmp_path / ".other.zarr.trash-0123abcd"
+    other.mkdir()
+
+    out = tmp_path / "out.zarr"
+    out.mkdir()
+    deleter = BackgroundDelete(out)
+    deleter.wait()
+    assert deleter.error is None
+    # only the trash of the same path is removed
+    assert list(tmp_path.iterdir()) == [other]
+
+
 #
 # Remote testing
 #
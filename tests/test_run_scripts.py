@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import json
+import time
+
+import pytest
+
+from ome2024_ngff_challenge import dispatch
+
+
+def make_script(path, body):
+    path.mkdir(parents=True)
+    script = path / "convert.sh"
+    script.write_text(body)
+    return script
+
+
+def records(out):
+    return [json.loads(x) for x in (out / "run-scripts.jsonl").read_text().splitlines()]
+
+
+def test_run_and_skip(tmp_path):
+    out = tmp_path / "out.zarr"
+    for name in ("0", "1", "2"):
+        make_script(out / name, f"echo '{{}}' > {out / name / 'zarr.json'}\n")
+
+    assert dispatch(["run-scripts", "--jobs=2", str(out)]) is None
+    first = records(out)
+    assert len(first) == 3
+    assert {x["status"] for x in first} == {0}
+    assert all(x["elapsed"] >= 0 for x in first)
+
+    # everything has validated, so nothing is run again...
+    dispatch(["run-scripts", str(out)])
+    assert len(records(out)) == 3
+    # ...unless the output goes missing
+    (out / "1" / "zarr.json").unlink()
+    dispatch(["run-scripts", str(out)])
+    assert [x["script"] for x in records(out)[3:]] == [str(out / "1" / "convert.sh")]
+
+
+def test_retries(tmp_path, monkeypatch):
+    delays = []
+    monkeypatch.setattr(time, "sleep", delays.append)
+    out = tmp_path / "out.zarr"
+    counter = tmp_path / "counter"
+    # throttled on the first two attempts only
+    make_script(
+        out / "0",
+        f"echo x >> {counter}\n"
+        f'[ "$(wc -l < {counter})" -gt 2 ] || {{ echo "503 SlowDown" >&2; exit 3; }}\n'
+        f"echo '{{}}' > {out / '0' / 'zarr.json'}\n",
+    )
+    # a permanent failure is not retried
+    make_script(out / "1", "echo 'No such file' >&2\nexit 4\n")
+    # a script killed by a signal is
+    make_script(out / "2", "kill -9 $$\n")
+
+    with pytest.raises(SystemExit):
+        dispatch(["run-scripts", "--jobs=1", "--retries=2", str(out)])
+    status = {x["script"]: x for x in records(out)}
+    assert status[str(out / "0" / "convert.sh")]["status"] == 0
+    assert status[str(out / "0" / "convert.sh")]["attempts"] == 3
+    assert status[str(out / "1" / "convert.sh")]["status"] == 4
+    assert status[str(out / "1" / "convert.sh")]["attempts"] == 1
+    assert status[str(out / "2" / "convert.sh")]["status"] == -9
+    assert status[str(out / "2" / "convert.sh")]["attempts"] == 3
+    # with backoff between the attempts
+    assert len(delays) == 4
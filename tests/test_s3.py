@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+import tensorstore as ts
+
+from ome2024_ngff_challenge import dispatch
+from ome2024_ngff_challenge.resave import ROCrateWriter, Session
+from ome2024_ngff_challenge.shards import EMPTY, ShardLayout, ShardStream
+from ome2024_ngff_challenge.utils import Config, StoreSettings
+
+LOGGER = logging.getLogger(__file__)
+
+DATA = Path(__file__).parent / "data"
+EXPECTED = {"2d": 1, "bf2raw": 2, "hcs": 8}
+
+
+def input_args(s3):
+    return ["--input-bucket=input", f"--input-endpoint={s3.endpoint}"]
+
+
+def output_args(s3):
+    return ["--output-bucket=output", f"--output-endpoint={s3.endpoint}"]
+
+
+@pytest.mark.parametrize("input", ["2d", "bf2raw", "hcs"])
+def test_s3_input(s3, tmp_path, input):
+    out = tmp_path / "out.zarr"
+    args = ["resave", "--cc-by", *input_args(s3), f"data/{input}.zarr", str(out)]
+    assert dispatch(args) == EXPECTED[input]
+    assert (out / "zarr.json").is_file()
+    assert s3.faults.requests["GET"] > 0
+
+
+@pytest.mark.parametrize("input", ["2d", "hcs"])
+def test_s3_output(s3, tmp_path, input):
+    prefix = f"{tmp_path.name}/out.zarr"
+    args = ["resave", "--cc-by", *output_args(s3), str(DATA / f"{input}.zarr"), prefix]
+    assert dispatch(args) == EXPECTED[input]
+    keys = s3.keys("output", prefix)
+    assert f"{prefix}/zarr.json" in keys
+    assert f"{prefix}/ro-crate-metadata.json" in keys
+    assert s3.faults.requests["PUT"] > 0
+
+
+def test_s3_overwrite(s3, tmp_path):
+    prefix = f"{tmp_path.name}/out.zarr"
+    args = ["resave", "--cc-by", *output_args(s3), str(DATA / "2d.zarr"), prefix]
+    assert dispatch(args) == EXPECTED["2d"]
+
+    client = s3.client()
+    client.put_object(Bucket="output", Key=f"{prefix}/stale/c/0/0", Body=b"x")
+    client.put_object(Bucket="output", Key=f"{prefix}2/keep", Body=b"x")
+    with pytest.raises(Exception, match="--output-overwrite"):
+        dispatch(args)
+
+    assert dispatch([*args, "--output-overwrite"]) == EXPECTED["2d"]
+    keys = s3.keys("output", tmp_path.name)
+    assert f"{prefix}/stale/c/0/0" not in keys
+    assert f"{prefix}/zarr.json" in keys
+    assert f"{prefix}2/keep" in keys
+    assert s3.faults.requests["POST"] > 0  # multi-object delete
+
+
+def test_s3_injected_errors(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(time, "sleep", lambda _: None)
+    # Each shard upload fails more often than tensorstore retries a request
+    # itself, so that only the conversion's own retries can recover
+    s3.faults.error_pattern = r"^PUT /output/.*/c/"
+    s3.faults.error_burst = 2
+    prefix = f"{tmp_path.name}/out.zarr"
+    output = StoreSettings(Path(prefix), bucket="output", endpoint=s3.endpoint)
+    session = Session(
+        chunks=[1, 1, 1, 32, 32],
+        shards=[1, 1, 1, 32, 32],
+        retries=100,
+        rocrate=ROCrateWriter(data_license="https://example.org/license"),
+        context={"s3_request_retries": {"max_retries": 1}},
+    )
+    with session:
+        assert session.convert_image(DATA / "2d.zarr", output) == 1
+    assert s3.faults.errors > 0
+    s3.faults.error_burst = 0
+
+    metadata = json.loads(
+        s3.client()
+        .get_object(Bucket="output", Key=f"{prefix}/0/zarr.json")["Body"]
+        .read()
+    )
+    stats = metadata["attributes"]["_ome2024_ngff_challenge_stats"]
+    assert stats["retries"] > 0
+    assert stats["failed_batches"] > 0
+    LOGGER.info(
+        f"injected {s3.faults.errors} errors: retries={stats['retries']} requests={dict(s3.faults.requests)}"
+    )
+
+    before = ts.open(
+        {
+            "driver": "zarr",
+            "kvstore": {"driver": "file", "path": str(DATA / "2d.zarr/0")},
+        }
+    ).result()
+    after = ts.open(
+        {
+            "driver": "zarr3",
+            "kvstore": {
+                "driver": "s3",
+                "bucket": "output",
+                "endpoint": s3.endpoint,
+                "path": f"{prefix}/0/",
+            },
+        }
+    ).result()
+    assert (before.read().result() == after.read().result()).all()
+
+
+def test_s3_slow_network(s3, tmp_path):
+    """
+    Remote-to-remote conversion over a slow network completes without
+    retries and writes the same data.
+    """
+    s3.faults.latency = 0.005
+    s3.faults.bandwidth = 1_000_000
+    prefix = f"{tmp_path.name}/out.zarr"
+    args = [
+        "resave",
+        "--cc-by",
+        *input_args(s3),
+        *output_args(s3),
+        "--output-chunks=1,1,1,32,32",
+        "--output-shards=1,1,1,64,64",
+        "data/hcs.zarr",
+        prefix,
+    ]
+    assert dispatch(args) == EXPECTED["hcs"]
+    assert s3.faults.errors == 0
+
+    client = s3.client()
+    arrays = sorted(p.parent for p in (DATA / "hcs.zarr").rglob(".zarray"))
+    assert len(arrays) == 8
+    for path in arrays:
+        key = f"{prefix}/{path.relative_to(DATA / 'hcs.zarr').as_posix()}"
+        metadata = json.loads(
+            client.get_object(Bucket="output", Key=f"{key}/zarr.json")["Body"].read()
+        )
+        stats = metadata["attributes"]["_ome2024_ngff_challenge_stats"]
+        assert stats["retries"] == 0
+        assert stats["failed_batches"] == 0
+
+        before = ts.open(
+            {"driver": "zarr", "kvstore": {"driver": "file", "path": str(path)}}
+        ).result()
+        after = ts.open(
+            {
+                "driver": "zarr3",
+                "kvstore": {
+                    "driver": "s3",
+                    "bucket": "output",
+                    "endpoint": s3.endpoint,
+                    "path": f"{key}/",
+                },
+            }
+        ).result()
+        assert (before.read().result() == after.read().result()).all()
+
+
+def test_s3_stream_multipart(s3, tmp_path):
+    settings = StoreSettings(
+        Path(f"{tmp_path.name}/0"), bucket="output", endpoint=s3.endpoint
+    )
+    config = Config(settings, "output", "w")
+    layout = ShardLayout([4, 1024, 1024], [4, 1024, 1024], [1, 1024, 1024])
+    rng = np.random.default_rng(0)
+    chunks = [rng.bytes(3 * 1024**2) for _ in range(4)]
+
+    stream = ShardStream(config, "c/0/0/0", layout, part_size=5 * 1024**2)
+    for i in (3, 0, 2):
+        stream.add(i, chunks[i])
+    assert s3.keys("output", tmp_path.name) == []  # not visible until closed
+    stream.close()
+    # create and complete, with one 5 MiB part and the remainder
+    assert s3.faults.requests["POST"] == 2
+    assert s3.faults.requests["PUT"] == 2
+
+    shard = s3.client().get_object(Bucket="output", Key=f"{tmp_path.name}/0/c/0/0/0")
+    data = shard["Body"].read()
+    assert shard["ContentLength"] == 9 * 1024**2 + layout.index_size
+    index = layout.check(data[-layout.index_size :], len(data))
+    for i in (0, 2, 3):
+        offset, nbytes = index[i]
+        assert data[offset : offset + nbytes] == chunks[i]
+    assert index[1].tolist() == [EMPTY, EMPTY]
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import csv
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+from ome2024_ngff_challenge import dispatch
+
+DATA = Path(__file__).parent / "data"
+
+
+def convert(server, input):
+    dispatch(
+        [
+            "resave",
+            "--cc-by",
+            "--rocrate-name=stats test",
+            "--rocrate-organism=NCBI:txid9606",
+            str(DATA / f"{input}.zarr"),
+            str(server.root / f"{input}.zarr"),
+        ]
+    )
+    return f"{server.url}/{input}.zarr"
+
+
+def read_output(path):
+    with path.open(newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_stats(tmp_path, server):
+    image = convert(server, "2d")
+    plate = convert(server, "hcs")
+    samples = tmp_path / "samples.csv"
+    samples.write_text(
+        f"study,url\nfirst,{image}\nsecond,{plate}\nagain,{image}\nmissing,{server.url}/none.zarr\n"
+    )
+
+    with pytest.raises(SystemExit, match="1 datasets"):
+        dispatch(["stats", "--datasets=2", "--connections=2", str(samples)])
+
+    rows = read_output(tmp_path / "samples_output.csv")
+    assert [r["study"] for r in rows] == ["first", "second", "missing"]
+    first, second, missing = rows
+    assert int(first["written"]) > 0
+    assert first["shape"] == "1,3,1,64,64"
+    assert first["dimension_names"] == "t,c,z,y,x"
+    assert first["name"] == "stats test"
+    assert first["organismId"] == "NCBI:txid9606"
+    assert "creativecommons" in first["license"]
+    # exact totals rather than an estimate from the first wells
+    totals = json.loads((server.root / "hcs.zarr" / "zarr.json").read_text())
+    totals = totals["attributes"]["_ome2024_ngff_challenge_stats"]
+    assert int(second["written"]) == totals["written"]
+    assert int(second["bytes"]) == totals["bytes"]
+    assert second["images"] == "8"
+    assert second["shards"]
+    assert not any(path.startswith("/hcs.zarr/A/2") for path in server.requests)
+    assert missing["written"] == "0"
+
+    # failed datasets are not recorded
+    temp = (tmp_path / "samples_temp.csv").read_text()
+    assert image in temp
+    assert "none.zarr" not in temp
+
+
+def test_stats_resume(tmp_path, server):
+    image = convert(server, "2d")
+    series = convert(server, "bf2raw")
+    samples = tmp_path / "samples.csv"
+    samples.write_text(f"{image}\n{series}\n")
+
+    # a run interrupted after the first dataset, with a partial second row
+    dispatch(["stats", str(samples)])
+    temp = tmp_path / "samples_temp.csv"
+    lines = temp.read_text().splitlines()
+    done = next(line for line in lines if line.startswith(image))
+    temp.write_text(f"{done}\n{series},12\n")
+    (tmp_path / "samples_output.csv").unlink()
+    server.requests.clear()
+
+    dispatch(["stats", str(samples)])
+    assert server.requests
+    assert not any(path.startswith("/2d.zarr") for path in server.requests)
+    rows = {row[0]: row for row in csv.reader(temp.read_text().splitlines())}
+    assert rows[series][3] == "1,1,1,8,8"
+
+    output = (tmp_path / "samples_output.csv").read_text().splitlines()
+    assert output[0].startswith("url,written,")
+    assert [line.split(",")[0] for line in output[1:]] == [image, series]
+
+    server.requests.clear()
+    dispatch(["stats", "--restart", str(samples)])
+    assert any(path.startswith("/2d.zarr") for path in server.requests)
+
+
+def test_stats_catalogue(tmp_path, server):
+    image = convert(server, "2d")
+    plate = convert(server, "hcs")
+    samples = tmp_path / "samples.csv"
+    samples.write_text(f"{image}\n{plate}\n")
+    catalogue = f"--catalogue={tmp_path / 'catalogue.sqlite'}"
+
+    dispatch(["stats", catalogue, str(samples)])
+    assert not (tmp_path / "samples_temp.csv").exists()
+    first = (tmp_path / "samples_output.csv").read_text()
+
+    # unchanged datasets only cost a conditional request per document
+    server.requests.clear()
+    dispatch(["stats", catalogue, str(samples)])
+    roots = {
+        f"/{name}.zarr/{doc}"
+        for name in ("2d", "hcs")
+        for doc in ("zarr.json", "ro-crate-metadata.json")
+    }
+    assert set(server.requests) == roots
+    assert (tmp_path / "samples_output.csv").read_text() == first
+
+    # a changed RO-Crate is picked up, without reading the plate again
+    rocrate = server.root / "2d.zarr" / "ro-crate-metadata.json"
+    rocrate.write_text(rocrate.read_text().replace("stats test", "renamed"))
+    later = rocrate.stat().st_mtime + 60
+    os.utime(rocrate, (later, later))
+    server.requests.clear()
+    export = tmp_path / "datasets.json"
+    dispatch(["stats", catalogue, f"--export={export}", str(samples)])
+    assert "/2d.zarr/0/zarr.json" in server.requests
+    assert not any(path.startswith("/hcs.zarr/A") for path in server.requests)
+
+    records = {r["url"]: r for r in json.loads(export.read_text())}
+    assert records[image]["name"] == "renamed"
+    assert records[plate]["name"] == "stats test"
+    assert records[plate]["images"] == 8
+
+    # exports need no CSV input
+    dispatch(["stats", catalogue, f"--export={tmp_path / 'datasets.csv'}"])
+    rows = read_output(tmp_path / "datasets.csv")
+    assert [r["url"] for r in rows] == sorted([image, plate])
+    assert rows[0]["checked"]
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+
+from ome2024_ngff_challenge import dispatch
+
+DATA = Path(__file__).parent / "data"
+
+CC0 = "https://creativecommons.org/publicdomain/zero/1.0/"
+
+
+def convert(tmp_path, input):
+    out = tmp_path / "out.zarr"
+    dispatch(
+        [
+            "resave",
+            "--cc-by",
+            "--conversion-notes=original",
+            str(DATA / f"{input}.zarr"),
+            str(out),
+        ]
+    )
+    return out
+
+
+def snapshot(path):
+    """
+    Bytes of every file except the group metadata and RO-Crate
+    """
+    groups = {
+        p
+        for p in path.rglob("zarr.json")
+        if json.loads(p.read_text())["node_type"] == "group"
+    }
+    return {
+        p: p.read_bytes()
+        for p in path.rglob("*")
+        if p.is_file() and p not in groups and p.name != "ro-crate-metadata.json"
+    }
+
+
+def creator_notes(path):
+    ome = json.loads((path / "zarr.json").read_text())["attributes"]["ome"]
+    return ome["_creator"]["notes"]
+
+
+@pytest.mark.parametrize("input", ["2d", "bf2raw", "hcs"])
+def test_update(tmp_path, input):
+    out = convert(tmp_path, input)
+    before = snapshot(out)
+
+    dispatch(["update", "--cc0", "--conversion-notes=updated", str(out)])
+
+    rocrate = json.loads((out / "ro-crate-metadata.json").read_text())
+    assert CC0 in json.dumps(rocrate)
+    assert creator_notes(out) == "updated"
+    assert snapshot(out) == before
+
+
+def test_update_keeps_previews(tmp_path):
+    out = tmp_path / "out.zarr"
+    dispatch(
+        ["resave", "--cc-by", "--output-projections", str(DATA / "hcs.zarr"), str(out)]
+    )
+    before = json.loads((out / "ro-crate-metadata.json").read_text())["@graph"]
+
+    dispatch(["update", "--cc0", str(out)])
+
+    rocrate = json.loads((out / "ro-crate-metadata.json").read_text())
+    entities = {entity["@id"]: entity for entity in rocrate["@graph"]}
+    previews = [e for e in before if "ImageObject" in e.get("@type", [])]
+    assert len(previews) == 8
+    assert all(entities[e["@id"]] == e for e in previews)
+    assert entities["./"]["thumbnail"] == {"@id": "A/1/0/thumbnails/thumbnail.png"}
+
+
+def test_update_keeps_rocrate_metadata(tmp_path):
+    out = tmp_path / "out.zarr"
+    metadata = [
+        "--rocrate-name=original name",
+        "--rocrate-description=original description",
+        "--rocrate-organism=NCBI:txid9606",
+        "--rocrate-modality=obo:FBbi_00000369",
+    ]
+    dispatch(["resave", "--cc-by", *metadata, str(DATA / "2d.zarr"), str(out)])
+
+    dispatch(["update", "--cc0", str(out)])
+    dispatch(["update", "--rocrate-name=new name", str(out)])
+
+    rocrate = json.loads((out / "ro-crate-metadata.json").read_text())
+    entities = {entity["@id"]: entity for entity in rocrate["@graph"]}
+    root = entities["./"]
+    assert root["name"] == "new name"
+    assert root["description"] == "original description"
+    assert root["license"] == CC0
+    acquisition = entities[root["resultOf"]["@id"]]
+    assert acquisition["fbbi_id"] == {"@id": "obo:FBbi_00000369"}
+    biosample = entities[entities[acquisition["specimen"]["@id"]]["biosample"]["@id"]]
+    assert biosample["organism_classification"] == {"@id": "NCBI:txid9606"}
+
+
+def test_update_skip_rocrate(tmp_path):
+    out = convert(tmp_path, "2d")
+    rocrate = (out / "ro-crate-metadata.json").read_bytes()
+    dispatch(["update", "--rocrate-skip", str(out)])
+    assert (out / "ro-crate-metadata.json").read_bytes() == rocrate
+    # notes are kept unless replaced
+    assert creator_notes(out) == "original"
+
+
+def test_update_missing(tmp_path):
+    with pytest.raises(SystemExit):
+        dispatch(["update", "--cc0", str(tmp_path / "missing.zarr")])
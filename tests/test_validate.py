@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+
+from ome2024_ngff_challenge import dispatch
+from ome2024_ngff_challenge import shards as shards_module
+from ome2024_ngff_challenge.shards import ShardIndexError, ShardLayout, crc32c
+
+DATA = Path(__file__).parent / "data"
+
+
+def convert(tmp_path, input, *args):
+    out = tmp_path / "out.zarr"
+    dispatch(["resave", "--cc-by", *args, str(DATA / f"{input}.zarr"), str(out)])
+    return out
+
+
+def shards(path):
+    return sorted(
+        p for p in path.rglob("*") if p.is_file() and "c" in p.relative_to(path).parts
+    )
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_crc32c(monkeypatch, native):
+    if not native:
+        monkeypatch.setattr(shards_module, "_crc32c_native", None)
+    elif shards_module._crc32c_native is None:
+        pytest.skip("numcodecs has no crc32c implementation")
+    assert crc32c(b"123456789") == 0xE3069283
+    assert crc32c(b"") == 0
+
+
+def test_shard_layout():
+    layout = ShardLayout.from_metadata(
+        {
+            "shape": [10, 100],
+            "chunk_grid": {"configuration": {"chunk_shape": [5, 64]}},
+            "chunk_key_encoding": {"name": "default"},
+            "codecs": [
+                {
+                    "name": "sharding_indexed",
+                    "configuration": {
+                        "chunk_shape": [5, 32],
+                        "index_codecs": [{"name": "bytes"}, {"name": "crc32c"}],
+                    },
+                }
+            ],
+        }
+    )
+    assert layout.grid == [2, 2]
+    assert sorted(layout.keys()) == ["c/0/0", "c/0/1", "c/1/0", "c/1/1"]
+    assert layout.index_size == 2 * 16 + 4
+
+    entries = (0).to_bytes(8, "little") + (10).to_bytes(8, "little")
+    entries += (10).to_bytes(8, "little") + (6).to_bytes(8, "little")
+    index = entries + crc32c(entries).to_bytes(4, "little")
+    assert layout.check(index, 16 + layout.index_size).tolist() == [[0, 10], [10, 6]]
+    assert layout.encode([b"0123456789", b"abcdef"]) == b"0123456789abcdef" + index
+    with pytest.raises(ShardIndexError, match="outside"):
+        layout.check(index, 15 + layout.index_size)
+    with pytest.raises(ShardIndexError, match="checksum"):
+        layout.check(entries + b"\0\0\0\0", 16 + layout.index_size)
+
+
+@pytest.mark.parametrize("input", ["2d", "bf2raw", "hcs"])
+def test_validate(tmp_path, input, capsys):
+    out = convert(tmp_path, input)
+    dispatch(["validate", str(out)])
+    assert "0 problems" in capsys.readouterr().out
+
+
+def test_validate_corrupt_index(tmp_path):
+    out = convert(tmp_path, "2d")
+    shard = shards(out)[0]
+    data = bytearray(shard.read_bytes())
+    data[-8] ^= 0xFF
+    shard.write_bytes(bytes(data))
+    with pytest.raises(SystemExit):
+        dispatch(["validate", str(out)])
+
+
+def test_validate_truncated(tmp_path):
+    out = convert(tmp_path, "2d")
+    shard = shards(out)[0]
+    shard.write_bytes(shard.read_bytes()[10:])
+    with pytest.raises(SystemExit):
+        dispatch(["validate", str(out)])
+
+
+def test_validate_missing(tmp_path, capsys):
+    out = convert(tmp_path, "2d")
+    shards(out)[0].unlink()
+    dispatch(["validate", str(out)])
+    assert "(1 missing)" in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        dispatch(["validate", "--strict", str(out)])
+
+
+def test_validate_metadata(tmp_path):
+    out = convert(tmp_path, "2d")
+    metadata = json.loads((out / "zarr.json").read_text())
+    metadata["attributes"]["ome"]["version"] = "0.4"
+    (out / "zarr.json").write_text(json.dumps(metadata))
+    with pytest.raises(SystemExit):
+        dispatch(["validate", str(out)])
+
+
+def test_validate_s3(s3, tmp_path, capsys):
+    out = convert(tmp_path, "hcs")
+    s3.upload("output", out, f"{tmp_path.name}/out.zarr")
+    args = [
+        "validate",
+        "--input-bucket=output",
+        f"--input-endpoint={s3.endpoint}",
+        f"{tmp_path.name}/out.zarr",
+    ]
+    dispatch(args)
+    assert "0 problems" in capsys.readouterr().out
+
+    shard = shards(out)[0]
+    key = f"{tmp_path.name}/out.zarr/{shard.relative_to(out).as_posix()}"
+    s3.client().put_object(Bucket="output", Key=key, Body=shard.read_bytes()[:-1])
+    with pytest.raises(SystemExit):
+        dispatch(args)